@@ -1,15 +1,23 @@
 """
 Core fetcher objects, including possible optional mixins
 """
+import functools
+import json
 import logging
+import operator
 from abc import ABC
+from datetime import datetime
 from pathlib import Path
-from typing import Union
+from typing import Dict, Iterable, List, Tuple, Type, Union
 
 import peewee
 import pydantic
 
-from .utils.db import DownloadRecord, db
+from .utils import metrics
+from .utils.cache import DownloadCache
+from .utils.checksum import Checksum, DEFAULT_CHECKSUM_ALGORITHM
+from .utils.db import DownloadRecord, AvailabilityRecord, get_database, bind_model, ensure_tables, \
+    SQLITE_MAX_VARIABLES
 
 logger = logging.getLogger(__name__)
 
@@ -26,10 +34,26 @@ class AbstractFetcher(pydantic.BaseModel, ABC):
             - donwload file and rename with temporary extension
             - record download in a database
 
+        Downloads are also recorded in process-wide metrics, cf. datafetch.utils.metrics
+
         :param kwargs:
         :return:
         """
-        return self._fetch(**kwargs)
+        labels = self.get_metrics_labels(**kwargs)
+        status = "failed"
+        with metrics.fetches_in_progress.track_in_progress(**labels), metrics.fetch_duration_seconds.time(**labels):
+            try:
+                fp = self._fetch(**kwargs)
+                if fp is not None:
+                    remote_info = kwargs.get('remote_info') or {}
+                    status = "unchanged" if remote_info.get('unchanged') else "downloaded"
+                    if status == "downloaded" and Path(fp).is_file():
+                        # Protocols set remote_info['resumed_from'] only if a partial download was continued
+                        downloaded_size = Path(fp).stat().st_size - remote_info.get('resumed_from', 0)
+                        metrics.downloaded_bytes_total.inc(max(0, downloaded_size), **labels)
+                return fp
+            finally:
+                metrics.fetches_total.inc(status=status, **labels)
 
     def _fetch(self, destination_fp: str = None, **kwargs) -> Union[Path, None]:
         """
@@ -40,6 +64,15 @@ class AbstractFetcher(pydantic.BaseModel, ABC):
         """
         raise NotImplementedError
 
+    def get_metrics_labels(self, **kwargs) -> Dict[str, str]:
+        """
+        Labels of download metrics, identifying where a file is downloaded from, cf. metrics.REMOTE_LABELS
+
+        :param kwargs: arguments of `_fetch()`
+        :return:
+        """
+        return {'protocol': "", 'host': "", 'bucket': ""}
+
 
 class FetchWithTemporaryExtensionMixin(AbstractFetcher, pydantic.BaseModel, ABC):
     """
@@ -47,17 +80,122 @@ class FetchWithTemporaryExtensionMixin(AbstractFetcher, pydantic.BaseModel, ABC)
     downloading the file
     """
     temporary_extension: str = "tmp"
+    # Continue an interrupted download from an existing temporary file,
+    # when the protocol and the remote server allow it
+    resume_partial: bool = False
+    # Checksum computed while downloading, and recorded in download database, None for disabling it
+    # eg. "sha256", "md5", "xxh3_64" (requires xxhash), cf. datafetch.utils.checksum
+    checksum_algorithm: str = DEFAULT_CHECKSUM_ALGORITHM
+    # Fail download when content doesn't match remote metadata (size, MD5 ETag), before renaming temporary file
+    verify_checksum: bool = True
+    # Skip download when remote file didn't change since local file was downloaded,
+    # according to validators (ETag, Last-Modified) kept in a hidden file next to it, cf. get_validators_fp()
+    conditional_fetch: bool = False
+    # Shared cache of downloaded files, cf. datafetch.utils.cache, None for disabling it
+    cache_dir: str = None
+    # Cache quota in bytes, and maximum age of cached files in seconds, None for unlimited
+    cache_max_size: int = None
+    cache_ttl: float = None
+    # How cached files are put into destination directories : "hardlink", "reflink", "symlink" or "copy"
+    # Hard-linked files share their inode with the cache, they must be replaced rather than modified in place
+    cache_link_mode: str = "hardlink"
+    _download_cache: DownloadCache = None
+
+    class Config:
+        underscore_attrs_are_private = True
 
     def fetch(self, destination_dir: str, destination_filename: str,
+              cache_key: str = None,
               **kwargs) -> Union[Path, None]:
         """
         Fetch a file with a temporary local extension
 
         :param destination_dir:
         :param destination_filename:
+        :param cache_key: remote identity of the file in download cache, eg. url, None for not using the cache
         :param kwargs:
         :return:
         """
+        fp, fp_tmp = self.get_destination_fp(destination_dir, destination_filename)
+        remote_info = kwargs.setdefault('remote_info', {})
+
+        cache = self.download_cache if cache_key is not None else None
+        if cache is not None:
+            fp_cached = cache.materialize(cache_key, fp)
+            if fp_cached is not None:
+                metrics.fetches_total.inc(status="cached", **self.get_metrics_labels(**kwargs))
+                return fp_cached
+
+        kwargs.update(self.get_local_state(fp, fp_tmp))
+        fp_downloaded = super().fetch(destination_fp=str(fp_tmp), **kwargs)
+        fp = self.finalize_temporary(fp_downloaded, fp)
+
+        if fp is not None and not remote_info.get('unchanged'):
+            self.keep_downloaded(fp, remote_info, cache_key=cache_key if cache is not None else None)
+        return fp
+
+    def get_local_state(self, fp: Path, fp_tmp: Path) -> dict:
+        """
+        What is already available locally for a download : a partial download to resume, or a previous copy
+        to keep if remote file didn't change
+
+        :param fp: final path
+        :param fp_tmp: temporary path
+        :return: arguments of `_fetch()`, ie. `resume_from`, `local_fp` and `local_validators`
+        """
+        local_state = {}
+        if self.resume_partial and self.temporary_extension and fp_tmp.is_file():
+            local_state['resume_from'] = fp_tmp.stat().st_size
+            logger.info(f"Found partial download {fp_tmp} ({local_state['resume_from']} bytes)")
+
+        if self.conditional_fetch:
+            local_validators = self.read_validators(fp)
+            if local_validators:
+                # Protocols return `local_fp` as is if remote file didn't change, setting remote_info['unchanged']
+                local_state.update({'local_fp': fp, 'local_validators': local_validators})
+        return local_state
+
+    def keep_downloaded(self, fp: Path, remote_info: dict, cache_key: str = None):
+        """
+        Keep track of a newly downloaded file : its remote validators for conditional fetch, and a copy in cache
+
+        :param fp:
+        :param remote_info: remote file information, filled by protocols
+        :param cache_key: None for not storing it in cache
+        :return:
+        """
+        if self.conditional_fetch:
+            self.write_validators(fp, remote_info)
+        if cache_key is not None:
+            try:
+                self.download_cache.put(cache_key, fp, checksum=remote_info.get('checksum'))
+            except OSError as exc:
+                logger.warning(f"Unable to store {fp} in cache {self.cache_dir} : {exc}")
+
+    @property
+    def download_cache(self) -> Union[DownloadCache, None]:
+        """
+        Shared download cache, None if disabled
+
+        :return:
+        """
+        if self.cache_dir is None:
+            return None
+        settings = {'cache_dir': self.cache_dir, 'max_size': self.cache_max_size, 'ttl': self.cache_ttl,
+                    'link_mode': self.cache_link_mode}
+        # Created once, unless cache settings were changed since
+        if self._download_cache is None or self._download_cache.dict() != settings:
+            self._download_cache = DownloadCache(**settings)
+        return self._download_cache
+
+    def get_destination_fp(self, destination_dir: str, destination_filename: str) -> Tuple[Path, Path]:
+        """
+        Final and temporary paths of a file to download, creating parent directory if needed
+
+        :param destination_dir:
+        :param destination_filename:
+        :return:
+        """
         fp = Path(destination_dir) / destination_filename
         if not fp.parent.exists():
             fp.parent.mkdir(parents=True, exist_ok=True)
@@ -67,11 +205,97 @@ class FetchWithTemporaryExtensionMixin(AbstractFetcher, pydantic.BaseModel, ABC)
             fp_tmp = fp.parent / f"{fp.name}.{self.temporary_extension}"
             logger.debug(f"Using temporary filename {fp_tmp} ...")
 
-        fp_downloaded = super().fetch(destination_fp=str(fp_tmp), **kwargs)
+        return fp, fp_tmp
+
+    @staticmethod
+    def get_validators_fp(fp: Path) -> Path:
+        """
+        Hidden file keeping remote validators of a downloaded file, for conditional fetch
+
+        :param fp:
+        :return:
+        """
+        return fp.parent / f".{fp.name}.validators"
+
+    def read_validators(self, fp: Path) -> Union[dict, None]:
+        """
+        Remote validators of a previously downloaded file
+
+        :param fp:
+        :return: None if file or validators don't exist, or if file was modified since download
+        """
+        fp_validators = self.get_validators_fp(fp)
+        if not fp.is_file() or not fp_validators.is_file():
+            return None
+        try:
+            validators = json.loads(fp_validators.read_text())
+        except ValueError as exc:
+            logger.warning(f"Ignoring invalid validators {fp_validators} : {exc}")
+            return None
+        if validators.pop('local_size', None) != fp.stat().st_size:
+            logger.debug(f"{fp} changed since it was downloaded, ignoring its validators")
+            return None
+        return validators
+
+    def write_validators(self, fp: Path, remote_info: dict):
+        """
+        Keep remote validators of a downloaded file
+
+        :param fp:
+        :param remote_info: remote file information, filled by protocols
+        :return:
+        """
+        validators = {key: str(remote_info[key]) for key in ('etag', 'last_modified')
+                      if remote_info.get(key) is not None}
+        if not validators:
+            return
+        if remote_info.get('size') is not None:
+            validators['size'] = int(remote_info['size'])
+        validators['local_size'] = fp.stat().st_size
+        self.get_validators_fp(fp).write_text(json.dumps(validators))
+
+    def new_checksum(self, with_md5: bool = False) -> Union[Checksum, None]:
+        """
+        Checksum to be updated while downloading, None if disabled
+
+        :param with_md5: also compute MD5, for verifying it against an ETag
+        :return:
+        """
+        if self.checksum_algorithm is None:
+            return None
+        return Checksum(self.checksum_algorithm, with_md5=with_md5 and self.verify_checksum)
 
+    def finish_checksum(self, checksum: Union[Checksum, None], remote_info: dict,
+                        etag: str = None, size: int = None):
+        """
+        Verify checksum against remote metadata, and make it available as remote information
+
+        :param checksum:
+        :param remote_info:
+        :param etag: checked only if it is a MD5
+        :param size: expected size, None if unknown
+        :return:
+        :raise ChecksumMismatchError:
+        """
+        if checksum is None:
+            return
+        if self.verify_checksum:
+            checksum.verify(etag=etag, size=size)
+        if remote_info is not None:
+            remote_info['checksum'] = checksum.value
+
+    def finalize_temporary(self, fp_downloaded: Union[Path, None], fp: Path) -> Union[Path, None]:
+        """
+        Rename a downloaded temporary file to its final name
+
+        :param fp_downloaded: result of the download, None if failed
+        :param fp: final path
+        :return:
+        """
         if fp_downloaded is not None:
             if self.temporary_extension:
-                if fp_downloaded.is_file():
+                # Nothing to rename when existing file was kept, eg. unchanged remote file
+                if fp_downloaded.is_file() and fp_downloaded != fp:
                     logger.info(f"Renaming {fp_downloaded} to {fp}")
                     fp_downloaded.rename(fp)
                 fp_downloaded = fp
@@ -94,7 +318,8 @@ class DownloadedFileRecorderMixin(AbstractFetcher, pydantic.BaseModel, ABC):
 
     db_name: str = None
     db_dir: str = "/tmp/"
-    _db: peewee.Database = None
+    # Keep database connection opened between fetches, cf. db_open() / db_close()
+    keep_db_open: bool = True
 
     def fetch(self, record_key: str, **kwargs) -> Union[Path, None]:
         """
@@ -114,15 +339,22 @@ class DownloadedFileRecorderMixin(AbstractFetcher, pydantic.BaseModel, ABC):
             downdb_record, _ = self.db_get_record(key=record_key)
             if downdb_record.need_download():
                 logger.info(f"{downdb_record} : Need download")
+                # Validators from previous attempt, and remote information filled while downloading
+                kwargs['validators'] = {'etag': downdb_record.etag, 'last_modified': downdb_record.last_modified}
+                remote_info = kwargs.setdefault('remote_info', {})
                 try:
                     downdb_record.set_start()
                     fp = super().fetch(**kwargs)
-                    downdb_record.set_downloaded(fp)
+                    if fp is None:
+                        downdb_record.set_failed(error="Download failed")
+                    else:
+                        downdb_record.set_downloaded(fp)
                 except Exception as exc:
                     downdb_record.set_failed(error=str(exc))
                     logger.error(str(exc), exc_info=exc)
-
-                downdb_record.save()
+                finally:
+                    downdb_record.set_remote_validators(**remote_info)
+                    downdb_record.save()
             else:
                 logger.info(f"{record_key} : Already downloaded {downdb_record.filepath} ...")
                 fp = Path(downdb_record.filepath)
@@ -140,21 +372,222 @@ class DownloadedFileRecorderMixin(AbstractFetcher, pydantic.BaseModel, ABC):
             self.db_name = self.__class__.__name__
         return Path(self.db_dir) / f"{self.db_name}.db"
 
+    @property
+    def db(self) -> peewee.SqliteDatabase:
+        """
+        Download database, shared by all fetchers using the same file
+
+        :return:
+        """
+        return get_database(self.db_path)
+
+    @property
+    def db_model(self) -> Type[DownloadRecord]:
+        """
+        DownloadRecord model bound to this fetcher's database
+
+        :return:
+        """
+        return bind_model(DownloadRecord, self.db)
+
+    @property
+    def availability_model(self) -> Type[AvailabilityRecord]:
+        """
+        AvailabilityRecord model bound to this fetcher's database
+
+        :return:
+        """
+        return bind_model(AvailabilityRecord, self.db)
+
+    def db_open(self):
+        """
+        Open a connection to the download database for the current thread, if not already opened
+
+        Connection is kept opened across fetches until `db_close()`, unless `keep_db_open` is disabled
+
+        :return:
+        """
+        self.db.connect(reuse_if_open=True)
+        ensure_tables(self.db, [self.db_model, self.availability_model])
+
+    def db_close(self):
+        """
+        Close connection to the download database for the current thread
+
+        :return:
+        """
+        if not self.db.is_closed():
+            self.db.close()
+
     def __enter__(self):
-        logger.debug(f"Using database {self.db_path} ...")
-        db.init(database=self.db_path)
-        db.connect()
-        db.create_tables([DownloadRecord])
+        self.db_open()
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        db.close()
+        if not self.keep_db_open:
+            self.db_close()
 
-    @staticmethod
-    def db_get_record(key: str) -> DownloadRecord:
+    def db_get_record(self, key: str) -> Tuple[DownloadRecord, bool]:
         """
         Get a DownDb record from key
 
         :param key:
         :return:
         """
-        return DownloadRecord.get_or_create(key=key)
+        self.db_open()
+        return self.db_model.get_or_create(key=key)
+
+    def db_get_records(self, keys: List[str]) -> List[DownloadRecord]:
+        """
+        Get existing records for many keys at once
+
+        :param keys:
+        :return:
+        """
+        model = self.db_model
+        self.db_open()
+        records = []
+        for keys_batch in peewee.chunked(keys, SQLITE_MAX_VARIABLES):
+            records.extend(model.select().where(model.key.in_(keys_batch)))
+        return records
+
+    def db_plan(self, keys: List[str], create_missing: bool = True) -> Dict[str, List[str]]:
+        """
+        Get status of many records at once, eg. for planning a large backfill
+
+        Example of usage :
+            >>> fetcher.db_plan(["a", "b", "c", "d"])
+            {'missing': ['d'], 'failed': ['b'], 'downloaded': ['a', 'c']}
+
+        :param keys:
+        :param create_missing: insert records for missing keys, in a single transaction
+        :return: keys grouped by record status, 'missing' being keys without any record
+        """
+        model = self.db_model
+        self.db_open()
+
+        status_by_key = {}
+        for keys_batch in peewee.chunked(keys, SQLITE_MAX_VARIABLES):
+            query = model.select(model.key, model.status).where(model.key.in_(keys_batch)).tuples()
+            status_by_key.update(query)
+
+        plan = {}
+        for key in keys:
+            plan.setdefault(status_by_key.get(key, "missing"), []).append(key)
+
+        if create_missing and plan.get("missing"):
+            logger.debug(f"Inserting {len(plan['missing'])} missing records ...")
+            with self.db.atomic():
+                for keys_batch in peewee.chunked(plan["missing"], SQLITE_MAX_VARIABLES):
+                    model.insert_many([{'key': key} for key in keys_batch], fields=[model.key]) \
+                        .on_conflict_ignore().execute()
+
+        return plan
+
+    def db_keys_to_download(self, keys: List[str], create_missing: bool = True) -> List[str]:
+        """
+        Among `keys`, the ones that need to be downloaded (cf. DownloadRecord.need_download), in the same order
+
+        :param keys:
+        :param create_missing:
+        :return:
+        """
+        plan = self.db_plan(keys, create_missing=create_missing)
+        to_download = set()
+        for status in ("missing",) + DownloadRecord.need_download_status:
+            to_download.update(plan.get(status, []))
+        return [key for key in keys if key in to_download]
+
+    def db_delete_records_under(self, directories: List[Union[str, Path]]) -> int:
+        """
+        Delete records of files located under some directories, eg. after removing them
+
+        :param directories:
+        :return: number of deleted records
+        """
+        model = self.db_model
+        self.db_open()
+        nb_deleted = 0
+        with self.db.atomic():
+            # One condition per directory, sqlite limiting the depth of expressions to 1000
+            for directories_batch in peewee.chunked(directories, 100):
+                condition = functools.reduce(operator.or_, [
+                    model.filepath.startswith(f"{Path(directory).absolute()}/") for directory in directories_batch
+                ])
+                nb_deleted += model.delete().where(condition).execute()
+        logger.debug(f"Deleted {nb_deleted} records under {len(directories)} directories")
+        return nb_deleted
+
+    def db_forget_missing_files(self) -> int:
+        """
+        Delete records of downloaded files that don't exist anymore, eg. removed by hand,
+        so that they are downloaded again if needed
+
+        :return: number of deleted records
+        """
+        model = self.db_model
+        self.db_open()
+        query = model.select(model.id, model.filepath).where(model.status == "downloaded").tuples()
+        missing_ids = [record_id for record_id, filepath in query
+                       if filepath is not None and not Path(filepath).exists()]
+        with self.db.atomic():
+            for ids_batch in peewee.chunked(missing_ids, SQLITE_MAX_VARIABLES):
+                model.delete().where(model.id.in_(ids_batch)).execute()
+        if missing_ids:
+            logger.info(f"Forgot {len(missing_ids)} records of files that don't exist anymore")
+        return len(missing_ids)
+
+    def db_record_availability(self, product: str, run_time: datetime, timesteps: Dict[str, str],
+                               available_keys: Iterable[str], observed_at: datetime = None):
+        """
+        Record an observation of which resources are available, keeping track of the first time they were seen
+
+        :param product: eg. bucket name
+        :param run_time:
+        :param timesteps: key -> timestep of every expected resource
+        :param available_keys: keys of available resources, others being missing
+        :param observed_at: time of observation, now by default
+        :return:
+        """
+        if observed_at is None:
+            observed_at = datetime.utcnow()
+        available_keys = set(available_keys) & timesteps.keys()
+        missing_keys = [key for key in timesteps if key not in available_keys]
+
+        model = self.availability_model
+        self.db_open()
+        with self.db.atomic():
+            rows = [{'key': key, 'product': product, 'run_time': run_time, 'timestep': timestep}
+                    for key, timestep in timesteps.items()]
+            for rows_batch in peewee.chunked(rows, SQLITE_MAX_VARIABLES // 4):
+                model.insert_many(rows_batch).on_conflict_ignore().execute()
+            for date_field, keys in (('date_last_missing', missing_keys), ('date_first_seen', available_keys)):
+                for keys_batch in peewee.chunked(keys, SQLITE_MAX_VARIABLES):
+                    model.update({date_field: observed_at}) \
+                        .where(model.key.in_(keys_batch) & model.date_first_seen.is_null()) \
+                        .execute()
+
+    def db_get_availability_offsets(self, product: str, max_runs: int = 30) -> Dict[str, List[float]]:
+        """
+        Publication offsets observed for the last runs of a product, per timestep
+
+        :param product:
+        :param max_runs: number of most recent observations kept per timestep
+        :return: timestep -> offsets in seconds after run time, most recent first
+        """
+        model = self.availability_model
+        self.db_open()
+        # Rank observations of each timestep in SQL, so that only the most recent ones are read
+        rank = peewee.fn.ROW_NUMBER().over(partition_by=[model.timestep], order_by=[model.run_time.desc()])
+        ranked = model.select(model.id, rank.alias('rank')) \
+            .where((model.product == product)
+                   & model.date_last_missing.is_null(False) & model.date_first_seen.is_null(False))
+        query = model.select() \
+            .join(ranked, on=(model.id == ranked.c.id)) \
+            .where(ranked.c.rank <= max_runs) \
+            .order_by(model.run_time.desc())
+
+        offsets = {}
+        for record in query:
+            offsets.setdefault(record.timestep, []).append(record.publication_offset())
+        return offsets
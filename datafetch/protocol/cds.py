@@ -1,8 +1,14 @@
+import ast
+import hashlib
+import itertools
+import json
 import logging
 import pprint
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Union, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Union, Tuple
 
 import pydantic
 import cdsapi
@@ -146,15 +152,14 @@ class ClimateDataStoreApi(SimpleHttpFetch,
         :param dict:
         :return:
         """
-        record_key = self.get_resource_key(cds_resource_name, cds_resource_param)
         with self:
             logger.debug(f"{cds_resource_name} Checking if queuing to CDS is needed ...")
-            downdb_record, created = self.db_get_record(key=str(record_key))
+            downdb_record, created = self.db_get_resource_record(cds_resource_name, cds_resource_param)
 
             if not created and force_new:
                 logger.info(f"Cleaning existing record {downdb_record}")
-                downdb_record.delete().execute()
-                downdb_record, created = self.db_get_record(key=str(record_key))
+                downdb_record.delete_instance()
+                downdb_record, created = self.db_get_resource_record(cds_resource_name, cds_resource_param)
 
             if downdb_record.need_queue():
                 # No request has been made yet
@@ -204,25 +209,176 @@ class ClimateDataStoreApi(SimpleHttpFetch,
             logger.error(f"Cannot check queue status while not using sqlite database to track requests id")
             return None
 
-        record_key = self.get_resource_key(cds_resource_name, cds_resource_param)
-        downdb_record, created = self.db_get_record(key=str(record_key))
+        downdb_record, created = self.db_get_resource_record(cds_resource_name, cds_resource_param)
         if created:
-            logger.error(f"Cannot find existing request id for {record_key} ...")
+            logger.error(f"Cannot find existing request id for {downdb_record.key} ...")
             return None
 
         state, result = self.check_queue_by_id(downdb_record.queue_id, **kwargs)
+        if state == "failed":
+            logger.debug(cds_resource_name)
+            logger.debug(pprint.pformat(cds_resource_param))
+        self.update_record_state(downdb_record, state, result)
+
+        return downdb_record
+
+    @staticmethod
+    def update_record_state(downdb_record: DownloadRecord, state: str, result: dict):
+        """
+        Update a record according to the state of its request on CDS
+
+        :param downdb_record:
+        :param state:
+        :param result:
+        :return:
+        """
         if state == "completed":
             downdb_record.origin_url = result['location']
             if downdb_record.status == "queued":
                 downdb_record.set_queued_and_ready()
         if state == "failed":
             downdb_record.set_failed(error=str(result))
-            logger.debug(cds_resource_name)
-            logger.debug(pprint.pformat(cds_resource_param))
             logger.debug(pprint.pformat(result))
         downdb_record.save()
 
-        return downdb_record
+    def poll_queue(self, records: List[DownloadRecord] = None,
+                   max_workers: int = 8,
+                   min_interval: float = 10, max_interval: float = 300, backoff: float = 1.5,
+                   timeout: float = None,
+                   refill: Callable[[int], List[DownloadRecord]] = None) -> Iterator[DownloadRecord]:
+        """
+        Check many queued requests concurrently, and yield each of them as soon as it is completed or failed
+
+        Each request is checked with its own exponential backoff,
+        from `min_interval` up to `max_interval` seconds between two checks
+
+        Example of usage :
+            >>> for record in cds.poll_queue():
+            ...     if record.status == "queued_and_ready":
+            ...         cds.download_result_by_id(record.queue_id, destination_dir="/tmp")
+
+        :param records: records to check, by default every queued record of download database
+        :param max_workers: maximum number of simultaneous checks
+        :param min_interval:
+        :param max_interval:
+        :param backoff:
+        :param timeout: stop after this number of seconds, even if some requests are still queued
+        :param refill: called with the number of requests being polled, at start and each time one is over,
+                       returning new records to poll too
+        :return:
+        """
+        if records is None:
+            model = self.db_model
+            self.db_open()
+            records = model.select().where(model.status == "queued")
+        pending = {}
+        next_check = {}
+        interval = {}
+
+        def add_records(new_records: List[DownloadRecord]):
+            new_pending = {record.queue_id: record for record in new_records if record.queue_id}
+            pending.update(new_pending)
+            next_check.update({queue_id: time.monotonic() for queue_id in new_pending})
+            interval.update({queue_id: min_interval for queue_id in new_pending})
+
+        add_records(records)
+        if refill is not None:
+            add_records(refill(len(pending)))
+        logger.info(f"Polling {len(pending)} CDS requests ...")
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending:
+                now = time.monotonic()
+                due = [queue_id for queue_id in pending if next_check[queue_id] <= now]
+                for queue_id, state, result in self._check_queue_ids(executor, due):
+                    if state in ("completed", "failed"):
+                        record = pending.pop(queue_id)
+                        self.update_record_state(record, state, result)
+                        yield record
+                        if refill is not None:
+                            add_records(refill(len(pending)))
+                    else:
+                        interval[queue_id] = min(interval[queue_id] * backoff, max_interval)
+                        next_check[queue_id] = time.monotonic() + interval[queue_id]
+
+                if not pending:
+                    break
+                if timeout is not None and time.monotonic() - start > timeout:
+                    logger.warning(f"Polling timeout, {len(pending)} CDS requests still in queue")
+                    break
+                time.sleep(max(0.0, min(next_check[queue_id] for queue_id in pending) - time.monotonic()))
+
+    def _check_queue_ids(self, executor: ThreadPoolExecutor,
+                         queue_ids: List[str]) -> Iterator[Tuple[str, Union[str, None], Union[dict, None]]]:
+        """
+        Check several queued requests concurrently, and yield each of them as soon as it is checked
+
+        :param executor:
+        :param queue_ids:
+        :return: queue id, state and result of each request, None state if it couldn't be checked
+        """
+        futures = {executor.submit(self.check_queue_by_id, queue_id): queue_id for queue_id in queue_ids}
+        for future in as_completed(futures):
+            queue_id = futures[future]
+            try:
+                state, result = future.result()
+            except Exception as exc:
+                logger.warning(f"{queue_id} : Unable to check queue : {str(exc)}")
+                state, result = None, None
+            yield queue_id, state, result
+
+    def submit_window(self, resources: List[Tuple[str, dict]], max_active: int = 10,
+                      **kwargs) -> Iterator[DownloadRecord]:
+        """
+        Submit many requests to CDS, keeping at most `max_active` of them in queue at the same time,
+        and yield each request as soon as it is completed or failed
+
+        Progress is kept in download database, so that a restarted process resumes where it stopped :
+        requests already in queue are polled again, and completed ones not yet downloaded are yielded first
+
+        Example of usage :
+            >>> for record in cds.submit_window(resources, max_active=8):
+            ...     if record.status == "queued_and_ready":
+            ...         cds.download_result_by_id(record.queue_id, destination_dir="/tmp")
+
+        :param resources: list of (cds_resource_name, cds_resource_param)
+        :param max_active: maximum number of requests in CDS queue, cf. CDS limits per user
+        :param kwargs: for poll_queue()
+        :return:
+        """
+        resource_by_key = {}
+        for name, param in resources:
+            resource_by_key.setdefault(self.get_resource_key(name, param), (name, param))
+
+        plan = self.db_plan(list(resource_by_key), create_missing=False)
+        for record in self.db_get_records(plan.get("queued_and_ready", [])):
+            yield record
+        in_queue = self.db_get_records(plan.get("queued", []))
+        to_submit = deque(plan.get("missing", []) + plan.get("empty", []))
+        logger.info(f"{len(resource_by_key)} CDS requests : {len(in_queue)} in queue, {len(to_submit)} to submit")
+
+        def refill(nb_active: int) -> List[DownloadRecord]:
+            submitted = []
+            while to_submit and nb_active + len(submitted) < max_active:
+                key = to_submit.popleft()
+                name, param = resource_by_key[key]
+                try:
+                    record, _ = self.submit_to_queue(name, param)
+                except Exception as exc:
+                    logger.error(f"{name} : Queuing request failed : {str(exc)}")
+                    record = None
+                if record is None or record.status != "queued":
+                    # Try again once another request is over
+                    to_submit.appendleft(key)
+                    break
+                submitted.append(record)
+            return submitted
+
+        yield from self.poll_queue(records=in_queue, refill=refill, **kwargs)
+
+        if to_submit:
+            logger.error(f"{len(to_submit)} CDS requests couldn't be submitted")
 
     def check_queue_by_id(self, queue_id: str,
                           wait_until_complete: bool = False,
@@ -274,6 +430,7 @@ class ClimateDataStoreApi(SimpleHttpFetch,
     def download_result(self,
                         cds_resource_name: str, cds_resource_param: dict,
                         destination_dir: str, destination_filename: str = None,
+                        cleanup: bool = True,
                         **kwargs) -> Union[Path, None]:
         """
         Download result locally
@@ -282,6 +439,7 @@ class ClimateDataStoreApi(SimpleHttpFetch,
         :param cds_resource_param:
         :param destination_filename:
         :param destination_dir:
+        :param cleanup: delete request from CDS once downloaded
         :param kwargs:
         :return:
         """
@@ -289,10 +447,9 @@ class ClimateDataStoreApi(SimpleHttpFetch,
             logger.error(f"Cannot check queue status while not using sqlite database to track requests id")
             raise ReferenceError()
 
-        record_key = self.get_resource_key(cds_resource_name, cds_resource_param)
-        downdb_record, created = self.db_get_record(key=str(record_key))
+        downdb_record, created = self.db_get_resource_record(cds_resource_name, cds_resource_param)
         if created:
-            logger.error(f"Cannot find existing request id for {record_key} ...")
+            logger.error(f"Cannot find existing request id for {downdb_record.key} ...")
             return None
 
         if downdb_record.status == "queued_and_ready":
@@ -305,11 +462,8 @@ class ClimateDataStoreApi(SimpleHttpFetch,
                 record_key=downdb_record.key,
                 **kwargs)
 
-            if fp:
-                logger.info("Cleanup CDS request")
-                r = Result(client=self.cds, reply=None)
-                r.update(request_id=downdb_record.queue_id)
-                r.delete()
+            if fp and cleanup:
+                self.cleanup_request(downdb_record.queue_id)
 
             return fp
         elif downdb_record.status == "downloaded":
@@ -323,6 +477,79 @@ class ClimateDataStoreApi(SimpleHttpFetch,
             logger.error(f"Unexpected status {downdb_record}")
             return None
 
+    def cleanup_request(self, queue_id: str):
+        """
+        Delete a request from CDS, eg. once its result is downloaded
+
+        :param queue_id:
+        :return:
+        """
+        logger.info(f"{queue_id} : Cleanup CDS request")
+        r = Result(client=self.cds, reply=None)
+        r.update(request_id=queue_id)
+        r.delete()
+
+    def download_pipelined(self, resources: List[Tuple[str, dict]], destination_dir: str,
+                           max_concurrent_downloads: int = 2,
+                           records: Iterable[DownloadRecord] = None,
+                           destination_filenames: Dict[str, str] = None,
+                           **kwargs) -> List[Tuple[Union[Path, None], dict]]:
+        """
+        Download results of many requests, as soon as each of them is ready
+
+        Checking queue, downloading and cleaning up requests on CDS run as concurrent stages :
+            - requests are polled from the current thread (cf. poll_queue)
+            - ready results are downloaded by a pool of `max_concurrent_downloads` threads
+            - downloaded requests are deleted from CDS by another thread
+
+        :param resources: list of (cds_resource_name, cds_resource_param), already submitted to queue
+        :param destination_dir:
+        :param max_concurrent_downloads:
+        :param records: records as they get ready, instead of polling queued resources, eg. from submit_window()
+        :param destination_filenames: destination filename by resource key, default to CDS result name
+        :param kwargs: for poll_queue()
+        :return: downloaded file and param of each resource, in the same order
+        """
+        resource_by_key = {}
+        for name, param in resources:
+            resource_by_key.setdefault(self.get_resource_key(name, param), (name, param))
+        destination_filenames = destination_filenames or {}
+
+        existing_records = self.db_get_records(list(resource_by_key))
+        fp_by_key = {
+            record.key: Path(record.filepath)
+            for record in existing_records if record.status == "downloaded" and record.filepath
+        }
+        if records is None:
+            ready = [record for record in existing_records if record.status == "queued_and_ready"]
+            records = itertools.chain(ready, self.poll_queue(
+                records=[record for record in existing_records if record.status == "queued"], **kwargs))
+
+        def download(record: DownloadRecord) -> Tuple[str, Union[Path, None]]:
+            name, param = resource_by_key[record.key]
+            fp = None
+            try:
+                fp = self.download_result(name, param, destination_dir=destination_dir,
+                                          destination_filename=destination_filenames.get(record.key),
+                                          cleanup=False)
+                if fp:
+                    cleanup_executor.submit(self.cleanup_request, record.queue_id)
+            except Exception as exc:
+                logger.error(f"{record} : Unable to download : {str(exc)}", exc_info=exc)
+            return record.key, fp
+
+        with ThreadPoolExecutor(max_workers=1) as cleanup_executor, \
+                ThreadPoolExecutor(max_workers=max_concurrent_downloads) as download_executor:
+            futures = [
+                download_executor.submit(download, record)
+                for record in records if record.status == "queued_and_ready"
+            ]
+            for future in as_completed(futures):
+                key, fp = future.result()
+                fp_by_key[key] = fp
+
+        return [(fp_by_key.get(key), param) for key, (_, param) in resource_by_key.items()]
+
     def download_result_by_id(self, queue_id: str,
                               destination_dir: str, destination_filename: str = None,
                               **kwargs):
@@ -367,16 +594,146 @@ class ClimateDataStoreApi(SimpleHttpFetch,
         else:
             return None
 
+    def db_get_resource_record(self, cds_resource_name: str, cds_resource_param: dict) -> Tuple[DownloadRecord, bool]:
+        """
+        Get the DownDb record of a CDS request
+
+        A record stored with a legacy key (cf. `get_legacy_resource_key`) is migrated on the fly
+
+        :param cds_resource_name:
+        :param cds_resource_param:
+        :return:
+        """
+        record_key = self.get_resource_key(cds_resource_name, cds_resource_param)
+        model = self.db_model
+        self.db_open()
+
+        if model.get_or_none(model.key == record_key) is None:
+            legacy_record = model.get_or_none(
+                model.key == self.get_legacy_resource_key(cds_resource_name, cds_resource_param))
+            if legacy_record is not None:
+                logger.info(f"Migrating legacy key of {legacy_record} to {record_key}")
+                legacy_record.key = record_key
+                legacy_record.save()
+
+        return self.db_get_record(key=record_key)
+
+    def db_migrate_legacy_keys(self) -> int:
+        """
+        Replace all legacy keys in download database by canonical keys
+
+        When several legacy records are equivalent, the most advanced one is kept (eg. downloaded rather than queued)
+
+        :return: number of migrated records
+        """
+        model = self.db_model
+        self.db_open()
+
+        nb_migrated = 0
+        with self.db.atomic():
+            for legacy_record in model.select().where(model.key.startswith("{'name': ")):
+                try:
+                    legacy_key = ast.literal_eval(legacy_record.key)
+                    record_key = self.get_resource_key(legacy_key['name'], legacy_key['param'])
+                except (ValueError, SyntaxError, KeyError, TypeError):
+                    logger.warning(f"Unable to parse legacy key {legacy_record.key}")
+                    continue
+
+                existing_record = model.get_or_none(model.key == record_key)
+                if existing_record is not None:
+                    if self.status_rank(existing_record.status) >= self.status_rank(legacy_record.status):
+                        logger.info(f"Removing {legacy_record}, equivalent to {existing_record}")
+                        legacy_record.delete_instance()
+                        nb_migrated += 1
+                        continue
+                    logger.info(f"Removing {existing_record}, equivalent to {legacy_record}")
+                    existing_record.delete_instance()
+
+                legacy_record.key = record_key
+                legacy_record.save()
+                nb_migrated += 1
+
+        return nb_migrated
+
     @staticmethod
-    def get_resource_key(cds_resource_name: str, cds_resource_param: dict) -> dict:
+    def status_rank(status: str) -> int:
+        """
+        How far a request went, for choosing between equivalent records
+
+        :param status:
+        :return:
+        """
+        return ["failed", "empty", "queued", "queued_and_ready", "downloading", "downloaded"].index(status)
+
+    @staticmethod
+    def get_resource_key(cds_resource_name: str, cds_resource_param: dict) -> str:
         """
         Generate a key from the CDS request
 
+        Equivalent requests give the same key, whatever the order of parameters or of their values,
+        eg. {'year': ['2021', '2020'], 'month': 2} and {'month': '02', 'year': ['2020', '2021']}
+
         :param cds_resource_name:
         :param cds_resource_param:
         :return:
         """
-        return {
+        canonical = json.dumps(
+            {'name': cds_resource_name, 'param': normalize_cds_value(cds_resource_param)},
+            sort_keys=True, separators=(",", ":")
+        )
+        digest = hashlib.sha256(canonical.encode()).hexdigest()[:32]
+        return f"cds:{cds_resource_name}:{digest}"
+
+    @staticmethod
+    def get_legacy_resource_key(cds_resource_name: str, cds_resource_param: dict) -> str:
+        """
+        Key used by previous versions, depending on parameters order
+
+        :param cds_resource_name:
+        :param cds_resource_param:
+        :return:
+        """
+        return str({
             'name': cds_resource_name,
             'param': cds_resource_param
-        }
+        })
+
+
+# Parameters whose values are a set of axis values, eg. ['00:00', '12:00'], where order and duplicates don't matter
+# Values of other parameters, eg. 'area' [N, W, S, E] or 'grid' [dlat, dlon], are positional
+CDS_UNORDERED_PARAMS = {
+    'year', 'month', 'day', 'time', 'hour', 'date', 'variable', 'param', 'product_type', 'pressure_level',
+    'model_level', 'levelist', 'leadtime_hour', 'leadtime_month', 'step', 'statistic',
+}
+
+
+def normalize_cds_value(value, unordered: bool = False):
+    """
+    Canonical form of a CDS request parameter :
+        - numbers and numeric strings as strings without leading zeros, eg. 2, '02' -> '2'
+        - lists of unordered parameters (cf. CDS_UNORDERED_PARAMS) sorted and without duplicates,
+          other lists being kept in order
+        - a single value list being the value itself
+        - dictionaries normalized recursively
+
+    :param value:
+    :param unordered: value is a set of values, whose order doesn't matter
+    :return:
+    """
+    if isinstance(value, dict):
+        return {str(k).strip(): normalize_cds_value(v, unordered=str(k).strip() in CDS_UNORDERED_PARAMS)
+                for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        values = [normalize_cds_value(v) for v in value]
+        if unordered or isinstance(value, set):
+            values = {json.dumps(v, sort_keys=True): v for v in values}
+            values = [values[k] for k in sorted(values)]
+        return values[0] if len(values) == 1 else values
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    value = str(value).strip()
+    if value.isdigit():
+        value = str(int(value))
+    return value
@@ -0,0 +1,209 @@
+"""
+Helpers for fetching many files through HTTP concurrently, using asyncio
+
+Requires aiohttp, eg. `pip install datafetch[async]`
+"""
+import asyncio
+import logging
+from pathlib import Path
+from typing import List, Union
+
+import pydantic
+
+from datafetch.utils import metrics
+from datafetch.utils.checksum import ChecksumMismatchError
+from .core import SimpleHttpFetch
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncHttpFetch(SimpleHttpFetch, pydantic.BaseModel):
+    """
+    Download many urls on a single event loop, with bounded concurrency
+
+    Temporary extension, download database and checksums (`checksum_algorithm`, `verify_checksum`)
+    are handled the same way as SimpleHttpFetch. Resuming, segmented and conditional downloads are not supported.
+
+    Example of usage :
+
+        >>> fetcher = AsyncHttpFetch(base_url="https://donneespubliques.meteofrance.fr/donnees_libres/Txt/Synop")
+        >>> fetcher.fetch_many(
+                destination_dir="/tmp",
+                fetch_list=[{'url_suffix': f"synop.20210208{hour:02d}.csv"} for hour in range(0, 24, 3)]
+            )
+        [PosixPath('/tmp/synop.2021020800.csv'), PosixPath('/tmp/synop.2021020803.csv'), ...]
+    """
+    # Maximum number of simultaneous downloads
+    max_concurrent_downloads: int = 20
+    # Maximum number of simultaneous connections to the same host
+    max_connections_per_host: int = 4
+    # Size of chunks read from network
+    chunk_size: int = 1024 * 1024
+    # Total timeout for a single download, in seconds
+    timeout: float = None
+
+    def fetch_many(self, destination_dir: str, fetch_list: List[dict]) -> List[Union[Path, None]]:
+        """
+        Download several urls concurrently
+
+        :param destination_dir:
+        :param fetch_list: list of SimpleHttpFetch.fetch() arguments, ie. url_suffix, destination_filename, record_key
+        :return: downloaded files, in the same order as `fetch_list`
+        """
+        return asyncio.run(self.async_fetch_many(destination_dir, fetch_list))
+
+    async def async_fetch_many(self, destination_dir: str, fetch_list: List[dict]) -> List[Union[Path, None]]:
+        """
+        Coroutine version of `fetch_many`, for running in an existing event loop
+
+        :param destination_dir:
+        :param fetch_list:
+        :return:
+        """
+        if aiohttp is None:
+            raise ImportError("aiohttp is required for AsyncHttpFetch, install it with `pip install aiohttp`")
+
+        semaphore = asyncio.Semaphore(self.max_concurrent_downloads)
+        connector = aiohttp.TCPConnector(
+            limit=self.max_concurrent_downloads,
+            limit_per_host=self.max_connections_per_host
+        )
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            return await asyncio.gather(*[
+                self.async_fetch(session, semaphore, destination_dir=destination_dir, **fetch_args)
+                for fetch_args in fetch_list
+            ])
+
+    async def async_fetch(self, session: "aiohttp.ClientSession", semaphore: asyncio.Semaphore,
+                          destination_dir: str,
+                          url_suffix: str = None, destination_filename: str = None,
+                          record_key: str = None) -> Union[Path, None]:
+        """
+        Download a single url, recording it in download database if enabled
+
+        Database is only accessed between two awaits, so that concurrent downloads don't interleave on it
+
+        :param session:
+        :param semaphore:
+        :param destination_dir:
+        :param url_suffix:
+        :param destination_filename:
+        :param record_key:
+        :return:
+        """
+        url = self.get_url(url_suffix)
+        if destination_filename is None:
+            destination_filename = url.split("/")[-1]
+        if record_key is None:
+            record_key = url
+
+        if not self.use_download_db:
+            return await self._async_fetch_with_temporary(session, semaphore, url,
+                                                          destination_dir, destination_filename)
+
+        with self:
+            logger.debug(f"{record_key} Checking if already downloaded ...")
+            downdb_record, _ = self.db_get_record(key=record_key)
+            if not downdb_record.need_download():
+                logger.info(f"{record_key} : Already downloaded {downdb_record.filepath} ...")
+                return Path(downdb_record.filepath)
+            logger.info(f"{downdb_record} : Need download")
+            downdb_record.set_start()
+
+        fp = None
+        error = None
+        remote_info = {}
+        try:
+            fp = await self._async_fetch_with_temporary(session, semaphore, url,
+                                                        destination_dir, destination_filename,
+                                                        remote_info=remote_info)
+        except Exception as exc:
+            error = exc
+            logger.error(str(exc), exc_info=exc)
+
+        with self:
+            if error is not None:
+                downdb_record.set_failed(error=str(error))
+            elif fp is None:
+                downdb_record.set_failed(error="Download failed")
+            else:
+                downdb_record.set_downloaded(fp)
+            downdb_record.set_remote_validators(**remote_info)
+            downdb_record.save()
+
+        return fp
+
+    async def _async_fetch_with_temporary(self, session: "aiohttp.ClientSession", semaphore: asyncio.Semaphore,
+                                          url: str, destination_dir: str,
+                                          destination_filename: str, remote_info: dict = None) -> Union[Path, None]:
+        """
+        Download to a temporary file, and rename it when done
+
+        :param session:
+        :param semaphore:
+        :param url:
+        :param destination_dir:
+        :param destination_filename:
+        :param remote_info: filled with remote file information, eg. ETag, checksum
+        :return:
+        """
+        fp, fp_tmp = self.get_destination_fp(destination_dir, destination_filename)
+        fp_downloaded = await self._async_fetch(session, semaphore, url, fp_tmp, remote_info=remote_info)
+        return self.finalize_temporary(fp_downloaded, fp)
+
+    async def _async_fetch(self, session: "aiohttp.ClientSession", semaphore: asyncio.Semaphore,
+                           url: str, destination_fp: Path, remote_info: dict = None) -> Union[Path, None]:
+        """
+        Actually download an url to a file
+
+        :param session:
+        :param semaphore:
+        :param url:
+        :param destination_fp:
+        :param remote_info: filled with remote file information, eg. ETag, checksum
+        :return:
+        """
+        if remote_info is None:
+            remote_info = {}
+        checksum = self.new_checksum(with_md5=self.http_etag_is_md5)
+        labels = self.get_metrics_labels(url=url)
+        async with semaphore:
+            logger.info(f"Downloading {url} to {destination_fp} ...")
+            with metrics.fetches_in_progress.track_in_progress(**labels), \
+                    metrics.fetch_duration_seconds.time(**labels):
+                try:
+                    async with session.get(url) as r:
+                        # Error pages must not be saved as downloaded files
+                        r.raise_for_status()
+                        remote_info.update(self.get_remote_info(r))
+                        with destination_fp.open('wb') as fd:
+                            async for chunk in r.content.iter_chunked(self.chunk_size):
+                                fd.write(chunk)
+                                if checksum is not None:
+                                    checksum.update(chunk)
+
+                        # Size and MD5 are only known for content as sent by the server, aiohttp decoding it
+                        if r.headers.get('Content-Encoding', 'identity').lower() == 'identity':
+                            self.finish_checksum(checksum, remote_info, etag=self.get_md5_etag(remote_info),
+                                                 size=r.content_length)
+                        else:
+                            self.finish_checksum(checksum, remote_info)
+                except ChecksumMismatchError as exc:
+                    logger.error(f"Corrupted download of {url} to {destination_fp}: {str(exc)}")
+                    destination_fp.unlink(missing_ok=True)
+                    metrics.fetches_total.inc(status="failed", **labels)
+                    return None
+                except Exception as exc:
+                    logger.error(f"Unable to download {url} to {destination_fp}: {str(exc)}")
+                    metrics.fetches_total.inc(status="failed", **labels)
+                    return None
+
+        metrics.fetches_total.inc(status="downloaded", **labels)
+        metrics.downloaded_bytes_total.inc(destination_fp.stat().st_size, **labels)
+        return destination_fp
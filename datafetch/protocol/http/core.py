@@ -2,19 +2,31 @@
 Helpers for fetching files through HTTP
 """
 import logging
+import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Union
+from typing import Dict, List, Tuple, Union
+from urllib.parse import urlsplit
 
 import pydantic
 import requests
 
 from datafetch.core import FetchWithTemporaryExtensionMixin, DownloadedFileRecorderMixin
+from datafetch.utils.checksum import Checksum, ChecksumMismatchError
+from .session import http_session_pool
+from .stream import KB, MB, write_response, write_response_at
 
 
 logger = logging.getLogger(__name__)
 
 
+class SegmentedDownloadError(Exception):
+    """
+    A segment couldn't be downloaded as expected, eg. server ignored the range
+    """
+
+
 class SimpleHttpFetch(DownloadedFileRecorderMixin,
                       FetchWithTemporaryExtensionMixin,
                       pydantic.BaseModel):
@@ -33,6 +45,26 @@ class SimpleHttpFetch(DownloadedFileRecorderMixin,
     # cf. https://2.python-requests.org/en/master/user/quickstart/#binary-response-content
     use_requests_raw: bool = False
 
+    # Buffer size when writing downloaded content, growing from min to max, cf. datafetch.protocol.http.stream
+    stream_min_chunk_size: int = 64 * KB
+    stream_max_chunk_size: int = 4 * MB
+    # Reserve disk space before downloading, when size is known
+    preallocate: bool = True
+
+    # Download large files as several byte ranges in parallel, when server supports it
+    segmented_download: bool = False
+    segments: int = 4
+    segment_min_size: int = 32 * MB
+
+    # Connections are kept alive and shared by host, cf. datafetch.protocol.http.session
+    http_pool_maxsize: int = 10
+    http_max_retries: int = 3
+    http_backoff_factor: float = 0.5
+    # Connect and read timeout, in seconds
+    http_timeout: float = 60
+    # Server ETags are MD5 of content, eg. S3-compatible storages, allowing to verify downloads against them
+    http_etag_is_md5: bool = False
+
     def fetch(self, destination_dir: str,
               url_suffix: str = None, destination_filename: str = None,
               record_key: str = None,
@@ -46,13 +78,7 @@ class SimpleHttpFetch(DownloadedFileRecorderMixin,
         :param record_key:
         :return:
         """
-        # Handle optional url suffix
-        if not self.base_url and url_suffix:
-            url = url_suffix
-        elif self.base_url and url_suffix:
-            url = f"{self.base_url}/{url_suffix}"
-        else:
-            url = self.base_url
+        url = self.get_url(url_suffix)
 
         # Default destination filename from url suffix
         if destination_filename is None:
@@ -67,33 +93,383 @@ class SimpleHttpFetch(DownloadedFileRecorderMixin,
             destination_dir=destination_dir, destination_filename=destination_filename,
             # For DownloadedFileRecorderMixin
             record_key=record_key,
+            # For FetchWithTemporaryExtensionMixin download cache
+            cache_key=record_key,
             # For _fetch function below
             url=url,
             **kwargs
         )
 
-    def _fetch(self, url: str, destination_fp: str) -> Union[Path, None]:
+    def get_url(self, url_suffix: str = None) -> str:
+        """
+        Full url from base url and an optional suffix
+
+        :param url_suffix:
+        :return:
+        """
+        if not self.base_url and url_suffix:
+            return url_suffix
+        elif self.base_url and url_suffix:
+            return f"{self.base_url}/{url_suffix}"
+        else:
+            return self.base_url
+
+    def get_metrics_labels(self, url: str = None, **kwargs) -> Dict[str, str]:
+        """
+        Labels of download metrics : scheme and host of the downloaded url
+
+        :param url:
+        :param kwargs: other arguments of `_fetch()`
+        :return:
+        """
+        parsed_url = urlsplit(url or "")
+        return {'protocol': parsed_url.scheme, 'host': parsed_url.hostname or "", 'bucket': ""}
+
+    def get_session(self, url: str) -> requests.Session:
+        """
+        Shared keep-alive session for the host of `url`
+
+        :param url:
+        :return:
+        """
+        return http_session_pool.get(
+            url,
+            pool_maxsize=self.http_pool_maxsize,
+            max_retries=self.http_max_retries,
+            backoff_factor=self.http_backoff_factor,
+        )
+
+    def _fetch(self, url: str, destination_fp: str,
+               resume_from: int = 0, validators: dict = None,
+               remote_info: dict = None,
+               local_fp: Path = None, local_validators: dict = None) -> Union[Path, None]:
         """
         Actually download an url to a file
 
         :param url:
         :param destination_fp:
+        :param resume_from: size of a previous partial download in `destination_fp`, to be continued
+        :param validators: ETag / Last-Modified of the previous attempt, for ensuring remote file didn't change
+        :param remote_info: filled with remote file information, eg. ETag
+        :param local_fp: an existing local copy, returned as is if remote file didn't change
+        :param local_validators: ETag / Last-Modified of `local_fp`
         :return:
         """
         destination_fp = Path(destination_fp)
-        logger.info(f"Downloading {url} to {destination_fp} ...")
+        if remote_info is None:
+            remote_info = {}
+        checksum = self.new_checksum(with_md5=self.http_etag_is_md5)
 
         try:
-            # cf. https://stackoverflow.com/a/39217788/554374
-            with requests.get(url, stream=True) as r:
-                with destination_fp.open('wb') as fd:
-                    if self.use_requests_raw:
-                        shutil.copyfileobj(r.raw, fd)
-                    else:
-                        for chunk in r.iter_content(chunk_size=128):
-                            fd.write(chunk)
+            r = None
+            if local_fp is not None and local_validators:
+                r = self._get_if_changed(url, local_validators)
+                if r is None:
+                    logger.info(f"{url} didn't change, keeping {local_fp}")
+                    remote_info['unchanged'] = True
+                    return Path(local_fp)
+            self._download(url, destination_fp, resume_from=resume_from, validators=validators,
+                           remote_info=remote_info, checksum=checksum, r=r)
+        except ChecksumMismatchError as exc:
+            logger.error(f"Corrupted download of {url} to {destination_fp}: {str(exc)}")
+            destination_fp.unlink(missing_ok=True)
+            return None
         except Exception as exc:
             logger.error(f"Unable to download {url} to {destination_fp}: {str(exc)}")
             return None
 
         return destination_fp
+
+    def _download(self, url: str, destination_fp: Path, resume_from: int = 0, validators: dict = None,
+                  remote_info: dict = None, checksum: Checksum = None, r: requests.Response = None):
+        """
+        Download an url to a file, in segments or as a single stream
+
+        :param url:
+        :param destination_fp:
+        :param resume_from: cf. `_fetch()`
+        :param validators: cf. `_fetch()`
+        :param remote_info:
+        :param checksum: updated with downloaded content, then verified
+        :param r: successful response to a conditional request, written as is unless downloading differently
+        :return:
+        """
+        if r is not None and (self.segmented_download or resume_from):
+            # Download as usual
+            r.close()
+            r = None
+        elif r is not None:
+            logger.info(f"{url} changed, downloading to {destination_fp} ...")
+
+        if r is None and self.segmented_download and not resume_from \
+                and self._fetch_segmented(url, destination_fp, remote_info, checksum):
+            return
+
+        mode = 'wb'
+        if r is None:
+            r, mode = self._get_stream(url, destination_fp, resume_from, validators, checksum)
+        if mode == 'ab':
+            remote_info['resumed_from'] = resume_from
+        self._write_stream(r, destination_fp, mode, remote_info, checksum)
+
+    def _get_stream(self, url: str, destination_fp: Path, resume_from: int = 0, validators: dict = None,
+                    checksum: Checksum = None) -> Tuple[requests.Response, str]:
+        """
+        Request the file as a single stream, continuing a previous partial download if possible
+
+        :param url:
+        :param destination_fp:
+        :param resume_from:
+        :param validators:
+        :param checksum: updated with the content already downloaded, if resumed
+        :return: a successful streamed response, and the mode to open `destination_fp` with
+        :raise requests.HTTPError: for error responses, eg. 404, or 5xx still failing after retries
+        """
+        if resume_from:
+            r = self._get_resumed(url, resume_from, validators)
+            if r is not None:
+                if checksum is not None:
+                    checksum.update_from_file(destination_fp, size=resume_from)
+                return r, 'ab'
+
+        logger.info(f"Downloading {url} to {destination_fp} ...")
+        r = self.get_session(url).get(url, stream=True, timeout=self.http_timeout)
+        self.raise_for_status(r)
+        return r, 'wb'
+
+    def _write_stream(self, r: requests.Response, destination_fp: Path, mode: str, remote_info: dict,
+                      checksum: Checksum = None):
+        """
+        Write a streamed response into a file, then verify it
+
+        :param r:
+        :param destination_fp:
+        :param mode: 'ab' for appending to a partial download
+        :param remote_info:
+        :param checksum:
+        :return:
+        """
+        # cf. https://stackoverflow.com/a/39217788/554374
+        with r:
+            remote_info.update(self.get_remote_info(r))
+            with destination_fp.open(mode) as fd:
+                if self.use_requests_raw and checksum is None:
+                    shutil.copyfileobj(r.raw, fd)
+                elif self.use_requests_raw:
+                    for chunk in iter(lambda: r.raw.read(self.stream_max_chunk_size), b""):
+                        fd.write(chunk)
+                        checksum.update(chunk)
+                else:
+                    write_response(r, fd,
+                                   min_chunk_size=self.stream_min_chunk_size,
+                                   max_chunk_size=self.stream_max_chunk_size,
+                                   preallocate=self.preallocate,
+                                   checksum=checksum)
+
+            # Size and MD5 are only known for content as sent by the server
+            decoded = not self.use_requests_raw \
+                and r.headers.get('Content-Encoding', 'identity').lower() != 'identity'
+            if not decoded:
+                self.finish_checksum(checksum, remote_info, etag=self.get_md5_etag(remote_info),
+                                     size=self.get_content_size(r))
+            else:
+                self.finish_checksum(checksum, remote_info)
+
+    def _fetch_segmented(self, url: str, destination_fp: Path, remote_info: dict, checksum: Checksum = None) -> bool:
+        """
+        Download an url as several byte ranges in parallel, written into a preallocated file
+
+        :param url:
+        :param destination_fp:
+        :param remote_info:
+        :param checksum: updated with downloaded content, then verified
+        :return: False if the server doesn't support ranges, or the file is too small to be worth it
+        """
+        session = self.get_session(url)
+        h = session.head(url, timeout=self.http_timeout, allow_redirects=True,
+                         headers={'Accept-Encoding': 'identity'})
+        segments = self.get_segments(h)
+        if not segments:
+            return False
+
+        remote_info.update(self.get_remote_info(h))
+        # Ensure every segment comes from the same version of the file
+        validator = h.headers.get('ETag')
+        if not validator or validator.startswith("W/"):
+            validator = h.headers.get('Last-Modified')
+        logger.info(f"Downloading {url} to {destination_fp} in {len(segments)} segments ...")
+
+        fd = os.open(str(destination_fp), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            size = segments[-1][1] + 1
+            if self.preallocate and hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+            with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                futures = [executor.submit(self._fetch_segment, session, h.url, fd, start, end, validator)
+                           for start, end in segments]
+                for future in futures:
+                    future.result()
+        except SegmentedDownloadError as exc:
+            logger.warning(f"{url} : {str(exc)}, falling back to a single stream download")
+            return False
+        finally:
+            os.close(fd)
+
+        # Segments are written out of order, content can only be hashed afterwards
+        if checksum is not None:
+            checksum.update_from_file(destination_fp)
+        self.finish_checksum(checksum, remote_info, etag=self.get_md5_etag(remote_info))
+        return True
+
+    def get_segments(self, h: requests.Response) -> List[Tuple[int, int]]:
+        """
+        Inclusive byte ranges to download in parallel, from the response to a HEAD request
+
+        :param h:
+        :return: empty if the server doesn't support ranges, or the file is too small to be worth it
+        """
+        size = int(h.headers.get('Content-Length') or 0)
+        if h.status_code != 200 or h.headers.get('Accept-Ranges', '').lower() != 'bytes' \
+                or h.headers.get('Content-Encoding', 'identity') != 'identity':
+            logger.info(f"{h.url} : Byte ranges not supported, not using segmented download")
+            return []
+
+        nb_segments = min(self.segments, size // self.segment_min_size)
+        if nb_segments < 2:
+            logger.debug(f"{h.url} : File too small ({size} bytes) for segmented download")
+            return []
+
+        segment_size = -(-size // nb_segments)
+        return [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+
+    def _fetch_segment(self, session: requests.Session, url: str, fd: int, start: int, end: int,
+                       validator: str = None):
+        """
+        Download a byte range into its place in a file
+
+        :param session:
+        :param url:
+        :param fd: file descriptor, eg. from os.open()
+        :param start:
+        :param end: inclusive
+        :param validator: ETag or Last-Modified of the file, ensuring every segment comes from the same version
+        :return:
+        :raise SegmentedDownloadError:
+        """
+        headers = {'Range': f"bytes={start}-{end}", 'Accept-Encoding': 'identity'}
+        if validator:
+            headers['If-Range'] = validator
+        with session.get(url, stream=True, timeout=self.http_timeout, headers=headers) as r:
+            if r.status_code != 206 or not r.headers.get('Content-Range', '').startswith(f"bytes {start}-{end}/"):
+                raise SegmentedDownloadError(f"Unexpected response for segment {start}-{end} : {r.status_code}")
+            written = write_response_at(r, fd, start, chunk_size=self.stream_max_chunk_size)
+            if written != end - start + 1:
+                raise SegmentedDownloadError(f"Incomplete segment {start}-{end} : {written} bytes")
+
+    def _get_if_changed(self, url: str, local_validators: dict) -> Union[requests.Response, None]:
+        """
+        Conditional request, cf. https://httpwg.org/specs/rfc7232.html
+
+        :param url:
+        :param local_validators: ETag / Last-Modified of a local copy
+        :return: a streamed response if remote file changed, None if it didn't
+        :raise requests.HTTPError: for error responses, eg. 404 if remote file was removed
+        """
+        headers = {}
+        if local_validators.get('etag'):
+            headers['If-None-Match'] = local_validators['etag']
+        if local_validators.get('last_modified'):
+            headers['If-Modified-Since'] = local_validators['last_modified']
+
+        r = self.get_session(url).get(url, stream=True, timeout=self.http_timeout, headers=headers)
+        if r.status_code == 304:
+            r.close()
+            return None
+        self.raise_for_status(r)
+        return r
+
+    def _get_resumed(self, url: str, resume_from: int, validators: dict = None) -> Union[requests.Response, None]:
+        """
+        Request the remaining part of a file, if it didn't change since previous attempt
+
+        :param url:
+        :param resume_from:
+        :param validators:
+        :return: a streamed response with the remaining bytes, None if download can't be resumed
+        """
+        validators = validators or {}
+        # Weak ETags can't be used for ranges, cf. https://httpwg.org/specs/rfc7233.html#header.if-range
+        validator = validators.get('etag')
+        if not validator or validator.startswith("W/"):
+            validator = validators.get('last_modified')
+        if not validator:
+            logger.info(f"{url} : No validator from previous attempt, restarting download from scratch ...")
+            return None
+
+        headers = {
+            'Range': f"bytes={resume_from}-",
+            'If-Range': validator,
+            # Ranges are meant on the raw file, not on some encoded content
+            'Accept-Encoding': 'identity',
+        }
+        r = self.get_session(url).get(url, stream=True, timeout=self.http_timeout, headers=headers)
+        if r.status_code == 206 and r.headers.get('Content-Range', '').startswith(f"bytes {resume_from}-"):
+            logger.info(f"Resuming download of {url} from byte {resume_from} ...")
+            return r
+
+        r.close()
+        logger.info(f"{url} : Unable to resume download (status {r.status_code}), restarting from scratch ...")
+        return None
+
+    @staticmethod
+    def raise_for_status(response: requests.Response):
+        """
+        Reject error responses, eg. 404, or 5xx still failing after retries, so that they are never written
+
+        :param response:
+        :return:
+        :raise requests.HTTPError:
+        """
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+
+    def get_md5_etag(self, remote_info: dict) -> Union[str, None]:
+        """
+        ETag to verify download against, if server ETags are MD5
+
+        :param remote_info:
+        :return:
+        """
+        return remote_info.get('etag') if self.http_etag_is_md5 else None
+
+    @staticmethod
+    def get_content_size(response: requests.Response) -> Union[int, None]:
+        """
+        Size of the whole remote file, from Content-Range or Content-Length
+
+        :param response:
+        :return: None if unknown
+        """
+        content_range = response.headers.get('Content-Range', '')
+        if response.status_code == 206 and "/" in content_range and not content_range.endswith("/*"):
+            return int(content_range.rsplit("/", 1)[1])
+        content_length = response.headers.get('Content-Length')
+        return int(content_length) if content_length else None
+
+    @staticmethod
+    def get_remote_info(response: requests.Response) -> dict:
+        """
+        Remote file information from response headers
+
+        :param response:
+        :return:
+        """
+        return {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
@@ -0,0 +1,92 @@
+"""
+Pool of keep-alive HTTP sessions, shared across fetchers and threads
+
+Reusing a session per host allows to reuse warm TCP / TLS connections between downloads
+"""
+import logging
+import threading
+from typing import Dict, Tuple
+from urllib.parse import urlsplit
+
+import requests
+import requests.adapters
+from urllib3.util.retry import Retry
+
+from datafetch.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CountedRetry(Retry):
+    """
+    Retry policy counting retries in metrics
+    """
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        # Raises when retries are exhausted, which isn't counted as a retry
+        retry = super().increment(method=method, url=url, response=response, error=error,
+                                  _pool=_pool, _stacktrace=_stacktrace)
+        if _pool is not None:
+            metrics.retries_total.inc(protocol=_pool.scheme, host=_pool.host, bucket="")
+        return retry
+
+
+class HttpSessionPool:
+    """
+    Thread-safe registry of requests.Session, one per (scheme, host) and connection settings
+
+    Example of usage :
+
+        >>> session = http_session_pool.get("https://donneespubliques.meteofrance.fr/plop", pool_maxsize=4)
+        >>> session.get("https://donneespubliques.meteofrance.fr/plop")
+    """
+    def __init__(self):
+        self._sessions: Dict[Tuple, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str, pool_maxsize: int = 10,
+            max_retries: int = 3, backoff_factor: float = 0.5) -> requests.Session:
+        """
+        Get a session for the host of `url`, creating it if needed
+
+        :param url:
+        :param pool_maxsize: maximum number of connections kept alive for this host
+        :param max_retries: number of retries on connection errors and 5xx responses
+        :param backoff_factor: sleep between retries, cf. urllib3 Retry
+        :return:
+        """
+        parsed_url = urlsplit(url)
+        key = (parsed_url.scheme, parsed_url.netloc, pool_maxsize, max_retries, backoff_factor)
+
+        with self._lock:
+            if key not in self._sessions:
+                logger.debug(f"Creating HTTP session for {parsed_url.scheme}://{parsed_url.netloc} ...")
+                retry = CountedRetry(
+                    total=max_retries,
+                    backoff_factor=backoff_factor,
+                    status_forcelist=(500, 502, 503, 504),
+                    raise_on_status=False,
+                )
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=pool_maxsize,
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.mount(f"{parsed_url.scheme}://{parsed_url.netloc}", adapter)
+                self._sessions[key] = session
+            return self._sessions[key]
+
+    def close(self):
+        """
+        Close all sessions and their connections
+
+        :return:
+        """
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+# Process-wide pool
+http_session_pool = HttpSessionPool()
@@ -0,0 +1,112 @@
+"""
+Fast writing of a streamed HTTP response into a file
+"""
+import logging
+import os
+from typing import BinaryIO
+
+import requests
+
+from datafetch.utils.checksum import Checksum
+
+logger = logging.getLogger(__name__)
+
+KB = 1024
+MB = 1024 * KB
+
+
+def write_response(response: requests.Response, fd: BinaryIO,
+                   min_chunk_size: int = 64 * KB, max_chunk_size: int = 4 * MB,
+                   preallocate: bool = True, checksum: Checksum = None) -> int:
+    """
+    Write the body of a streamed response (ie. `stream=True`) into a file
+
+    When the body is not encoded, bytes are read straight into a reusable buffer,
+    which grows from `min_chunk_size` to `max_chunk_size` as long as reads fill it up.
+    Otherwise (eg. gzip, deflate), content is decoded on the fly by urllib3.
+
+    :param response:
+    :param fd: file opened in binary write mode
+    :param min_chunk_size:
+    :param max_chunk_size:
+    :param preallocate: reserve disk space when Content-Length is known
+    :param checksum: updated with written content
+    :return: number of bytes written
+    """
+    content_encoding = response.headers.get('Content-Encoding', 'identity').lower()
+    if content_encoding != 'identity':
+        return write_decoded_response(response, fd, chunk_size=max_chunk_size, checksum=checksum)
+
+    content_length = response.headers.get('Content-Length')
+    # In append mode, writes would go after the preallocated space
+    appending = 'a' in getattr(fd, 'mode', '')
+    if preallocate and content_length and not appending and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd.fileno(), fd.tell(), int(content_length))
+        except OSError as exc:
+            logger.debug(f"Unable to preallocate {content_length} bytes : {exc}")
+
+    start = fd.tell()
+    buffer = memoryview(bytearray(max_chunk_size))
+    chunk_size = min(min_chunk_size, max_chunk_size)
+    written = 0
+    while True:
+        n = response.raw.readinto(buffer[:chunk_size])
+        if not n:
+            break
+        fd.write(buffer[:n])
+        if checksum is not None:
+            checksum.update(buffer[:n])
+        written += n
+        if n == chunk_size and chunk_size < max_chunk_size:
+            chunk_size = min(chunk_size * 2, max_chunk_size)
+
+    # Preallocation may have extended the file beyond what was actually received
+    fd.truncate(start + written)
+    return written
+
+
+def write_decoded_response(response: requests.Response, fd: BinaryIO, chunk_size: int = 4 * MB,
+                           checksum: Checksum = None) -> int:
+    """
+    Write the body of a streamed, encoded response (eg. gzip, deflate) into a file, decoded on the fly by urllib3
+
+    :param response:
+    :param fd: file opened in binary write mode
+    :param chunk_size:
+    :param checksum: updated with written content
+    :return: number of bytes written
+    """
+    written = 0
+    for chunk in response.raw.stream(chunk_size, decode_content=True):
+        written += fd.write(chunk)
+        if checksum is not None:
+            checksum.update(chunk)
+    return written
+
+
+def write_response_at(response: requests.Response, fd: int, position: int, chunk_size: int = 1 * MB) -> int:
+    """
+    Write the body of a streamed, unencoded response into a file descriptor, starting at `position`
+
+    Positional writes allow several responses (eg. byte ranges) to be written concurrently into the same file
+
+    :param response:
+    :param fd: file descriptor, eg. from os.open()
+    :param position:
+    :param chunk_size:
+    :return: number of bytes written
+    """
+    buffer = memoryview(bytearray(chunk_size))
+    written = 0
+    while True:
+        n = response.raw.readinto(buffer)
+        if not n:
+            break
+        # pwrite may write only part of the chunk, eg. when interrupted by a signal
+        view = buffer[:n]
+        while view:
+            n = os.pwrite(fd, view, position + written)
+            view = view[n:]
+            written += n
+    return written
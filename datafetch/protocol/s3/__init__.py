@@ -2,3 +2,6 @@
 Datafetcher related to AWS S3
 """
 from .core import S3ApiBucket
+from .transfer import set_transfer_concurrency_budget
+from .listing import listing_cache
+from .session import s3_client_cache
@@ -2,16 +2,25 @@
 Helpers for fetching data from AWS S3
 """
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Union
+from typing import Dict, Iterable, List, Tuple, Union
+from urllib.parse import urlsplit
 
-import boto3
-import boto3.resources
-import botocore
+import boto3.resources.base
+import boto3.s3.transfer
 import botocore.client
+import botocore.exceptions
 import pydantic
 
 from datafetch.core import FetchWithTemporaryExtensionMixin, DownloadedFileRecorderMixin
+from datafetch.utils.checksum import Checksum, ChecksumMismatchError
+from datafetch.utils.grib import ByteRange
+from .listing import listing_cache
+from .session import s3_client_cache
+from .transfer import MB, KnownObjectSubscriber, transfer_budget, make_transfer_config, \
+    get_shared_transfer_manager
 
 logger = logging.getLogger(__name__)
 
@@ -25,31 +34,92 @@ class S3ApiBucket(FetchWithTemporaryExtensionMixin,
     - download objects
     """
     bucket_name: str = None
-    _s3: object = None
+
+    # Client configuration, clients being shared by all instances with the same configuration
+    # cf. datafetch.protocol.s3.session
+    region_name: str = None
+    endpoint_url: str = None
+    # Anonymous requests, eg. for public datasets
+    unsigned: bool = True
+    # Maximum number of connections kept alive, at least `transfer_max_concurrency` by default
+    max_pool_connections: int = None
+
+    # Transfer tuning, forwarded to boto3 TransferConfig
+    # cf. https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/s3.html
+    transfer_multipart_threshold: int = 8 * MB
+    transfer_multipart_chunksize: int = 8 * MB
+    transfer_max_concurrency: int = 10
+    transfer_max_io_queue: int = 100
+    transfer_use_threads: bool = True
+    # Submit downloads to a process-wide thread pool, sized by the concurrency budget
+    # cf. datafetch.protocol.s3.set_transfer_concurrency_budget()
+    transfer_use_shared_pool: bool = False
+    # Managed transfers and byte ranges write parts concurrently, out of order : their checksum can only be
+    # computed by reading the whole file again once downloaded. This doubles disk I/O, so it is opt-in,
+    # their size and ETag being always verified. Single stream downloads (`resume_partial`) are always hashed on the fly
+    checksum_after_transfer: bool = False
+
+    # Answer availability checks from a cached listing of the whole prefix
+    # cf. datafetch.protocol.s3.listing
+    use_listing_cache: bool = True
+    # Maximum age of a cached listing, in seconds
+    listing_cache_ttl: float = 60
+    # Directory for sharing listings between processes, None for keeping them in memory only
+    listing_cache_dir: str = None
 
     class Config:
         underscore_attrs_are_private = True
 
+    @property
+    def client_config(self) -> dict:
+        """
+        Arguments of s3_client_cache, from current settings
+
+        :return:
+        """
+        return {
+            'region_name': self.region_name,
+            'unsigned': self.unsigned,
+            'endpoint_url': self.endpoint_url,
+            'max_pool_connections': self.max_pool_connections or max(10, self.transfer_max_concurrency),
+        }
+
+    @property
+    def client(self) -> botocore.client.BaseClient:
+        """
+        boto3 client, shared in the process
+
+        :return:
+        """
+        return s3_client_cache.get_client(**self.client_config)
+
     @property
     def s3(self) -> boto3.resources.base.ServiceResource:
         """
-        boto3 resource object
+        boto3 resource object, for the current thread
 
         :return:
         """
-        if self._s3 is None:
-            session = boto3.session.Session()
-            self._s3 = session.resource('s3', config=botocore.client.Config(signature_version=botocore.UNSIGNED))
-        return self._s3
+        return s3_client_cache.get_resource(**self.client_config)
 
     @property
     def bucket(self) -> object:
         """
-        Bucket object
+        Bucket object, for the current thread
 
         :return:
         """
-        return self.s3.Bucket(name=self.bucket_name)
+        return s3_client_cache.get_bucket(self.bucket_name, **self.client_config)
+
+    def get_metrics_labels(self, **kwargs) -> Dict[str, str]:
+        """
+        Labels of download metrics : host of the endpoint, empty for AWS, and bucket
+
+        :param kwargs: arguments of `_fetch()`
+        :return:
+        """
+        host = urlsplit(self.endpoint_url).hostname if self.endpoint_url else ""
+        return {'protocol': "s3", 'host': host or "", 'bucket': self.bucket_name}
 
     def filter(self, **kwargs: dict):
         """
@@ -66,6 +136,67 @@ class S3ApiBucket(FetchWithTemporaryExtensionMixin,
         logger.debug(f"{self.bucket_name} : filtering {kwargs} ...")
         return self.bucket.objects.filter(**kwargs)
 
+    def list_keys(self, prefix: str, refresh: bool = False) -> Dict[str, int]:
+        """
+        All object keys starting with `prefix`, with their size
+
+        Listing is cached for `listing_cache_ttl` seconds, and shared by all instances of the process
+
+        :param prefix:
+        :param refresh: list prefix again, even if a recent listing is cached
+        :return:
+        """
+        def list_prefix() -> Dict[str, int]:
+            paginator = self.client.get_paginator('list_objects_v2')
+            return {
+                obj['Key']: obj['Size']
+                for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix)
+                for obj in page.get('Contents', [])
+            }
+
+        if not self.use_listing_cache:
+            return list_prefix()
+        return listing_cache.get(self.bucket_name, prefix, list_prefix,
+                                 ttl=self.listing_cache_ttl, cache_dir=self.listing_cache_dir, refresh=refresh)
+
+    def stat(self, object_key: str) -> Union[dict, None]:
+        """
+        Metadata of an object, from a HEAD request
+
+        Contrary to filtering by prefix, only the exact key is checked, eg. not its `.idx` sibling
+
+        :param object_key:
+        :return: size, etag and last_modified of the object, None if it doesn't exist
+        """
+        try:
+            r = self.client.head_object(Bucket=self.bucket_name, Key=object_key)
+        except botocore.exceptions.ClientError as exc:
+            if exc.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return {'size': r['ContentLength'], 'etag': r['ETag'], 'last_modified': r['LastModified']}
+
+    def exists(self, object_key: str) -> bool:
+        """
+        Check if an object exists, from a HEAD request
+
+        :param object_key:
+        :return:
+        """
+        return self.stat(object_key) is not None
+
+    def stat_many(self, object_keys: Iterable[str], max_workers: int = 16) -> Dict[str, Union[dict, None]]:
+        """
+        Metadata of several objects, with HEAD requests sent in parallel
+
+        :param object_keys:
+        :param max_workers:
+        :return: object key -> metadata, cf. `stat()`
+        """
+        object_keys = list(object_keys)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(object_keys)))) as executor:
+            return dict(zip(object_keys, executor.map(self.stat, object_keys)))
+
     def fetch(self, object_key: str, destination_dir: str,
               destination_filename: str = None,
               record_key: str = None,
@@ -88,23 +219,312 @@ class S3ApiBucket(FetchWithTemporaryExtensionMixin,
             # For FetchWithTemporaryExtensionMixin
             destination_dir=destination_dir, destination_filename=destination_filename,
             # For DownloadFileRecorderMixin
-            record_key=object_key,
+            record_key=record_key or object_key,
+            # Objects of different buckets may have the same key
+            cache_key=f"s3://{self.bucket_name}/{record_key or object_key}",
             **kwargs)
 
     def _fetch(self, object_key: str,
-               destination_fp: str = None, **kwargs) -> Union[Path, None]:
+               destination_fp: str = None,
+               byte_ranges: List[ByteRange] = None,
+               resume_from: int = 0, validators: dict = None, remote_info: dict = None,
+               local_fp: Path = None, local_validators: dict = None,
+               **kwargs) -> Union[Path, None]:
         """
         Actually download a S3 bucket resource
 
         :param object_key:
         :param destination_fp:
+        :param byte_ranges: only download these parts of the object, concatenated in the same order
+        :param resume_from: size of a previous partial download in `destination_fp`, to be continued
+        :param validators: ETag of the previous attempt, for ensuring remote object didn't change
+        :param remote_info: filled with remote object information, eg. ETag
+        :param local_fp: an existing local copy, returned as is if remote object didn't change
+        :param local_validators: ETag and size of the object `local_fp` was downloaded from
         :param kwargs:
         :return:
         """
+        if remote_info is None:
+            remote_info = {}
+        streamed = self.resume_partial and not byte_ranges
+        checksum = None
+        if streamed or self.checksum_after_transfer:
+            checksum = self.new_checksum(with_md5=not byte_ranges)
+
         try:
-            self.bucket.download_file(object_key, str(destination_fp))
+            info = self._stat_before_fetch(object_key, streamed=streamed, byte_ranges=byte_ranges,
+                                           local_validators=local_validators, remote_info=remote_info)
+
+            if local_fp is not None and local_validators and self.is_unchanged(info, local_validators):
+                logger.info(f"{self.bucket_name}/{object_key} didn't change, keeping {local_fp}")
+                remote_info['unchanged'] = True
+                return Path(local_fp)
+
+            if byte_ranges:
+                self._fetch_byte_ranges(object_key, destination_fp, byte_ranges,
+                                        etag=info['etag'] if info else None)
+                # Parts are written out of order, content can only be hashed afterwards
+                if checksum is not None:
+                    checksum.update_from_file(destination_fp)
+                self.finish_checksum(checksum, remote_info)
+            elif self.resume_partial:
+                # A single stream, written in order, is needed for being able to resume it later
+                etag = (validators or {}).get('etag')
+                self._fetch_stream(object_key, destination_fp, resume_from=resume_from, etag=etag,
+                                   remote_info=remote_info, checksum=checksum)
+            else:
+                self._fetch_managed(object_key, destination_fp, info, checksum=checksum)
+                self.finish_checksum(checksum, remote_info, etag=info['etag'], size=info['size'])
+        except ChecksumMismatchError as exc:
+            logger.error(f"Corrupted download of {self.bucket_name}/{object_key} to {destination_fp}: {str(exc)}")
+            Path(destination_fp).unlink(missing_ok=True)
+            return None
         except Exception as exc:
             logger.error(f"Unable to fetch {self.bucket_name}/{object_key} to {destination_fp}: {str(exc)}")
             return None
 
         return Path(destination_fp)
+
+    def _stat_before_fetch(self, object_key: str, streamed: bool, byte_ranges: List[ByteRange] = None,
+                           local_validators: dict = None, remote_info: dict = None) -> Union[dict, None]:
+        """
+        Metadata of an object, when needed before downloading it : for checking if it changed, verifying
+        a managed transfer, or keeping track of it. A single stream download gets it from its GET request.
+
+        :param object_key:
+        :param streamed: cf. `_fetch_stream()`
+        :param byte_ranges:
+        :param local_validators:
+        :param remote_info: updated with object metadata
+        :return: cf. `stat()`, None if not needed
+        :raise FileNotFoundError:
+        """
+        if not local_validators and (streamed or (byte_ranges and not self.conditional_fetch)):
+            return None
+        info = self.stat(object_key)
+        if info is None:
+            raise FileNotFoundError(f"No such object {self.bucket_name}/{object_key}")
+        if remote_info is not None:
+            remote_info.update(info)
+        return info
+
+    def _fetch_managed(self, object_key: str, destination_fp: str, info: dict, checksum: Checksum = None):
+        """
+        Download an object with a boto3 managed transfer, ie. in parts written concurrently
+
+        Size of the downloaded file is always verified against object metadata, as well as its ETag :
+        the object must not change during download. Content is hashed afterwards only if `checksum` is given.
+
+        :param object_key:
+        :param destination_fp:
+        :param info: object metadata, cf. `stat()`
+        :param checksum: updated from downloaded file
+        :return:
+        :raise ChecksumMismatchError:
+        """
+        subscriber = KnownObjectSubscriber(size=info['size'], etag=info['etag'])
+        if self.transfer_use_shared_pool:
+            manager = get_shared_transfer_manager(self.transfer_config(), **self.client_config)
+            manager.download(self.bucket_name, object_key, str(destination_fp), subscribers=[subscriber]).result()
+        else:
+            # Without threads, a transfer only uses the calling thread
+            concurrency = self.transfer_max_concurrency if self.transfer_use_threads else 1
+            with transfer_budget.acquire(concurrency) as max_concurrency:
+                with boto3.s3.transfer.create_transfer_manager(self.client,
+                                                               self.transfer_config(max_concurrency)) as manager:
+                    manager.download(self.bucket_name, object_key, str(destination_fp),
+                                     subscribers=[subscriber]).result()
+
+        size = os.path.getsize(destination_fp)
+        if size != info['size']:
+            raise ChecksumMismatchError(f"Expected {info['size']} bytes, got {size}")
+        if not subscriber.etag_provided:
+            # Parts may come from different versions of the object, unless it didn't change meanwhile
+            current = self.stat(object_key)
+            if current is None or current['etag'] != info['etag']:
+                raise ChecksumMismatchError(f"Object changed during download, ETag {info['etag']} is now "
+                                            f"{current['etag'] if current else None}")
+        # Managed transfers write parts concurrently, content can only be hashed afterwards
+        if checksum is not None:
+            checksum.update_from_file(destination_fp)
+
+    @staticmethod
+    def is_unchanged(info: dict, local_validators: dict) -> bool:
+        """
+        Check if an object is the one a local copy was downloaded from
+
+        :param info: current object metadata, cf. stat()
+        :param local_validators: metadata when local copy was downloaded
+        :return:
+        """
+        if not local_validators.get('etag') or info['etag'] != local_validators['etag']:
+            return False
+        return local_validators.get('size') is None or int(local_validators['size']) == info['size']
+
+    def transfer_config(self, max_concurrency: int = None) -> boto3.s3.transfer.TransferConfig:
+        """
+        boto3 transfer configuration, from current settings
+
+        :param max_concurrency: override `transfer_max_concurrency`, eg. according to concurrency budget
+        :return:
+        """
+        return make_transfer_config(
+            multipart_threshold=self.transfer_multipart_threshold,
+            multipart_chunksize=self.transfer_multipart_chunksize,
+            max_concurrency=max_concurrency or self.transfer_max_concurrency,
+            max_io_queue=self.transfer_max_io_queue,
+            use_threads=self.transfer_use_threads,
+        )
+
+    def get_object_bytes(self, object_key: str, byte_range: ByteRange = None) -> bytes:
+        """
+        Read an object, or part of it, into memory
+
+        :param object_key:
+        :param byte_range: inclusive (start, end), end being None for "until end of object"
+        :return:
+        """
+        args = {'Bucket': self.bucket_name, 'Key': object_key}
+        if byte_range is not None:
+            args['Range'] = self.get_range_header(byte_range)
+        r = self.client.get_object(**args)
+        return r['Body'].read()
+
+    def _fetch_stream(self, object_key: str, destination_fp: str,
+                      resume_from: int = 0, etag: str = None, remote_info: dict = None,
+                      checksum: Checksum = None):
+        """
+        Download an object in a single stream, possibly continuing a previous partial download
+
+        :param object_key:
+        :param destination_fp:
+        :param resume_from:
+        :param etag: ETag of the object when partial download started
+        :param remote_info:
+        :param checksum: updated while writing, then verified against object metadata
+        :return:
+        """
+        if remote_info is None:
+            remote_info = {}
+        r, offset = self._get_object_stream(object_key, resume_from=resume_from, etag=etag)
+
+        size = None
+        if r.get('ContentLength') is not None:
+            size = r['ContentLength'] + offset
+            remote_info['size'] = size
+        remote_info.update({'etag': r['ETag'], 'last_modified': r['LastModified']})
+
+        mode = 'wb'
+        if offset:
+            logger.info(f"Resuming download of {self.bucket_name}/{object_key} from byte {offset} ...")
+            remote_info['resumed_from'] = offset
+            if checksum is not None:
+                checksum.update_from_file(destination_fp, size=offset)
+            mode = 'ab'
+        with open(destination_fp, mode) as fd:
+            for chunk in r['Body'].iter_chunks(self.transfer_multipart_chunksize):
+                fd.write(chunk)
+                if checksum is not None:
+                    checksum.update(chunk)
+
+        self.finish_checksum(checksum, remote_info, etag=r['ETag'], size=size)
+
+    def _get_object_stream(self, object_key: str, resume_from: int = 0, etag: str = None) -> Tuple[dict, int]:
+        """
+        GET request of an object, from byte `resume_from` if the object didn't change since `etag`
+
+        :param object_key:
+        :param resume_from:
+        :param etag: ETag of the object when partial download started
+        :return: response, and offset its body starts at : `resume_from`, or 0 when restarting from scratch
+        """
+        args = {'Bucket': self.bucket_name, 'Key': object_key}
+        if resume_from and etag:
+            try:
+                return self.client.get_object(Range=f"bytes={resume_from}-", IfMatch=etag, **args), resume_from
+            except botocore.exceptions.ClientError as exc:
+                if exc.response['Error']['Code'] not in ('PreconditionFailed', 'InvalidRange', '412', '416'):
+                    raise
+                logger.info(f"{self.bucket_name}/{object_key} : Unable to resume download "
+                            f"({exc.response['Error']['Code']}), restarting from scratch ...")
+        elif resume_from:
+            logger.info(f"{self.bucket_name}/{object_key} : No ETag from previous attempt, "
+                        f"restarting download from scratch ...")
+        return self.client.get_object(**args), 0
+
+    def _fetch_byte_ranges(self, object_key: str, destination_fp: str, byte_ranges: List[ByteRange],
+                           etag: str = None):
+        """
+        Download several parts of an object in parallel, and concatenate them into `destination_fp`
+
+        Size of each part is verified, and all parts must come from the same version of the object
+
+        :param object_key:
+        :param destination_fp:
+        :param byte_ranges:
+        :param etag: expected ETag of the object, None if unknown
+        :return:
+        :raise ChecksumMismatchError:
+        """
+        client = self.client
+        if any(end is None for _, end in byte_ranges):
+            info = self.stat(object_key)
+            etag = etag or info['etag']
+            byte_ranges = [(start, info['size'] - 1 if end is None else end) for start, end in byte_ranges]
+
+        # Position of each part in the destination file
+        positions = []
+        total_size = 0
+        for start, end in byte_ranges:
+            positions.append(total_size)
+            total_size += end - start + 1
+
+        logger.info(f"{self.bucket_name}/{object_key} : downloading {len(byte_ranges)} byte ranges, "
+                    f"{total_size} bytes in total ...")
+
+        extra_args = {'IfMatch': etag} if etag else {}
+
+        def fetch_part(byte_range: ByteRange, position: int) -> str:
+            r = client.get_object(Bucket=self.bucket_name, Key=object_key,
+                                  Range=self.get_range_header(byte_range), **extra_args)
+            body = r['Body']
+            start = position
+            while True:
+                chunk = body.read(self.transfer_multipart_chunksize)
+                if not chunk:
+                    break
+                # pwrite may write only part of the chunk, eg. when interrupted by a signal
+                view = memoryview(chunk)
+                while view:
+                    written = os.pwrite(fd, view, position)
+                    view = view[written:]
+                    position += written
+            part_size = byte_range[1] - byte_range[0] + 1
+            if position - start != part_size:
+                raise ChecksumMismatchError(f"Expected {part_size} bytes for range {byte_range}, "
+                                            f"got {position - start}")
+            return r.get('ETag')
+
+        fd = os.open(str(destination_fp), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, total_size)
+            with transfer_budget.acquire(self.transfer_max_concurrency) as max_concurrency:
+                with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                    futures = [executor.submit(fetch_part, byte_range, position)
+                               for byte_range, position in zip(byte_ranges, positions)]
+                    etags = {future.result() for future in futures}
+        finally:
+            os.close(fd)
+        if len(etags - {None}) > 1:
+            raise ChecksumMismatchError(f"Object changed during download, parts have ETags {sorted(etags - {None})}")
+
+    @staticmethod
+    def get_range_header(byte_range: ByteRange) -> str:
+        """
+        HTTP Range header from an inclusive byte range
+
+        :param byte_range:
+        :return:
+        """
+        start, end = byte_range
+        return f"bytes={start}-{'' if end is None else end}"
@@ -0,0 +1,152 @@
+"""
+Process-wide cache of S3 prefix listings
+
+Listing a prefix once allows to answer many "is this key available ?" questions,
+eg. for every timestep of a NWP run, without a LIST request for each of them.
+
+Example of usage :
+
+    >>> from datafetch.protocol.s3 import listing_cache
+    >>> listing_cache.clear()
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Object key -> size
+Listing = Dict[str, int]
+
+
+class ListingCache:
+    """
+    Thread-safe cache of prefix listings, per (bucket, prefix), expiring after a TTL
+
+    Listings can also be stored on disk, so that they are shared between processes, eg. Prefect tasks
+    """
+    def __init__(self):
+        self._listings: Dict[Tuple[str, str], Tuple[float, Listing]] = {}
+        self._lock = threading.Lock()
+        # One lock per listing, so that concurrent misses on the same prefix only list it once
+        self._prefix_locks: Dict[Tuple[str, str], threading.Lock] = {}
+
+    def get(self, bucket_name: str, prefix: str, list_prefix: Callable[[], Listing],
+            ttl: float = 60, cache_dir: str = None, refresh: bool = False) -> Listing:
+        """
+        Get listing of a prefix, calling `list_prefix` if not cached or expired
+
+        :param bucket_name:
+        :param prefix:
+        :param list_prefix: actually list the prefix
+        :param ttl: maximum age of a cached listing, in seconds
+        :param cache_dir: directory for sharing listings between processes, None for memory only
+        :param refresh: ignore cached listing
+        :return:
+        """
+        key = (bucket_name, prefix)
+        with self._lock:
+            prefix_lock = self._prefix_locks.setdefault(key, threading.Lock())
+
+        with prefix_lock:
+            if not refresh:
+                cached = self._get_cached(key, ttl, cache_dir)
+                if cached is not None:
+                    return cached
+
+            logger.debug(f"{bucket_name} : listing prefix {prefix} ...")
+            listed_at = time.time()
+            listing = list_prefix()
+            with self._lock:
+                self._listings[key] = (listed_at, listing)
+            if cache_dir is not None:
+                self._write(key, listed_at, listing, cache_dir)
+            return listing
+
+    def invalidate(self, bucket_name: str, prefix: str, cache_dir: str = None):
+        """
+        Forget listing of a prefix
+
+        :param bucket_name:
+        :param prefix:
+        :param cache_dir:
+        :return:
+        """
+        key = (bucket_name, prefix)
+        with self._lock:
+            self._listings.pop(key, None)
+        if cache_dir is not None:
+            self.get_cache_fp(key, cache_dir).unlink(missing_ok=True)
+
+    def clear(self):
+        """
+        Forget all listings kept in memory
+
+        :return:
+        """
+        with self._lock:
+            self._listings.clear()
+
+    def _get_cached(self, key: Tuple[str, str], ttl: float, cache_dir: Union[str, None]) -> Union[Listing, None]:
+        """
+        Listing from memory, or from disk, if it is recent enough
+
+        :param key:
+        :param ttl:
+        :param cache_dir:
+        :return:
+        """
+        with self._lock:
+            listed_at, listing = self._listings.get(key, (0, None))
+        if time.time() - listed_at <= ttl:
+            return listing
+
+        # Another process may have listed it more recently
+        if cache_dir is not None:
+            listed_at, listing = self._read(key, cache_dir)
+            if listing is not None and time.time() - listed_at <= ttl:
+                with self._lock:
+                    self._listings[key] = (listed_at, listing)
+                return listing
+        return None
+
+    @staticmethod
+    def get_cache_fp(key: Tuple[str, str], cache_dir: str) -> Path:
+        """
+        File storing a listing on disk
+
+        :param key:
+        :param cache_dir:
+        :return:
+        """
+        digest = hashlib.sha1("/".join(key).encode()).hexdigest()
+        return Path(cache_dir) / f"s3-listing-{digest}.json"
+
+    def _read(self, key: Tuple[str, str], cache_dir: str) -> Tuple[float, Union[Listing, None]]:
+        fp = self.get_cache_fp(key, cache_dir)
+        try:
+            content = json.loads(fp.read_text())
+            return content['listed_at'], content['keys']
+        except FileNotFoundError:
+            return 0, None
+        except (ValueError, KeyError) as exc:
+            logger.warning(f"Ignoring invalid listing cache {fp} : {exc}")
+            return 0, None
+
+    def _write(self, key: Tuple[str, str], listed_at: float, listing: Listing, cache_dir: str):
+        fp = self.get_cache_fp(key, cache_dir)
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so that other processes never read a partial file
+        fp_tmp = fp.with_name(f"{fp.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+        fp_tmp.write_text(json.dumps({'bucket': key[0], 'prefix': key[1],
+                                      'listed_at': listed_at, 'keys': listing}))
+        fp_tmp.replace(fp)
+
+
+# Process-wide cache
+listing_cache = ListingCache()
@@ -0,0 +1,177 @@
+"""
+Process-wide cache of boto3 clients, shared across S3 fetchers and threads
+
+Creating a boto3 session and client takes tens to hundreds of milliseconds, and a noticeable amount of memory.
+Clients are thread-safe, so a single one is kept per configuration.
+Resources (eg. Bucket) are not, so they are kept per thread, on top of the shared client.
+
+Example of usage :
+
+    >>> from datafetch.protocol.s3 import s3_client_cache
+    >>> client = s3_client_cache.get_client(region_name="us-east-1", max_pool_connections=20)
+"""
+import logging
+import threading
+from typing import Dict, Tuple
+
+import boto3
+import boto3.resources.base
+import boto3.utils
+import botocore
+import botocore.client
+import botocore.model
+
+from datafetch.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class S3ClientCache:
+    """
+    Thread-safe registry of S3 clients, one per (region, signature, endpoint) and connection pool size
+    """
+    def __init__(self):
+        self._session = None
+        self._clients: Dict[Tuple, botocore.client.BaseClient] = {}
+        self._resource_cls = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @staticmethod
+    def get_key(region_name: str = None, unsigned: bool = True, endpoint_url: str = None,
+                max_pool_connections: int = 10) -> Tuple:
+        return region_name, unsigned, endpoint_url, max_pool_connections
+
+    def get_client(self, region_name: str = None, unsigned: bool = True, endpoint_url: str = None,
+                   max_pool_connections: int = 10) -> botocore.client.BaseClient:
+        """
+        Get a S3 client, creating it if needed
+
+        :param region_name: None for default region, from environment or AWS config
+        :param unsigned: anonymous requests, eg. for public datasets
+        :param endpoint_url: None for AWS endpoint
+        :param max_pool_connections: maximum number of connections kept alive, ie. of concurrent requests
+        :return:
+        """
+        key = self.get_key(region_name, unsigned, endpoint_url, max_pool_connections)
+        with self._lock:
+            if key not in self._clients:
+                logger.debug(f"Creating S3 client {key} ...")
+                # boto3 sessions are not thread-safe, clients are created under lock
+                if self._session is None:
+                    self._session = boto3.session.Session()
+                config = botocore.client.Config(max_pool_connections=max_pool_connections)
+                if unsigned:
+                    config = config.merge(botocore.client.Config(signature_version=botocore.UNSIGNED))
+                client = self._session.client('s3', region_name=region_name,
+                                              endpoint_url=endpoint_url, config=config)
+                client.meta.events.register('before-parameter-build.s3', record_request)
+                client.meta.events.register('after-call.s3', record_retries)
+                self._clients[key] = client
+            return self._clients[key]
+
+    def get_resource(self, region_name: str = None, unsigned: bool = True, endpoint_url: str = None,
+                     max_pool_connections: int = 10) -> boto3.resources.base.ServiceResource:
+        """
+        Get a S3 resource for the current thread, using the shared client
+
+        :param region_name:
+        :param unsigned:
+        :param endpoint_url:
+        :param max_pool_connections:
+        :return:
+        """
+        key = self.get_key(region_name, unsigned, endpoint_url, max_pool_connections)
+        resources = self._local.__dict__.setdefault('resources', {})
+        if key not in resources:
+            client = self.get_client(*key)
+            # Resources and their sub-resources send their requests through the given client
+            resources[key] = self.get_resource_class(client)(client=client)
+        return resources[key]
+
+    def get_resource_class(self, client: botocore.client.BaseClient) -> type:
+        """
+        S3 ServiceResource class, built once from boto3 resource definitions
+
+        Unlike `boto3.session.Session.resource()`, no client is created along the way
+
+        :param client: shared client, whose service model is used
+        :return:
+        """
+        with self._lock:
+            if self._resource_cls is None:
+                loader = self._session._loader
+                api_version = loader.determine_latest_version('s3', 'resources-1')
+                resource_model = loader.load_service_model('s3', 'resources-1', api_version)
+                service_context = boto3.utils.ServiceContext(
+                    service_name='s3',
+                    service_model=client.meta.service_model,
+                    resource_json_definitions=resource_model['resources'],
+                    service_waiter_model=boto3.utils.LazyLoadedWaiterModel(self._session._session, 's3', api_version),
+                )
+                self._resource_cls = self._session.resource_factory.load_from_definition(
+                    resource_name='s3',
+                    single_resource_json_definition=resource_model['service'],
+                    service_context=service_context,
+                )
+            return self._resource_cls
+
+    def get_bucket(self, bucket_name: str, **kwargs) -> object:
+        """
+        Get a Bucket resource for the current thread
+
+        :param bucket_name:
+        :param kwargs: client configuration, cf. `get_client()`
+        :return:
+        """
+        key = (bucket_name, self.get_key(**kwargs))
+        buckets = self._local.__dict__.setdefault('buckets', {})
+        if key not in buckets:
+            buckets[key] = self.get_resource(**kwargs).Bucket(name=bucket_name)
+        return buckets[key]
+
+    def clear(self):
+        """
+        Forget all clients, eg. after forking
+
+        Resources already created by other threads keep their client
+
+        :return:
+        """
+        with self._lock:
+            self._clients.clear()
+            self._session = None
+            self._resource_cls = None
+        self._local.__dict__.clear()
+
+
+def record_request(params: dict, model: botocore.model.OperationModel, context: dict, **kwargs):
+    """
+    Count S3 requests in metrics, cf. botocore events
+
+    :param params: parameters of the API call, eg. Bucket, Key
+    :param model: API operation, eg. GetObject
+    :param context: kept along the API call
+    :param kwargs:
+    :return:
+    """
+    context['datafetch_bucket'] = params.get('Bucket', "")
+    metrics.s3_requests_total.inc(bucket=context['datafetch_bucket'], operation=model.name)
+
+
+def record_retries(parsed: dict, context: dict, **kwargs):
+    """
+    Count retries of a S3 request in metrics, done by botocore before returning a response
+
+    :param parsed: response
+    :param context:
+    :param kwargs:
+    :return:
+    """
+    nb_retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if nb_retries:
+        metrics.retries_total.inc(nb_retries, protocol="s3", host="", bucket=context.get('datafetch_bucket', ""))
+
+
+# Process-wide cache
+s3_client_cache = S3ClientCache()
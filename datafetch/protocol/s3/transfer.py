@@ -0,0 +1,203 @@
+"""
+Tuning of S3 transfers (multipart size, threads, ...) and a process-wide concurrency budget
+
+Example of usage :
+
+    >>> from datafetch.protocol.s3 import set_transfer_concurrency_budget
+    >>> # No more than 16 download threads in the whole process,
+    >>> # whatever the number of S3ApiBucket downloading in parallel
+    >>> set_transfer_concurrency_budget(16)
+"""
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Tuple, Union
+
+import boto3.s3.transfer
+from s3transfer.download import GetObjectTask
+from s3transfer.manager import TransferManager
+from s3transfer.subscribers import BaseSubscriber
+
+from .session import s3_client_cache
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+class TransferConcurrencyBudget:
+    """
+    A counting semaphore allowing to acquire several slots at once
+
+    Each download acquires up to as many slots as the number of threads it may use, and at least one,
+    so that the total number of transfer threads in the process stays under `size`.
+    Downloads share the budget : a download gets whatever slots are available instead of waiting for all of them.
+    """
+    def __init__(self, size: int = None):
+        self.size = size
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    def resize(self, size: Union[int, None]):
+        """
+        Change the budget size, None meaning unlimited
+
+        :param size:
+        :return:
+        """
+        with self._condition:
+            self.size = size
+            self._condition.notify_all()
+
+    @contextmanager
+    def acquire(self, concurrency: int):
+        """
+        Block until at least one slot is available, and hold up to `concurrency` slots while in context
+
+        :param concurrency:
+        :return: number of slots actually granted, to use as number of threads
+        """
+        with self._condition:
+            while self.size is not None and self.in_use >= self.size:
+                self._condition.wait()
+            slots = max(1, concurrency) if self.size is None else max(1, min(concurrency, self.size - self.in_use))
+            self.in_use += slots
+        try:
+            yield slots
+        finally:
+            with self._condition:
+                self.in_use -= slots
+                self._condition.notify_all()
+
+
+# Process-wide budget, unlimited by default
+transfer_budget = TransferConcurrencyBudget()
+
+
+def run_with_budget_slot(fn: Callable, *args, **kwargs):
+    """
+    Run a function while holding one slot of the concurrency budget
+
+    :param fn:
+    :param args:
+    :param kwargs:
+    :return:
+    """
+    with transfer_budget.acquire(1):
+        return fn(*args, **kwargs)
+
+
+class BudgetedThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    Thread pool of shared TransferManagers, cf. `executor_cls` of s3transfer TransferManager
+
+    Each GET request holds a slot of the concurrency budget while running,
+    so that downloads of all shared managers, and those not using the shared pool, stay under the budget together.
+    Submission and disk writing tasks aren't limited, as GET requests may wait for them.
+    """
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        if isinstance(fn, GetObjectTask):
+            return super().submit(run_with_budget_slot, fn, *args, **kwargs)
+        return super().submit(fn, *args, **kwargs)
+
+
+class KnownObjectSubscriber(BaseSubscriber):
+    """
+    Provide size and ETag of an object, from a previous HEAD request, to a s3transfer download
+
+    It saves the HEAD request s3transfer would send, and ties the download to that version of the object :
+    s3transfer versions supporting it send the ETag in the If-Match header of every GET request
+    """
+    def __init__(self, size: int, etag: str):
+        self.size = size
+        self.etag = etag
+        # Whether s3transfer ensures the object doesn't change during download
+        self.etag_provided = False
+
+    def on_queued(self, future, **kwargs):
+        future.meta.provide_transfer_size(self.size)
+        if hasattr(future.meta, 'provide_object_etag'):
+            future.meta.provide_object_etag(self.etag)
+            self.etag_provided = True
+
+
+# Shared TransferManager per client configuration
+_shared_managers: Dict[Tuple, TransferManager] = {}
+_shared_manager_lock = threading.Lock()
+
+
+def set_transfer_concurrency_budget(size: Union[int, None]):
+    """
+    Limit the total number of S3 transfer threads in the current process
+
+    :param size: maximum number of threads, None for unlimited
+    :return:
+    """
+    logger.debug(f"Setting S3 transfer concurrency budget to {size}")
+    transfer_budget.resize(size)
+
+    # Shared pool size depends on budget, managers are re-created on next usage.
+    # Previous ones aren't shut down, as downloads may still be using them : their idle threads exit
+    # once they are not referenced anymore.
+    with _shared_manager_lock:
+        _shared_managers.clear()
+
+
+def make_transfer_config(multipart_threshold: int, multipart_chunksize: int,
+                         max_concurrency: int, max_io_queue: int,
+                         use_threads: bool) -> boto3.s3.transfer.TransferConfig:
+    """
+    Build a boto3 TransferConfig
+
+    :param multipart_threshold:
+    :param multipart_chunksize:
+    :param max_concurrency:
+    :param max_io_queue:
+    :param use_threads:
+    :return:
+    """
+    return boto3.s3.transfer.TransferConfig(
+        multipart_threshold=multipart_threshold,
+        multipart_chunksize=multipart_chunksize,
+        max_concurrency=max_concurrency,
+        max_io_queue=max_io_queue,
+        use_threads=use_threads,
+    )
+
+
+def get_shared_transfer_manager(config: boto3.s3.transfer.TransferConfig,
+                                region_name: str = None, unsigned: bool = True, endpoint_url: str = None,
+                                **kwargs) -> TransferManager:
+    """
+    Get a process-wide TransferManager, whose thread pool is shared by all downloads with the same settings
+
+    There is one manager per client and multipart settings (threshold, chunk size, IO queue),
+    its number of threads being the concurrency budget if set, otherwise `config.max_concurrency`.
+    Whatever the number of managers, their GET requests are limited by the budget, cf. BudgetedThreadPoolExecutor
+
+    :param config:
+    :param region_name:
+    :param unsigned:
+    :param endpoint_url:
+    :param kwargs: other client settings, ignored since connection pool is sized from concurrency
+    :return:
+    """
+    key = (region_name, unsigned, endpoint_url,
+           config.multipart_threshold, config.multipart_chunksize, config.max_io_queue)
+    with _shared_manager_lock:
+        if key not in _shared_managers:
+            max_concurrency = transfer_budget.size or config.max_concurrency
+            shared_config = make_transfer_config(
+                multipart_threshold=config.multipart_threshold,
+                multipart_chunksize=config.multipart_chunksize,
+                max_concurrency=max_concurrency,
+                max_io_queue=config.max_io_queue,
+                use_threads=True,
+            )
+            client = s3_client_cache.get_client(region_name=region_name, unsigned=unsigned,
+                                                endpoint_url=endpoint_url, max_pool_connections=max_concurrency)
+            logger.debug(f"Creating shared S3 transfer pool {key} with {max_concurrency} threads ...")
+            _shared_managers[key] = TransferManager(client, config=shared_config,
+                                                    executor_cls=BudgetedThreadPoolExecutor)
+        return _shared_managers[key]
@@ -0,0 +1,97 @@
+"""
+Expected availability of regularly published resources, eg. NWP timesteps, learned from past observations
+
+Publication offsets (seconds after run time) observed for previous runs give, for each timestep,
+a window [median, p95] in which it is likely to appear. Polling can then be dense inside these windows,
+and sparse elsewhere. After them, polling backs off from dense to sparse.
+
+Example of usage :
+
+    >>> expected = compute_expected_availability({'003': [12600, 12660, 12720, 13000]})
+    >>> expected['003']
+    ExpectedAvailability(median=12690.0, p95=13000.0, nb_samples=4)
+    >>> next_poll_delay(11000, [expected['003']], min_interval=30, max_interval=600)
+    600
+    >>> next_poll_delay(13160, [expected['003']], min_interval=30, max_interval=600)
+    50.0
+"""
+import math
+import statistics
+from typing import Dict, List, Union
+
+import pydantic
+
+
+class ExpectedAvailability(pydantic.BaseModel):
+    """
+    Publication offset of a resource, in seconds after run time
+    """
+    median: float
+    p95: float
+    nb_samples: int
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Nearest-rank percentile
+
+    :param values:
+    :param q: between 0 and 100
+    :return:
+    """
+    values = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(values)))
+    return values[rank - 1]
+
+
+def compute_expected_availability(offsets: Dict[str, List[float]],
+                                  min_samples: int = 3) -> Dict[str, ExpectedAvailability]:
+    """
+    Expected publication offset of each timestep, from offsets observed for previous runs
+
+    :param offsets: timestep -> observed offsets, in seconds
+    :param min_samples: ignore timesteps with fewer observations
+    :return:
+    """
+    return {
+        timestep: ExpectedAvailability(
+            median=statistics.median(values),
+            p95=percentile(values, 95),
+            nb_samples=len(values),
+        )
+        for timestep, values in offsets.items()
+        if len(values) >= min_samples
+    }
+
+
+def next_poll_delay(offset: float, expected: List[Union[ExpectedAvailability, None]],
+                    min_interval: float, max_interval: float, margin: float = 60, backoff: float = 0.5) -> float:
+    """
+    Delay before next poll, dense inside expected publication windows of missing resources, and sparse elsewhere
+
+    A resource still missing after its window, ie. later than usual, is polled with a backoff : the delay
+    starts at `min_interval` and grows with lateness, up to `max_interval`
+
+    :param offset: current time, in seconds after run time
+    :param expected: expected availability of resources still missing, None when unknown
+    :param min_interval: delay when a publication is expected soon, or unknown
+    :param max_interval: maximum delay, when nothing is expected soon
+    :param margin: seconds added before median and after p95, for the window in which polling is dense
+    :param backoff: delay after a window, as a fraction of time elapsed since its end
+    :return:
+    """
+    if not expected or any(availability is None for availability in expected):
+        return min_interval
+
+    delay = max_interval
+    for availability in expected:
+        start = availability.median - margin
+        end = availability.p95 + margin
+        if start <= offset <= end:
+            # Inside expected window : keep polling densely
+            return min_interval
+        if offset < start:
+            delay = min(delay, start - offset)
+        else:
+            delay = min(delay, backoff * (offset - end))
+    return max(min_interval, delay)
@@ -0,0 +1,295 @@
+"""
+Shared local cache of downloaded files, so that the same remote file is only downloaded once
+whatever the number of flows and destination directories
+
+Files are indexed by their remote identity (eg. url), and stored once per content when their checksum is known.
+They are materialized into destination directories as hard links by default, which costs neither time nor disk space.
+A disk quota and a time-to-live can be set, least recently used files being evicted first.
+
+Hard-linked destinations share their inode with the stored file : modifying one of them in place, eg. appending to it
+or rewriting it with `open(fp, 'r+b')`, corrupts the cache and every other destination of the same file.
+Replace them instead (write a new file, then rename it over the destination), or use "reflink" or "copy" link modes.
+
+Example of usage :
+
+    >>> from datafetch.weather.noaa.nwp import NoaaGfsS3
+    >>> s3api = NoaaGfsS3(cache_dir="/data/cache", cache_max_size=200 * 1024 ** 3)
+    >>> s3api.download_timestep("20210201", "00", "003", download_dir="/tmp/plop")
+    >>> # Instantaneous, without any transfer
+    >>> s3api.download_timestep("20210201", "00", "003", download_dir="/tmp/plip")
+"""
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Type, Union
+
+import peewee
+import pydantic
+
+from .db import CacheEntry, get_database, bind_model, ensure_tables
+
+logger = logging.getLogger(__name__)
+
+LINK_MODES = ("hardlink", "reflink", "symlink", "copy")
+
+# cf. linux/fs.h
+FICLONE = 0x40049409
+
+
+class DownloadCache(pydantic.BaseModel):
+    """
+    A directory of downloaded files, with its own index database
+    """
+    cache_dir: str
+    # Maximum size of stored files in bytes, None for unlimited
+    max_size: int = None
+    # Maximum age of a stored file in seconds, None for unlimited
+    ttl: float = None
+    # How files are materialized into destinations, cf. LINK_MODES
+    # Hard links and reflinks fall back to copies, eg. when cache is on another filesystem.
+    # Hard-linked destinations must not be modified in place, cf. module docstring
+    # Symbolic links become dangling when a file is evicted
+    link_mode: str = "hardlink"
+
+    # CacheEntry model bound to the index, once its table is ready
+    _model: Type[CacheEntry] = None
+
+    class Config:
+        underscore_attrs_are_private = True
+
+    @pydantic.validator('link_mode')
+    def check_link_mode(cls, link_mode: str) -> str:
+        if link_mode not in LINK_MODES:
+            raise ValueError(f"link_mode must be one of {LINK_MODES}")
+        return link_mode
+
+    @property
+    def db(self) -> peewee.SqliteDatabase:
+        return get_database(Path(self.cache_dir) / "index.db")
+
+    @property
+    def db_model(self) -> Type[CacheEntry]:
+        """
+        CacheEntry model bound to the cache index, creating it on first use
+
+        Each thread connects to the index on its first query
+
+        :return:
+        """
+        if self._model is None:
+            Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+            model = bind_model(CacheEntry, self.db)
+            ensure_tables(self.db, [model])
+            self._model = model
+        return self._model
+
+    def get_entry(self, key: str) -> Union[CacheEntry, None]:
+        """
+        Entry of a key, if stored and not expired
+
+        :param key:
+        :return:
+        """
+        model = self.db_model
+        entry = model.get_or_none(model.key == key)
+        if entry is None:
+            return None
+        if self.ttl is not None and datetime.utcnow() - entry.date_created > timedelta(seconds=self.ttl):
+            logger.debug(f"{entry} : expired")
+            self.remove(entry)
+            return None
+        if not Path(entry.filepath).is_file():
+            logger.warning(f"{entry} : stored file doesn't exist anymore")
+            self.remove(entry)
+            return None
+        return entry
+
+    def materialize(self, key: str, destination_fp: Union[str, Path]) -> Union[Path, None]:
+        """
+        Put the stored file of a key to `destination_fp`
+
+        :param key:
+        :param destination_fp:
+        :return: None if key isn't stored
+        """
+        entry = self.get_entry(key)
+        if entry is None:
+            return None
+
+        destination_fp = Path(destination_fp)
+        self.link(Path(entry.filepath), destination_fp)
+        logger.info(f"{key} : found in cache, materialized to {destination_fp}")
+
+        model = self.db_model
+        model.update(date_last_access=datetime.utcnow(), nb_hits=model.nb_hits + 1) \
+            .where(model.id == entry.id).execute()
+        return destination_fp
+
+    def put(self, key: str, fp: Union[str, Path], checksum: str = None) -> Path:
+        """
+        Store a downloaded file, which is then replaced by a link to the stored file
+
+        :param key:
+        :param fp:
+        :param checksum: checksum of the file, allowing to store identical contents only once
+        :return: path of the stored file
+        """
+        fp = Path(fp)
+        size = fp.stat().st_size
+        # A new version replaces the previous one, which must not count in quota
+        model = self.db_model
+        previous = model.get_or_none(model.key == key)
+        if previous is not None:
+            self.remove(previous)
+
+        stored_fp = self.get_stored_fp(key, checksum)
+        stored_fp.parent.mkdir(parents=True, exist_ok=True)
+
+        stored_mode = None
+        if checksum is not None and stored_fp.is_file():
+            logger.debug(f"{key} : same content already stored in {stored_fp}")
+        else:
+            self.evict(reserve=size)
+            stored_mode = self.link(fp, stored_fp, link_mode="copy" if self.link_mode == "symlink" else self.link_mode)
+
+        # Destination shares its content with the stored file
+        if self.link_mode == "symlink":
+            self.link(stored_fp, fp)
+        elif self.link_mode == "hardlink" and stored_mode != "copy" and not os.path.samefile(fp, stored_fp):
+            # Destination already has the same content, only a hard link is worth replacing it
+            self.link(stored_fp, fp, copy_fallback=False)
+
+        now = datetime.utcnow()
+        model.insert(key=key, filepath=str(stored_fp), size=size, checksum=checksum,
+                     date_created=now, date_last_access=now) \
+            .on_conflict_replace().execute()
+        logger.debug(f"{key} : stored in cache {stored_fp}")
+        return stored_fp
+
+    def get_stored_fp(self, key: str, checksum: str = None) -> Path:
+        """
+        Where a file is stored : by content if its checksum is known, otherwise by key
+
+        :param key:
+        :param checksum: eg. "sha256:d7a8fb..."
+        :return:
+        """
+        if checksum is not None:
+            algorithm, _, digest = checksum.partition(":")
+            return Path(self.cache_dir) / "objects" / algorithm / digest[:2] / digest
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return Path(self.cache_dir) / "objects" / "key" / digest[:2] / digest
+
+    def link(self, source: Path, destination: Path, link_mode: str = None,
+             copy_fallback: bool = True) -> Union[str, None]:
+        """
+        Make `destination` have the content of `source`, according to link mode
+
+        :param source:
+        :param destination:
+        :param link_mode: None for the cache link mode
+        :param copy_fallback: copy `source` when it can't be linked, otherwise leave `destination` as is
+        :return: link mode actually used, "copy" after a fallback, None if nothing was done
+        """
+        link_mode = link_mode or self.link_mode
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        # Link, or copy, to a temporary name first, so that destination is always complete.
+        # The name is unique per thread, as several fetchers may materialize the same file concurrently
+        destination_tmp = destination.with_name(f".{destination.name}.{os.getpid()}.{threading.get_ident()}.link")
+        destination_tmp.unlink(missing_ok=True)
+
+        if link_mode == "hardlink":
+            try:
+                os.link(source, destination_tmp)
+            except OSError as exc:
+                if not copy_fallback:
+                    logger.debug(f"Unable to hard link {source} : {exc}, keeping {destination}")
+                    return None
+                logger.debug(f"Unable to hard link {source} : {exc}, copying it")
+                shutil.copyfile(source, destination_tmp)
+                link_mode = "copy"
+        elif link_mode == "symlink":
+            destination_tmp.symlink_to(source.absolute())
+        elif link_mode == "reflink":
+            if not self.reflink(source, destination_tmp):
+                link_mode = "copy"
+        else:
+            shutil.copyfile(source, destination_tmp)
+
+        destination_tmp.replace(destination)
+        return link_mode
+
+    @staticmethod
+    def reflink(source: Path, destination: Path) -> bool:
+        """
+        Copy-on-write clone of a file, eg. on btrfs or xfs, falling back to a copy
+
+        :param source:
+        :param destination:
+        :return: False if it fell back to a copy
+        """
+        try:
+            import fcntl
+            with source.open('rb') as fd_src, destination.open('wb') as fd_dst:
+                fcntl.ioctl(fd_dst.fileno(), FICLONE, fd_src.fileno())
+        except (ImportError, OSError) as exc:
+            logger.debug(f"Unable to reflink {source} : {exc}, copying it")
+            shutil.copyfile(source, destination)
+            return False
+        return True
+
+    def remove(self, entry: CacheEntry):
+        """
+        Remove an entry, and its stored file if no other entry shares it
+
+        :param entry:
+        :return:
+        """
+        model = self.db_model
+        model.delete().where(model.id == entry.id).execute()
+        if not model.select().where(model.filepath == entry.filepath).exists():
+            Path(entry.filepath).unlink(missing_ok=True)
+
+    def total_size(self) -> int:
+        """
+        Size of stored files, counting shared files once
+
+        :return:
+        """
+        model = self.db_model
+        query = model.select(model.filepath, peewee.fn.MAX(model.size)).group_by(model.filepath).tuples()
+        return sum(size for _, size in query)
+
+    def evict(self, reserve: int = 0) -> int:
+        """
+        Remove expired entries, then least recently used ones until `reserve` bytes fit in quota
+
+        :param reserve:
+        :return: number of removed entries
+        """
+        model = self.db_model
+        removed = 0
+        with self.db.atomic():
+            if self.ttl is not None:
+                expired = model.select().where(model.date_created < datetime.utcnow() - timedelta(seconds=self.ttl))
+                for entry in list(expired):
+                    self.remove(entry)
+                    removed += 1
+
+            if self.max_size is not None:
+                total_size = self.total_size()
+                for entry in list(model.select().order_by(model.date_last_access)):
+                    if total_size + reserve <= self.max_size:
+                        break
+                    self.remove(entry)
+                    removed += 1
+                    if not model.select().where(model.filepath == entry.filepath).exists():
+                        total_size -= entry.size
+
+        if removed:
+            logger.info(f"Evicted {removed} files from cache {self.cache_dir}")
+        return removed
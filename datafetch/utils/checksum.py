@@ -0,0 +1,132 @@
+"""
+Checksums computed while downloading, for verifying and recording downloaded files without reading them again
+
+xxhash is used when installed (`pip install datafetch[xxhash]`), since it is much faster than SHA-256
+
+Example of usage :
+
+    >>> checksum = Checksum(with_md5=True)
+    >>> for chunk in chunks:
+            fd.write(chunk)
+            checksum.update(chunk)
+    >>> checksum.verify(etag='"9e107d9d372bb6826bd81d3542a419d6"')
+    >>> checksum.value
+    'sha256:d7a8fbb307d7809469ca9abcb0082e4f...'
+"""
+import hashlib
+import re
+from pathlib import Path
+from typing import Union
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DEFAULT_CHECKSUM_ALGORITHM = "xxh3_64" if xxhash is not None else "sha256"
+
+# ETag of a S3 object uploaded in a single part is the MD5 of its content
+# Multipart ETags, eg. "<md5 of md5s>-<nb parts>", and weak ETags don't match this
+_MD5_ETAG = re.compile(r'^"?([0-9a-fA-F]{32})"?$')
+
+
+class ChecksumMismatchError(Exception):
+    """
+    Downloaded content doesn't match remote metadata
+    """
+
+
+def new_hash(algorithm: str):
+    """
+    Hash object from hashlib, or from xxhash for 'xxh*' algorithms
+
+    :param algorithm:
+    :return:
+    """
+    if algorithm.startswith("xxh"):
+        if xxhash is None:
+            raise ImportError(f"xxhash is required for {algorithm} checksums, install it with `pip install xxhash`")
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def md5_from_etag(etag: Union[str, None]) -> Union[str, None]:
+    """
+    MD5 of the content, if the ETag is one
+
+    :param etag:
+    :return:
+    """
+    match = _MD5_ETAG.match(etag or "")
+    return match.group(1).lower() if match else None
+
+
+class Checksum:
+    """
+    Checksum of a content, updated chunk by chunk, along with its size
+    """
+    def __init__(self, algorithm: str = DEFAULT_CHECKSUM_ALGORITHM, with_md5: bool = False):
+        """
+        :param algorithm: algorithm of the recorded checksum
+        :param with_md5: also compute MD5, for verifying against an ETag
+        """
+        self.algorithm = algorithm
+        self._hash = new_hash(algorithm)
+        self._md5 = hashlib.md5() if with_md5 and algorithm != "md5" else None
+        self.size = 0
+
+    def update(self, data: Union[bytes, memoryview]):
+        self._hash.update(data)
+        if self._md5 is not None:
+            self._md5.update(data)
+        self.size += len(data)
+
+    def update_from_file(self, fp: Union[str, Path], size: int = None, chunk_size: int = 4 * 1024 * 1024):
+        """
+        Update from the beginning of a file, eg. a partial download being resumed
+
+        :param fp:
+        :param size: number of bytes to read, None for the whole file
+        :param chunk_size:
+        :return:
+        """
+        buffer = memoryview(bytearray(chunk_size))
+        remaining = size
+        with open(fp, 'rb', buffering=0) as fd:
+            while remaining is None or remaining > 0:
+                n = fd.readinto(buffer if remaining is None else buffer[:min(chunk_size, remaining)])
+                if not n:
+                    break
+                self.update(buffer[:n])
+                if remaining is not None:
+                    remaining -= n
+
+    @property
+    def value(self) -> str:
+        """
+        Checksum, prefixed by its algorithm, eg. 'sha256:d7a8fb...'
+
+        :return:
+        """
+        return f"{self.algorithm}:{self._hash.hexdigest()}"
+
+    @property
+    def md5(self) -> Union[str, None]:
+        if self.algorithm == "md5":
+            return self._hash.hexdigest()
+        return self._md5.hexdigest() if self._md5 is not None else None
+
+    def verify(self, etag: str = None, size: int = None):
+        """
+        Compare with remote metadata, when available
+
+        :param etag: checked only if it is a MD5, cf. md5_from_etag()
+        :param size: expected size
+        :return:
+        :raise ChecksumMismatchError:
+        """
+        if size is not None and int(size) != self.size:
+            raise ChecksumMismatchError(f"Expected {size} bytes, got {self.size}")
+        expected_md5 = md5_from_etag(etag)
+        if expected_md5 is not None and self.md5 is not None and expected_md5 != self.md5:
+            raise ChecksumMismatchError(f"MD5 {self.md5} doesn't match ETag {etag}")
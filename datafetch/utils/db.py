@@ -1,10 +1,37 @@
+import logging
+import threading
 from datetime import timedelta, datetime
 from pathlib import Path
+from typing import Dict, List, Tuple, Type, Union
 
 import peewee
+from playhouse.migrate import SqliteMigrator, migrate
 
-# FIXME: don't use a global variable ?
-db = peewee.SqliteDatabase(None)
+logger = logging.getLogger(__name__)
+
+# Write-ahead log allows readers and a writer to work concurrently,
+# and doesn't need to sync on every transaction when synchronous is 'normal'
+# cf. https://www.sqlite.org/wal.html
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+}
+# Seconds to wait for a lock held by another connection
+SQLITE_TIMEOUT = 30
+# Maximum number of parameters in a query, for older sqlite versions
+SQLITE_MAX_VARIABLES = 999
+
+# Models are declared against this placeholder, and bound to an actual database per file,
+# cf. get_database() and bind_model()
+db = peewee.DatabaseProxy()
+
+# One database object per file, each thread getting its own connection from it
+_databases: Dict[str, peewee.SqliteDatabase] = {}
+# Models bound to each database
+_bound_models: Dict[Tuple[type, str], type] = {}
+# Database files whose tables are already created and migrated in current process
+_tables_ready = set()
+_lock = threading.RLock()
 
 
 class BaseDbModel(peewee.Model):
@@ -35,6 +62,11 @@ class DownloadRecord(BaseDbModel):
     ])
     nb_try = peewee.IntegerField(default=0)
     error = peewee.CharField(null=True)
+    # Remote validators of the last download attempt, allowing to resume it
+    etag = peewee.CharField(null=True)
+    last_modified = peewee.CharField(null=True)
+    # Checksum of downloaded content, prefixed by its algorithm, eg. "sha256:..."
+    checksum = peewee.CharField(null=True)
 
     def __str__(self):
         r = f"<{self.key[:20]}> // {self.status}"
@@ -62,13 +94,16 @@ class DownloadRecord(BaseDbModel):
         else:
             return False
 
+    # Status of records that need to be downloaded
+    need_download_status = ("empty", "failed", "queued_and_ready")
+
     def need_download(self) -> bool:
         """
         Check if we need to download this record or not
 
         :return:
         """
-        if self.status in ("empty", "failed", "queued_and_ready"):
+        if self.status in self.need_download_status:
             return True
         else:
             return False
@@ -124,6 +159,23 @@ class DownloadRecord(BaseDbModel):
         self.status = "downloaded"
         self.date_stop = datetime.now()
 
+    def set_remote_validators(self, etag: str = None, last_modified: str = None, checksum: str = None, **kwargs):
+        """
+        Keep track of remote file validators (ETag, Last-Modified), and of downloaded content checksum
+
+        :param etag:
+        :param last_modified:
+        :param checksum:
+        :param kwargs: other remote information, ignored
+        :return:
+        """
+        if etag:
+            self.etag = etag
+        if last_modified:
+            self.last_modified = str(last_modified)
+        if checksum:
+            self.checksum = checksum
+
     def set_failed(self, error: str = None):
         """
         Set failed status
@@ -135,3 +187,132 @@ class DownloadRecord(BaseDbModel):
         self.date_stop = datetime.now()
         if error:
             self.error = error
+
+
+class AvailabilityRecord(BaseDbModel):
+    """
+    When a remote resource, eg. a NWP timestep, was observed as available for the first time
+
+    Actual publication happened between `date_last_missing` and `date_first_seen`
+    """
+    key = peewee.CharField(unique=True)
+    # Group of resources published on the same schedule, eg. a S3 bucket
+    product = peewee.CharField()
+    # Reference time of the publication, eg. NWP run time
+    run_time = peewee.DateTimeField()
+    timestep = peewee.CharField(null=True)
+    date_last_missing = peewee.DateTimeField(null=True)
+    date_first_seen = peewee.DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            (('product', 'timestep', 'run_time'), False),
+        )
+
+    def __str__(self):
+        return f"<{self.key[:20]}> // run {self.run_time} // first seen {self.date_first_seen}"
+
+    def publication_offset(self) -> Union[float, None]:
+        """
+        Estimated publication time, in seconds after `run_time`
+
+        :return: None if publication time is not bounded by observations
+        """
+        if self.date_last_missing is None or self.date_first_seen is None:
+            return None
+        published = self.date_last_missing + (self.date_first_seen - self.date_last_missing) / 2
+        return (published - self.run_time).total_seconds()
+
+
+class CacheEntry(BaseDbModel):
+    """
+    A file of the shared download cache, cf. datafetch.utils.cache
+    """
+    # Remote identity, eg. url
+    key = peewee.CharField(unique=True)
+    # Stored file, possibly shared by several keys having the same content
+    filepath = peewee.CharField()
+    size = peewee.IntegerField()
+    checksum = peewee.CharField(null=True)
+    date_created = peewee.DateTimeField(default=datetime.utcnow)
+    date_last_access = peewee.DateTimeField(default=datetime.utcnow, index=True)
+    nb_hits = peewee.IntegerField(default=0)
+
+    def __str__(self):
+        return f"<{self.key[:20]}> // {self.filepath} // {self.nb_hits} hits"
+
+
+def migrate_tables(database: peewee.Database, models: List[peewee.Model]):
+    """
+    Add columns which are missing from existing tables, eg. database created by a previous version
+
+    New columns must be nullable or have a default value
+
+    :param database:
+    :param models:
+    :return:
+    """
+    migrator = SqliteMigrator(database)
+    for model in models:
+        table_name = model._meta.table_name
+        existing_columns = {column.name for column in database.get_columns(table_name)}
+        operations = [
+            migrator.add_column(table_name, field.column_name, field)
+            for field in model._meta.sorted_fields
+            if field.column_name not in existing_columns
+        ]
+        if operations:
+            logger.info(f"Migrating table {table_name} : adding {len(operations)} columns ...")
+            migrate(*operations)
+
+
+def get_database(path: str) -> peewee.SqliteDatabase:
+    """
+    Database object for a sqlite file, shared in the current process
+
+    peewee keeps a connection per thread, so the same object can be safely used from several threads
+
+    :param path:
+    :return:
+    """
+    path = str(path)
+    with _lock:
+        if path not in _databases:
+            logger.debug(f"Using database {path} ...")
+            _databases[path] = peewee.SqliteDatabase(path, pragmas=SQLITE_PRAGMAS, timeout=SQLITE_TIMEOUT)
+        return _databases[path]
+
+
+def bind_model(model: Type[peewee.Model], database: peewee.Database) -> Type[peewee.Model]:
+    """
+    Get a subclass of `model` bound to `database`, using the same table
+
+    Unlike Model.bind(), this doesn't modify `model`, so that several databases can be used at the same time
+
+    :param model:
+    :param database:
+    :return:
+    """
+    key = (model, database.database)
+    with _lock:
+        if key not in _bound_models:
+            meta = type('Meta', (), {'database': database, 'table_name': model._meta.table_name})
+            _bound_models[key] = type(model.__name__, (model,), {'Meta': meta, '__module__': model.__module__})
+        return _bound_models[key]
+
+
+def ensure_tables(database: peewee.Database, models: List[Type[peewee.Model]]):
+    """
+    Create and migrate tables, only once per database file in the current process
+
+    :param database:
+    :param models: models bound to `database`
+    :return:
+    """
+    with _lock:
+        models = [model for model in models if (model._meta.table_name, database.database) not in _tables_ready]
+        if not models:
+            return
+        database.create_tables(models)
+        migrate_tables(database, models)
+        _tables_ready.update((model._meta.table_name, database.database) for model in models)
@@ -0,0 +1,116 @@
+"""
+Helpers for GRIB2 index files (.idx), as produced by wgrib2 and published by NOAA next to each GRIB2 file
+
+A line of an index file looks like :
+
+    1:0:d=2021020200:PRMSL:mean sea level:anl:
+    2:990253:d=2021020200:CLWMR:1 hybrid level:anl:
+
+ie. message number, byte offset, reference date, variable, level, forecast, ...
+"""
+from typing import List, Tuple, Union
+
+import pydantic
+
+# Inclusive byte range, as used in HTTP Range header. An end of None means "until end of file"
+ByteRange = Tuple[int, Union[int, None]]
+
+
+class GribIdxEntry(pydantic.BaseModel):
+    """
+    A single GRIB2 message, as described in an index file
+    """
+    number: str
+    offset: int
+    date: str
+    variable: str
+    level: str
+    forecast: str
+    # Last byte of the message (inclusive), None for the last message of the file
+    end: int = None
+
+    @property
+    def byte_range(self) -> ByteRange:
+        return self.offset, self.end
+
+    def match(self, field: str) -> bool:
+        """
+        Check if this message matches a field, expressed as "<variable>" or "<variable>:<level>"
+        eg. "TMP", "TMP:850 mb", "UGRD:10 m above ground"
+
+        :param field:
+        :return:
+        """
+        variable, _, level = field.partition(":")
+        if variable != self.variable:
+            return False
+        return not level or level == self.level
+
+
+def parse_grib_idx(content: str) -> List[GribIdxEntry]:
+    """
+    Parse the content of a GRIB2 index file
+
+    :param content:
+    :return:
+    """
+    entries = []
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        parts = line.split(":")
+        entries.append(GribIdxEntry(
+            number=parts[0],
+            offset=int(parts[1]),
+            date=parts[2].replace("d=", ""),
+            variable=parts[3],
+            level=parts[4],
+            forecast=parts[5],
+        ))
+
+    # A message ends where the next one starts
+    # Sub-messages (eg. 2.1, 2.2) share the same offset, hence looking for the next greater offset
+    offsets = sorted({entry.offset for entry in entries})
+    next_offset = dict(zip(offsets, offsets[1:]))
+    for entry in entries:
+        if entry.offset in next_offset:
+            entry.end = next_offset[entry.offset] - 1
+
+    return entries
+
+
+def select_grib_idx_entries(entries: List[GribIdxEntry], fields: List[str]) -> List[GribIdxEntry]:
+    """
+    Keep messages matching at least one of the fields, without duplicated offsets
+
+    :param entries:
+    :param fields: eg. ["TMP:850 mb", "UGRD", "VGRD"]
+    :return:
+    """
+    selected = {}
+    for entry in entries:
+        if entry.offset not in selected and any(entry.match(field) for field in fields):
+            selected[entry.offset] = entry
+    return [selected[offset] for offset in sorted(selected)]
+
+
+def merge_byte_ranges(byte_ranges: List[ByteRange], max_gap: int = 0) -> List[ByteRange]:
+    """
+    Merge adjacent (or close enough) byte ranges, for making as few requests as possible
+
+    :param byte_ranges: inclusive ranges, end being None for "until end of file"
+    :param max_gap: merge ranges separated by at most `max_gap` bytes (they will be downloaded too !)
+    :return:
+    """
+    merged = []
+    for start, end in sorted(byte_ranges, key=lambda r: r[0]):
+        if merged:
+            previous_start, previous_end = merged[-1]
+            if previous_end is None:
+                continue
+            if start <= previous_end + 1 + max_gap:
+                if end is None or end > previous_end:
+                    merged[-1] = (previous_start, end)
+                continue
+        merged.append((start, end))
+    return merged
@@ -0,0 +1,342 @@
+"""
+Process-wide metrics of downloads, exportable in Prometheus text format
+
+Fetchers record how many files and bytes they download, how long it takes, and how often it fails.
+Metrics can be scraped from a local HTTP endpoint, or written to a file, eg. for node_exporter's textfile collector.
+
+Example of usage :
+
+    >>> from datafetch.utils.metrics import metrics
+    >>> server = metrics.start_http_server(port=9464)
+    >>> # Or, eg. at the end of a flow
+    >>> metrics.write_textfile("/var/lib/node_exporter/datafetch.prom")
+    >>> print(metrics.to_prometheus())
+    # HELP datafetch_downloaded_bytes_total Bytes downloaded
+    # TYPE datafetch_downloaded_bytes_total counter
+    datafetch_downloaded_bytes_total{protocol="s3",host="",bucket="noaa-gfs-bdp-pds"} 528491213.0
+    ...
+"""
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from small files to large NWP / reanalysis files
+DEFAULT_DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    """
+    Labels in Prometheus text format, eg. '{protocol="s3",bucket="plop"}'
+
+    :param labels:
+    :return:
+    """
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+    A metric, with one value per combination of label values
+    """
+    type_name: str = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def get_key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        """
+        Label values, in order of label names
+
+        :param labels:
+        :return:
+        :raise ValueError: if labels don't match label names
+        """
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} : expected labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def get(self, **labels) -> float:
+        """
+        Current value for some labels
+
+        :param labels:
+        :return:
+        """
+        with self._lock:
+            return self._values.get(self.get_key(labels), 0.)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        """
+        Samples to export : suffix of metric name, labels and value
+
+        :return:
+        """
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield "", dict(zip(self.labelnames, key)), value
+
+    def to_prometheus(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing value, eg. number of downloaded bytes
+    """
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError(f"{self.name} : counters can only increase")
+        key = self.get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.) + amount
+
+
+class Gauge(Metric):
+    """
+    Value going up and down, eg. number of downloads in progress
+    """
+    type_name = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self.get_key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    @contextmanager
+    def track_in_progress(self, **labels):
+        """
+        Increment while the context is running
+
+        :param labels:
+        :return:
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, eg. download durations, in cumulative buckets
+    """
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        if "le" in self.labelnames:
+            raise ValueError(f"{self.name} : 'le' is reserved for histogram buckets")
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self.get_key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.))
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def get(self, **labels) -> float:
+        """
+        Number of observations for some labels
+
+        :param labels:
+        :return:
+        """
+        with self._lock:
+            counts, _ = self._values.get(self.get_key(labels), ([0], 0.))
+            return counts[-1]
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe duration of the context, in seconds
+
+        :param labels:
+        :return:
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            values = [(key, (list(counts), total)) for key, (counts, total) in self._values.items()]
+        for key, (counts, total) in values:
+            labels = dict(zip(self.labelnames, key))
+            for upper_bound, count in zip(self.buckets, counts):
+                yield "_bucket", {**labels, 'le': format_value(upper_bound)}, count
+            yield "_sum", labels, total
+            yield "_count", labels, counts[-1]
+
+
+class MetricsRegistry:
+    """
+    Thread-safe set of metrics, exported together
+    """
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, metric_class: type, name: str, documentation: str,
+                       labelnames: Tuple[str, ...], **kwargs) -> Metric:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_class(name, documentation, labelnames, **kwargs)
+            metric = self._metrics[name]
+        if not isinstance(metric, metric_class) or metric.labelnames != tuple(labelnames):
+            raise ValueError(f"Metric {name} already registered as {metric.type_name} with labels {metric.labelnames}")
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_DURATION_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def get(self, name: str) -> Union[Metric, None]:
+        return self._metrics.get(name)
+
+    @property
+    def metrics(self) -> List[Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def clear(self):
+        """
+        Reset values of all metrics, eg. between tests
+
+        :return:
+        """
+        for metric in self.metrics:
+            metric.clear()
+
+    def to_prometheus(self) -> str:
+        """
+        All metrics, in Prometheus text exposition format
+
+        :return:
+        """
+        return "".join(f"{metric.to_prometheus()}\n" for metric in self.metrics)
+
+    def write_textfile(self, fp: Union[str, Path]):
+        """
+        Write metrics to a file, eg. for node_exporter's textfile collector
+
+        :param fp:
+        :return:
+        """
+        fp = Path(fp)
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so that collector never reads a partial file
+        fp_tmp = fp.with_name(f"{fp.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+        fp_tmp.write_text(self.to_prometheus())
+        fp_tmp.replace(fp)
+
+    def start_http_server(self, port: int = 9464, addr: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """
+        Serve metrics over HTTP, on any path, from a background thread
+
+        :param port: 0 for any free port, cf. `server.server_address`
+        :param addr: listening address, local only by default
+        :return: server, to stop with `server.shutdown()`
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                content = registry.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                logger.debug(f"Metrics endpoint : {format % args}")
+
+        server = ThreadingHTTPServer((addr, port), MetricsHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, name="datafetch-metrics", daemon=True)
+        thread.start()
+        logger.info(f"Serving metrics on http://{server.server_address[0]}:{server.server_address[1]}/metrics")
+        return server
+
+
+# Process-wide registry
+metrics = MetricsRegistry()
+
+# Labels identifying where files are downloaded from, eg. protocol "https" and host,
+# or protocol "s3" and bucket. Labels that don't apply are empty.
+REMOTE_LABELS = ("protocol", "host", "bucket")
+
+fetches_total = metrics.counter(
+    "datafetch_fetches_total", "Fetched files, by outcome : downloaded, unchanged, cached or failed",
+    REMOTE_LABELS + ("status",)
+)
+fetches_in_progress = metrics.gauge(
+    "datafetch_fetches_in_progress", "Files being downloaded", REMOTE_LABELS
+)
+fetch_duration_seconds = metrics.histogram(
+    "datafetch_fetch_duration_seconds", "Duration of file downloads, failed ones included", REMOTE_LABELS
+)
+downloaded_bytes_total = metrics.counter(
+    "datafetch_downloaded_bytes_total", "Bytes downloaded", REMOTE_LABELS
+)
+retries_total = metrics.counter(
+    "datafetch_retries_total", "Requests retried after a connection error or a server error", REMOTE_LABELS
+)
+s3_requests_total = metrics.counter(
+    "datafetch_s3_requests_total", "S3 API requests, by operation, eg. ListObjectsV2, HeadObject, GetObject",
+    ("bucket", "operation")
+)
@@ -0,0 +1,70 @@
+"""
+Retention of regularly downloaded runs, eg. NWP, and disk space checks before downloading a new one
+
+A run is kept if it is among the `keep_runs` most recent ones, or if it is less than `keep_days` days old.
+
+Example of usage :
+
+    >>> select_expired_runs([datetime(2021, 2, 1, 0), datetime(2021, 2, 1, 6), datetime(2021, 2, 1, 12)],
+                            keep_runs=2)
+    [datetime.datetime(2021, 2, 1, 0, 0)]
+"""
+import shutil
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Union
+
+
+class InsufficientDiskSpaceError(Exception):
+    """
+    Not enough free disk space for a download, even after evicting older runs
+    """
+
+
+def select_expired_runs(run_times: List[datetime], keep_runs: int = None, keep_days: float = None,
+                        now: datetime = None) -> List[datetime]:
+    """
+    Runs to remove according to retention policy, oldest first
+
+    :param run_times:
+    :param keep_runs: number of most recent runs to keep, None for no limit on number of runs
+    :param keep_days: age in days of runs to keep, None for no limit on age
+    :param now: reference time for age of runs, now by default
+    :return:
+    """
+    if keep_runs is None and keep_days is None:
+        return []
+    if now is None:
+        now = datetime.utcnow()
+
+    expired = []
+    for i, run_time in enumerate(sorted(run_times, reverse=True)):
+        if keep_runs is not None and i < keep_runs:
+            continue
+        if keep_days is not None and now - run_time < timedelta(days=keep_days):
+            continue
+        expired.append(run_time)
+    return expired[::-1]
+
+
+def get_free_space(path: Union[str, Path]) -> int:
+    """
+    Free disk space, in bytes, on the filesystem of `path`, which may not exist yet
+
+    :param path:
+    :return:
+    """
+    path = Path(path).absolute()
+    while not path.exists():
+        path = path.parent
+    return shutil.disk_usage(path).free
+
+
+def get_directory_size(path: Union[str, Path]) -> int:
+    """
+    Total size of files under a directory, in bytes
+
+    :param path:
+    :return:
+    """
+    return sum(fp.stat().st_size for fp in Path(path).rglob("*") if fp.is_file() and not fp.is_symlink())
@@ -1 +1,2 @@
 from .core import EcmwfEra5CDS, EcmwfEra5S3
+from .planner import LogicalRequest, PlannedRequest, plan_requests, find_planned_request, date_range
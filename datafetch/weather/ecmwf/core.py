@@ -8,6 +8,7 @@ import pydantic
 from datafetch.protocol import S3ApiBucket
 from datafetch.protocol.cds import ClimateDataStoreApi
 from datafetch.utils.db import DownloadRecord
+from .planner import PlannedRequest
 
 logger = logging.getLogger(__name__)
 
@@ -42,8 +43,7 @@ class EcmwfEra5S3(S3ApiBucket, pydantic.BaseModel):
         :return:
         """
         object_key = self.get_object_key(parameter_filename, year, month)
-        r = self.filter(Prefix=object_key).limit(count=1)
-        if len(list(r)) > 0:
+        if self.exists(object_key):
             logger.info(f"{object_key} is available")
             return True
         else:
@@ -164,6 +164,55 @@ class EcmwfEra5CDS(ClimateDataStoreApi, pydantic.BaseModel):
             fp_list.append((fp, param))
         return fp_list
 
+    def check_queue_and_download_pipelined(self, date_info: dict = None,
+                                           max_concurrent_downloads: int = 2,
+                                           **kwargs) -> List[Tuple[Union[Path, None], dict]]:
+        """
+        Same as `check_queue_and_download`, but downloading each result as soon as it is ready,
+        while other requests are still in queue
+
+        :param date_info:
+        :param max_concurrent_downloads:
+        :param kwargs: for poll_queue(), eg. timeout
+        :return:
+        """
+        resources = [
+            (name, self.update_param_with_date(param, date_info))
+            for name, param in self.cds_resources_list
+        ]
+        return self.download_pipelined(resources, destination_dir=self.destination_dir,
+                                       max_concurrent_downloads=max_concurrent_downloads, **kwargs)
+
+    def download_plan(self, planned: List[PlannedRequest], max_active: int = 10,
+                      max_concurrent_downloads: int = 2,
+                      **kwargs) -> List[Tuple[PlannedRequest, Union[Path, None]]]:
+        """
+        Submit planned requests (cf. datafetch.weather.ecmwf.planner) with at most `max_active` of them in queue,
+        and download each result as soon as it is ready
+
+        Example of usage :
+            >>> planned = plan_requests(LogicalRequest(...))
+            >>> for planned_request, fp in cds.download_plan(planned):
+            ...     print(planned_request.years, planned_request.months, fp)
+
+        :param planned:
+        :param max_active:
+        :param max_concurrent_downloads:
+        :param kwargs: for poll_queue()
+        :return: each planned request with its downloaded file, None if failed
+        """
+        resources = [(planned_request.name, planned_request.param) for planned_request in planned]
+        fp_list = self.download_pipelined(
+            resources, destination_dir=self.destination_dir,
+            max_concurrent_downloads=max_concurrent_downloads,
+            records=self.submit_window(resources, max_active=max_active, **kwargs),
+            destination_filenames={planned_request.key: planned_request.filename for planned_request in planned},
+        )
+        # Results are given once per distinct request
+        keys = list(dict.fromkeys(planned_request.key for planned_request in planned))
+        fp_by_key = {key: fp for key, (fp, _) in zip(keys, fp_list)}
+        return [(planned_request, fp_by_key[planned_request.key]) for planned_request in planned]
+
     @staticmethod
     def update_param_with_date(param: dict, date_info: dict = None) -> dict:
         """
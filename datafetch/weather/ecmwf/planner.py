@@ -0,0 +1,228 @@
+"""
+Plan CDS requests for ERA5 : split a logical request into right-sized CDS requests
+
+CDS rejects requests having too many fields, and each request has a significant queue overhead.
+A logical request (variables x levels x dates x times) is first cut by month, since ERA5 is archived by month,
+then small months are merged together, and months too large are split by variables, levels, days and times.
+
+Example of usage :
+
+    >>> request = LogicalRequest(
+            name='reanalysis-era5-pressure-levels',
+            variables=['temperature', 'geopotential'],
+            levels=['500', '850'],
+            dates=date_range(date(2020, 1, 1), date(2020, 12, 31)),
+            times=['00:00', '12:00'],
+            extra={'product_type': 'reanalysis', 'format': 'grib'}
+        )
+    >>> planned = plan_requests(request, max_fields=120000)
+    >>> find_planned_request(planned, 'temperature', date(2020, 5, 3), level='850')
+    PlannedRequest(name='reanalysis-era5-pressure-levels', ...)
+"""
+import calendar
+import math
+from datetime import date, timedelta
+from itertools import groupby
+from typing import List, Union
+
+import pydantic
+
+from datafetch.protocol.cds import ClimateDataStoreApi
+
+# Maximum number of fields in a single ERA5 request
+# cf. https://confluence.ecmwf.int/display/CKB/Climate+Data+Store+%28CDS%29+documentation
+ERA5_MAX_FIELDS = 120000
+
+ALL_DAYS = tuple(range(1, 32))
+
+
+class LogicalRequest(pydantic.BaseModel):
+    """
+    What we want from a CDS dataset, regardless of CDS limits
+    """
+    name: str
+    variables: List[str]
+    dates: List[date]
+    times: List[str] = [f"{hour:02d}:00" for hour in range(24)]
+    # Pressure levels, None for single level datasets
+    levels: List[str] = None
+    # Other CDS parameters, eg. product_type, format, area
+    extra: dict = {}
+
+
+class PlannedRequest(pydantic.BaseModel):
+    """
+    A single CDS request, covering the cartesian product of its variables, levels, years, months, days and times
+    """
+    name: str
+    variables: List[str]
+    levels: List[str] = None
+    years: List[int]
+    months: List[int]
+    days: List[int]
+    times: List[str]
+    extra: dict = {}
+
+    @property
+    def param(self) -> dict:
+        """
+        CDS request parameters
+
+        :return:
+        """
+        param = dict(self.extra)
+        param['variable'] = self.variables
+        if self.levels is not None:
+            param['pressure_level'] = self.levels
+        param['year'] = [str(year) for year in self.years]
+        param['month'] = [f"{month:02d}" for month in self.months]
+        param['day'] = [f"{day:02d}" for day in self.days]
+        param['time'] = self.times
+        return param
+
+    @property
+    def key(self) -> str:
+        """
+        Key of this request in download database
+
+        :return:
+        """
+        return ClimateDataStoreApi.get_resource_key(self.name, self.param)
+
+    @property
+    def filename(self) -> str:
+        """
+        A unique filename for the result of this request
+
+        :return:
+        """
+        extension = {'grib': "grib", 'netcdf': "nc"}.get(self.extra.get('format'), "data")
+        return f"{self.name}.{self.key.split(':')[-1]}.{extension}"
+
+    @property
+    def nb_fields(self) -> int:
+        """
+        Number of fields, counting dates that don't exist (eg. 31/02) which are ignored by CDS
+
+        :return:
+        """
+        return len(self.variables) * len(self.levels or [None]) * \
+            len(self.years) * len(self.months) * len(self.days) * len(self.times)
+
+    def covers(self, variable: str, day: date, level: str = None, time: str = None) -> bool:
+        """
+        Check if a field is part of this request
+
+        :param variable:
+        :param day:
+        :param level:
+        :param time:
+        :return:
+        """
+        return variable in self.variables \
+            and (level is None or self.levels is None or level in self.levels) \
+            and day.year in self.years and day.month in self.months and day.day in self.days \
+            and (time is None or time in self.times)
+
+
+def date_range(start: date, end: date) -> List[date]:
+    """
+    Every day from start to end, both included
+
+    :param start:
+    :param end:
+    :return:
+    """
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+
+def plan_requests(request: LogicalRequest, max_fields: int = ERA5_MAX_FIELDS) -> List[PlannedRequest]:
+    """
+    Split and merge a logical request into CDS requests of at most `max_fields` fields
+
+    :param request:
+    :param max_fields:
+    :return:
+    """
+    planned = []
+    for unit in _merge_months(request, max_fields):
+        planned.extend(_split(unit, max_fields))
+    return planned
+
+
+def find_planned_request(planned: List[PlannedRequest], variable: str, day: date,
+                         level: str = None, time: str = None) -> Union[PlannedRequest, None]:
+    """
+    Find which planned request contains a particular field
+
+    :param planned:
+    :param variable:
+    :param day:
+    :param level:
+    :param time:
+    :return:
+    """
+    for planned_request in planned:
+        if planned_request.covers(variable, day, level=level, time=time):
+            return planned_request
+    return None
+
+
+def _merge_months(request: LogicalRequest, max_fields: int) -> List[PlannedRequest]:
+    """
+    One request per month, merged with the previous one when it forms a cartesian product and stays small enough
+
+    :param request:
+    :param max_fields:
+    :return:
+    """
+    units = []
+    for (year, month), dates in groupby(sorted(set(request.dates)), key=lambda d: (d.year, d.month)):
+        days = tuple(d.day for d in dates)
+        # Full months share the same day list, so that they can be merged
+        if len(days) == calendar.monthrange(year, month)[1]:
+            days = ALL_DAYS
+        unit = PlannedRequest(
+            name=request.name, variables=request.variables, levels=request.levels,
+            years=[year], months=[month], days=list(days), times=request.times, extra=request.extra
+        )
+
+        if units:
+            previous = units[-1]
+            merged = None
+            if previous.days == unit.days and previous.years == unit.years:
+                merged = previous.copy(update={'months': previous.months + unit.months})
+            elif previous.days == unit.days and previous.months == unit.months:
+                merged = previous.copy(update={'years': previous.years + unit.years})
+            if merged is not None and merged.nb_fields <= max_fields:
+                units[-1] = merged
+                continue
+        units.append(unit)
+
+    return units
+
+
+def _split(unit: PlannedRequest, max_fields: int) -> List[PlannedRequest]:
+    """
+    Split a request along variables, then levels, days and times, until it is small enough
+
+    :param unit:
+    :param max_fields:
+    :return:
+    """
+    if unit.nb_fields <= max_fields:
+        return [unit]
+
+    for axis in ('variables', 'levels', 'days', 'times'):
+        values = getattr(unit, axis)
+        if values is None or len(values) < 2:
+            continue
+        nb_chunks = min(len(values), math.ceil(unit.nb_fields / max_fields))
+        chunk_size = math.ceil(len(values) / nb_chunks)
+        split = []
+        for i in range(0, len(values), chunk_size):
+            split.extend(_split(unit.copy(update={axis: values[i:i + chunk_size]}), max_fields))
+        return split
+
+    # A single field can't be split anymore
+    return [unit]
@@ -15,6 +15,8 @@ class MeteoFranceObservationFetch(SimpleHttpFetch, pydantic.BaseModel):
     Download MeteoFrance Observation from public dataset
     """
     base_url = "https://donneespubliques.meteofrance.fr/donnees_libres/"
+    # Scheduled runs often get the same csv again, skip it when unchanged
+    conditional_fetch = True
 
     observation_type_url_suffix = {
         'synop': 'Txt/Synop'
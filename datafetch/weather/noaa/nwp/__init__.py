@@ -1,2 +1,2 @@
 from .core import S3Nwp, NoaaGfsS3
-from .flows import create_flow_download
+from .flows import create_flow_download, create_flow_watch
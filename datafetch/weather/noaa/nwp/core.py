@@ -1,13 +1,25 @@
 """
 Core functionalities of downloading weather data from public AWS dataset, in particular NWP data
 """
+import hashlib
 import logging
-from datetime import datetime
-from typing import Union
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+from pathlib import Path, PurePosixPath
+from typing import Iterable, Iterator, List, Tuple, Union
 
+import botocore.exceptions
 import pydantic
+import requests
 
 from datafetch.protocol import S3ApiBucket
+from datafetch.utils.availability import compute_expected_availability, next_poll_delay
+from datafetch.utils.grib import GribIdxEntry, parse_grib_idx, select_grib_idx_entries, merge_byte_ranges
+from datafetch.utils.retention import InsufficientDiskSpaceError, select_expired_runs, get_free_space, \
+    get_directory_size
 
 
 logger = logging.getLogger(__name__)
@@ -40,12 +52,46 @@ class S3Nwp(S3ApiBucket, pydantic.BaseModel):
         """
         raise NotImplementedError
 
-    def check_run_availability(self, date_day: str = None, run: str = 0) -> Union[dict, None]:
+    def get_run_time(self, date_day: str, run: str) -> datetime:
+        """
+        Reference time of a run
+
+        :param date_day:
+        :param run:
+        :return:
+        """
+        return datetime.strptime(date_day, "%Y%m%d") + timedelta(hours=int(run))
+
+    def record_availability(self, date_day: str, run: str, timesteps: Iterable[str], available_keys: Iterable[str]):
+        """
+        Keep track of when timesteps are published, if download database is enabled
+
+        cf. `watch_run()`, whose polling is scheduled from these observations
+
+        :param date_day:
+        :param run:
+        :param timesteps: observed timesteps
+        :param available_keys: keys found on bucket
+        :return:
+        """
+        if not self.use_download_db:
+            return
+        self.db_record_availability(
+            product=self.bucket_name,
+            run_time=self.get_run_time(date_day, run),
+            timesteps={self.get_timestep_key(date_day=date_day, run=run, timestep=timestep): str(timestep).zfill(3)
+                       for timestep in timesteps},
+            available_keys=available_keys
+        )
+
+    def check_run_availability(self, date_day: str = None, run: str = 0,
+                               refresh: bool = False) -> Union[dict, None]:
         """
         Check if a particular run is available
 
         :param date_day:
         :param run:
+        :param refresh: ignore cached listing of the run, cf. `use_listing_cache`
         :return:
         """
         if date_day is None:
@@ -54,28 +100,39 @@ class S3Nwp(S3ApiBucket, pydantic.BaseModel):
         daterun_prefix = self.get_daterun_prefix(date_day, run)
         logger.info(f"{date_day} / {run} : Checking run availability, prefix {daterun_prefix} ...")
 
-        r = self.filter(Prefix=daterun_prefix).limit(count=1)
-        if len(list(r)) > 0:
+        if self.use_listing_cache:
+            # Listing the whole run also warms up the cache for timestep checks
+            available = len(self.list_keys(daterun_prefix, refresh=refresh)) > 0
+        else:
+            available = len(list(self.filter(Prefix=daterun_prefix).limit(count=1))) > 0
+        if available:
             logger.info(f"{date_day} / {run} : Run is available !")
             return {'date_day': date_day, 'run': run}
         else:
             logger.warning(f"Run {date_day} / {run} is not yet available")
             return None
 
-    def check_timestep_availability(self, date_day: str, run: str, timestep: str) -> Union[dict, None]:
+    def check_timestep_availability(self, date_day: str, run: str, timestep: str,
+                                    refresh: bool = False) -> Union[dict, None]:
         """
         Check if a particular timestep is available
 
         :param date_day:
         :param run:
         :param timestep:
+        :param refresh: ignore cached listing of the run, cf. `use_listing_cache`
         :return:
         """
         timestep_key = self.get_timestep_key(date_day=date_day, run=run, timestep=timestep)
         logger.info(f"{date_day} / {run} / {timestep} : Checking timestep availability, key {timestep_key} ...")
 
-        r = self.filter(Prefix=timestep_key)
-        if len(list(r)) > 0:
+        if self.use_listing_cache:
+            available = timestep_key in self.list_keys(self.get_daterun_prefix(date_day, run), refresh=refresh)
+        else:
+            # A HEAD request on the exact key is cheaper than listing by prefix, which also matches `.idx`
+            available = self.exists(timestep_key)
+        self.record_availability(date_day, run, [timestep], [timestep_key] if available else [])
+        if available:
             logger.info(f"{date_day} / {run} / {timestep} : Timestep available !")
             return {'date_day': date_day, 'run': run, 'timestep': timestep}
         else:
@@ -102,6 +159,372 @@ class S3Nwp(S3ApiBucket, pydantic.BaseModel):
         else:
             return None
 
+    def watch_run(self, date_day: str, run: str, timesteps: List[str], download_dir: str,
+                  poll_interval: float = 30, timeout: float = None,
+                  max_concurrent_downloads: int = 4, max_retries: int = 3,
+                  max_poll_interval: float = None) -> Iterator[dict]:
+        """
+        Watch a run being published, and download each timestep as soon as it appears
+
+        The whole run is listed every `poll_interval` seconds, and keys that were not in the previous listing
+        are immediately submitted to a pool of downloads. Watching stops when every timestep is downloaded,
+        or after `timeout` seconds. Failed listings and downloads are tried again on next poll.
+
+        With download database enabled, publication times of previous runs are recorded, and listing can be
+        scheduled from them : every `poll_interval` seconds around expected publication of missing timesteps,
+        and up to every `max_poll_interval` seconds when none is expected soon.
+
+        Example of usage :
+            >>> for r in s3api.watch_run("20210201", "00", timesteps=range(0, 385, 3), download_dir="/tmp/"):
+                    print(r)
+            {'date_day': '20210201', 'run': '00', 'timestep': 0, 'fp': '/tmp/gfs.20210201/00/gfs.t00z.pgrb2.0p25.f000'}
+            ...
+
+        :param date_day:
+        :param run:
+        :param timesteps:
+        :param download_dir:
+        :param poll_interval: seconds between two listings of the run
+        :param timeout: maximum watching time in seconds, None for no limit
+        :param max_concurrent_downloads:
+        :param max_retries: number of retries of a failed download, on next polls
+        :param max_poll_interval: maximum seconds between two listings, None for polling uniformly
+        :return: downloaded timesteps, in order of completion, with 'fp' None if download failed
+        """
+        daterun_prefix = self.get_daterun_prefix(date_day, run)
+        expected = {self.get_timestep_key(date_day=date_day, run=run, timestep=timestep): timestep
+                    for timestep in timesteps}
+        logger.info(f"{date_day} / {run} : Watching {len(expected)} timesteps, prefix {daterun_prefix} ...")
+        expected_availability = self.get_expected_availability() if max_poll_interval is not None else {}
+
+        previous_keys = set()
+        to_download = set()
+        nb_done = 0
+        nb_failures = {}
+        pending = {}
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max_concurrent_downloads) as executor:
+            while True:
+                keys = self.list_run_keys(date_day, run, expected.values())
+                if keys is None:
+                    # Listing failed, tried again on next poll
+                    keys = previous_keys
+                to_download |= (keys - previous_keys) & expected.keys()
+                previous_keys = keys
+
+                for key in sorted(to_download, key=list(expected).index):
+                    logger.info(f"{date_day} / {run} / {expected[key]} : Timestep available, downloading ...")
+                    future = executor.submit(self.download_timestep, date_day, run, expected[key], download_dir)
+                    pending[future] = key
+                to_download.clear()
+
+                if nb_done + len(pending) == len(expected):
+                    # Everything is published, only waiting for downloads
+                    next_poll = None
+                elif timeout is not None and time.monotonic() - started > timeout:
+                    missing = [expected[key] for key in expected if key not in keys]
+                    logger.warning(f"{date_day} / {run} : Timeout, stopped watching timesteps {missing}")
+                    next_poll = None
+                else:
+                    missing = [timestep for key, timestep in expected.items() if key not in keys]
+                    next_poll = time.monotonic() + self.get_poll_delay(
+                        date_day, run, missing, expected_availability, poll_interval, max_poll_interval)
+
+                # Report downloads while waiting for next poll
+                while pending and (next_poll is None or time.monotonic() < next_poll):
+                    for key, r in self.wait_downloads(pending, next_poll):
+                        if r is None and nb_failures.get(key, 0) < max_retries:
+                            nb_failures[key] = nb_failures.get(key, 0) + 1
+                            logger.warning(f"{date_day} / {run} / {expected[key]} : Download failed, "
+                                           f"retrying on next poll ...")
+                            to_download.add(key)
+                            # Polling may have stopped, failed downloads being then retried after `poll_interval`
+                            next_poll = next_poll or time.monotonic() + poll_interval
+                            continue
+                        nb_done += 1
+                        yield {'date_day': date_day, 'run': run, 'timestep': expected[key],
+                               'fp': r['fp'] if r else None}
+
+                if next_poll is None:
+                    return
+                time.sleep(max(0., next_poll - time.monotonic()))
+
+    def list_run_keys(self, date_day: str, run: str, timesteps: Iterable[str]) -> Union[set, None]:
+        """
+        Keys currently published for a run, recording availability of timesteps, cf. `watch_run()`
+
+        :param date_day:
+        :param run:
+        :param timesteps: observed timesteps
+        :return: None if listing failed
+        """
+        try:
+            keys = set(self.list_keys(self.get_daterun_prefix(date_day, run), refresh=True))
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, requests.RequestException) as exc:
+            logger.warning(f"{date_day} / {run} : Unable to list run, {exc}")
+            return None
+        self.record_availability(date_day, run, timesteps, keys)
+        return keys
+
+    def get_expected_availability(self) -> dict:
+        """
+        Expected publication offset of each timestep, from previous runs recorded in download database
+
+        :return: {timestep: seconds after run time}, empty if download database is disabled
+        """
+        if not self.use_download_db:
+            return {}
+        expected_availability = compute_expected_availability(self.db_get_availability_offsets(self.bucket_name))
+        logger.debug(f"Expected availability known for {len(expected_availability)} timesteps")
+        return expected_availability
+
+    def get_poll_delay(self, date_day: str, run: str, missing: List[str], expected_availability: dict,
+                       poll_interval: float, max_poll_interval: float = None) -> float:
+        """
+        Seconds until next listing of a run, cf. `watch_run()`
+
+        :param date_day:
+        :param run:
+        :param missing: timesteps not yet published
+        :param expected_availability: cf. `get_expected_availability()`
+        :param poll_interval:
+        :param max_poll_interval:
+        :return:
+        """
+        if not expected_availability:
+            return poll_interval
+        delay = next_poll_delay(
+            (datetime.utcnow() - self.get_run_time(date_day, run)).total_seconds(),
+            [expected_availability.get(str(timestep).zfill(3)) for timestep in missing],
+            min_interval=poll_interval, max_interval=max_poll_interval
+        )
+        logger.debug(f"{date_day} / {run} : Next poll in {delay:.0f}s")
+        return delay
+
+    @staticmethod
+    def wait_downloads(pending: dict, until: float = None) -> List[Tuple[str, dict]]:
+        """
+        Wait for at least one pending download to complete, or until a time
+
+        :param pending: {future: key}, completed downloads being removed
+        :param until: time.monotonic() deadline, None for no limit
+        :return: key and result of completed downloads
+        """
+        remaining = None if until is None else max(0., until - time.monotonic())
+        done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        return [(pending.pop(future), future.result()) for future in done]
+
+    def get_daterun_dir(self, date_day: str, run: str) -> str:
+        """
+        Directory of a run, relative to download directory, eg. "gfs.{date_day}/{run}"
+
+        :param date_day:
+        :param run:
+        :return:
+        """
+        return str(PurePosixPath(self.get_daterun_prefix(date_day, run)).parent)
+
+    def parse_daterun_dir(self, daterun_dir: str) -> Union[Tuple[str, str], None]:
+        """
+        Date day and run of a run directory, cf. `get_daterun_dir()`
+
+        :param daterun_dir: relative to download directory
+        :return: None if it isn't a run directory
+        """
+        raise NotImplementedError
+
+    def list_downloaded_runs(self, download_dir: str) -> List[Tuple[datetime, Path]]:
+        """
+        Runs found in a download directory, most recent first
+
+        :param download_dir:
+        :return: run time and directory of each run
+        """
+        depth = len(PurePosixPath(self.get_daterun_dir("20000101", "00")).parts)
+        runs = []
+        for run_dir in Path(download_dir).glob("/".join(["*"] * depth)):
+            daterun = self.parse_daterun_dir(run_dir.relative_to(download_dir).as_posix())
+            if run_dir.is_dir() and daterun is not None:
+                runs.append((self.get_run_time(*daterun), run_dir))
+        return sorted(runs, reverse=True)
+
+    def remove_runs(self, run_dirs: List[Path]):
+        """
+        Remove downloaded runs, and their records in download database if enabled
+
+        :param run_dirs:
+        :return:
+        """
+        for run_dir in run_dirs:
+            logger.info(f"Removing run {run_dir} ...")
+            shutil.rmtree(run_dir, ignore_errors=True)
+        if self.use_download_db and run_dirs:
+            with self:
+                self.db_delete_records_under(run_dirs)
+
+    def prune_runs(self, download_dir: str, keep_runs: int = None, keep_days: float = None,
+                   dry_run: bool = False) -> List[Path]:
+        """
+        Remove runs beyond retention : those which are neither among the `keep_runs` most recent ones,
+        nor less than `keep_days` days old
+
+        Example of usage :
+            >>> s3api.prune_runs("/data/gfs", keep_runs=8)
+            [PosixPath('/data/gfs/gfs.20210130/00'), PosixPath('/data/gfs/gfs.20210130/06')]
+
+        :param download_dir:
+        :param keep_runs:
+        :param keep_days:
+        :param dry_run: only return runs that would be removed
+        :return: removed run directories, oldest first
+        """
+        runs = dict(self.list_downloaded_runs(download_dir))
+        expired = [runs[run_time] for run_time in select_expired_runs(list(runs), keep_runs, keep_days)]
+        if not dry_run:
+            self.remove_runs(expired)
+        return expired
+
+    def get_run_download_size(self, date_day: str, run: str, timesteps: Iterable[str], download_dir: str) -> int:
+        """
+        Bytes still to download for some timesteps of a run, from its listing
+
+        Sizes of timesteps not published yet are estimated from the most recent run already downloaded
+
+        :param date_day:
+        :param run:
+        :param timesteps:
+        :param download_dir:
+        :return:
+        """
+        sizes = self.list_keys(self.get_daterun_prefix(date_day, run))
+        previous_runs = [(run_time, run_dir) for run_time, run_dir in self.list_downloaded_runs(download_dir)
+                         if run_time != self.get_run_time(date_day, run)]
+
+        size = 0
+        for timestep in timesteps:
+            timestep_key = self.get_timestep_key(date_day=date_day, run=run, timestep=timestep)
+            if (Path(download_dir) / timestep_key).is_file():
+                continue
+            if timestep_key in sizes:
+                size += sizes[timestep_key]
+            elif previous_runs:
+                previous_run_time, _ = previous_runs[0]
+                previous_fp = Path(download_dir) / self.get_timestep_key(
+                    date_day=previous_run_time.strftime("%Y%m%d"), run=previous_run_time.strftime("%H"),
+                    timestep=timestep
+                )
+                if previous_fp.is_file():
+                    size += previous_fp.stat().st_size
+        return size
+
+    def ensure_disk_space(self, date_day: str, run: str, timesteps: Iterable[str], download_dir: str,
+                          min_free_space: int = 0, evict: bool = False) -> int:
+        """
+        Check that timesteps of a run can be downloaded without filling the disk,
+        so that a run is refused instead of failing in the middle of its download
+
+        :param date_day:
+        :param run:
+        :param timesteps:
+        :param download_dir:
+        :param min_free_space: bytes that must remain free after download
+        :param evict: remove oldest runs, other than this one, until there is enough space
+        :return: bytes to download
+        :raise InsufficientDiskSpaceError:
+        """
+        size = self.get_run_download_size(date_day, run, timesteps, download_dir)
+        free_space = get_free_space(download_dir)
+        logger.info(f"{date_day} / {run} : {size / 1024 ** 2:.1f} MiB to download, "
+                    f"{free_space / 1024 ** 2:.1f} MiB free in {download_dir}")
+
+        if evict and free_space - size < min_free_space:
+            current_dir = (Path(download_dir) / self.get_daterun_dir(date_day, run)).absolute()
+            for _, run_dir in reversed(self.list_downloaded_runs(download_dir)):
+                if free_space - size >= min_free_space:
+                    break
+                if run_dir.absolute() == current_dir:
+                    continue
+                logger.warning(f"{date_day} / {run} : Not enough disk space, evicting run {run_dir} "
+                               f"({get_directory_size(run_dir) / 1024 ** 2:.1f} MiB)")
+                self.remove_runs([run_dir])
+                free_space = get_free_space(download_dir)
+
+        if free_space - size < min_free_space:
+            raise InsufficientDiskSpaceError(
+                f"{date_day} / {run} : {size} bytes to download, only {free_space} bytes free in {download_dir}, "
+                f"{min_free_space} bytes must remain free"
+            )
+        return size
+
+    def get_index_key(self, date_day: str, run: str, timestep: str) -> str:
+        """
+        Key of the GRIB2 index file (.idx) for a specific timestep
+
+        :param date_day:
+        :param run:
+        :param timestep:
+        :return:
+        """
+        return self.get_timestep_key(date_day=date_day, run=run, timestep=timestep) + ".idx"
+
+    def get_timestep_index(self, date_day: str, run: str, timestep: str) -> List[GribIdxEntry]:
+        """
+        Fetch and parse GRIB2 index for a specific timestep
+
+        :param date_day:
+        :param run:
+        :param timestep:
+        :return:
+        """
+        index_key = self.get_index_key(date_day=date_day, run=run, timestep=timestep)
+        logger.debug(f"{date_day} / {run} / {timestep} : Reading index {index_key} ...")
+        return parse_grib_idx(self.get_object_bytes(index_key).decode())
+
+    def download_timestep_subset(self, date_day: str, run: str, timestep: str,
+                                 fields: List[str], download_dir: str,
+                                 max_gap: int = 0) -> Union[dict, None]:
+        """
+        Download only some GRIB2 messages of a particular timestep, using its index file
+
+        Example of usage :
+            >>> s3api.download_timestep_subset(
+                    "20210201", "00", "003",
+                    fields=["TMP:850 mb", "UGRD:10 m above ground", "VGRD:10 m above ground"],
+                    download_dir="/tmp/"
+                )
+            {'fp': '/tmp/gfs.20210201/00/gfs.t00z.pgrb2.0p25.f003.subset-5e2b7c1f4a'}
+
+        :param date_day:
+        :param run:
+        :param timestep:
+        :param fields: "<variable>" or "<variable>:<level>", as written in index file
+        :param download_dir:
+        :param max_gap: merge byte ranges separated by at most `max_gap` bytes
+        :return:
+        """
+        entries = select_grib_idx_entries(self.get_timestep_index(date_day, run, timestep), fields)
+        if not entries:
+            logger.error(f"{date_day} / {run} / {timestep} : No message matching {fields}")
+            return None
+
+        byte_ranges = merge_byte_ranges([entry.byte_range for entry in entries], max_gap=max_gap)
+        logger.info(f"{date_day} / {run} / {timestep} : Downloading {len(entries)} messages "
+                    f"in {len(byte_ranges)} requests to {download_dir} ...")
+
+        object_key = self.get_timestep_key(date_day=date_day, run=run, timestep=timestep)
+        fields_digest = hashlib.sha1("\n".join(sorted(fields)).encode()).hexdigest()[:10]
+        fp = self.fetch(
+            object_key=object_key,
+            destination_dir=download_dir,
+            destination_filename=f"{object_key}.subset-{fields_digest}",
+            record_key=f"{object_key}?subset={fields_digest}",
+            byte_ranges=byte_ranges
+        )
+        if fp:
+            return {'fp': str(fp.absolute())}
+        else:
+            return None
+
 
 class NoaaGfsS3(S3Nwp, pydantic.BaseModel):
     """
@@ -121,3 +544,7 @@ class NoaaGfsS3(S3Nwp, pydantic.BaseModel):
         run = str(run).zfill(2)
         timestep = str(timestep).zfill(3)
         return f"gfs.{date_day}/{run}/gfs.t{run}z.pgrb2.0p25.f{timestep}"
+
+    def parse_daterun_dir(self, daterun_dir: str) -> Union[Tuple[str, str], None]:
+        match = re.fullmatch(r"gfs\.(\d{8})/(\d{2})", daterun_dir)
+        return match.groups() if match else None
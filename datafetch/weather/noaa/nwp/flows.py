@@ -6,6 +6,11 @@ Example of usage :
     >>> flow_download = create_flow_download()
     >>> flow_download.run()
 
+    >>> # Or, for downloading timesteps as soon as they are published
+    >>> from datafetch.weather.noaa.nwp.flows import create_flow_watch
+    >>> flow_watch = create_flow_watch(timesteps=range(0, 121, 3))
+    >>> flow_watch.run()
+
 """
 import datetime
 
@@ -18,6 +23,8 @@ from prefect.schedules import Schedule
 from prefect.schedules.clocks import CronClock
 from prefect.tasks.prefect import StartFlowRun
 
+from datafetch.utils.retention import InsufficientDiskSpaceError
+
 from .core import NoaaGfsS3
 
 
@@ -37,7 +44,8 @@ def check_run_availability(run: Parameter, date_day: Parameter = None):
         date_day = prefect.context.scheduled_start_time.strftime("%Y%m%d")
 
     s3api = NoaaGfsS3()
-    r = s3api.check_run_availability(date_day, str(run))
+    # On retries, the run has to be listed again
+    r = s3api.check_run_availability(date_day, str(run), refresh=prefect.context.get('task_run_count', 1) > 1)
     if not r:
         raise signals.FAIL(f"Run {date_day} / {run} is not yet available")
     return r
@@ -55,7 +63,8 @@ def check_timestep_availability(daterun_info: dict, timestep: str):
     :return:
     """
     s3api = NoaaGfsS3()
-    r = s3api.check_timestep_availability(timestep=timestep, **daterun_info)
+    r = s3api.check_timestep_availability(timestep=timestep, **daterun_info,
+                                          refresh=prefect.context.get('task_run_count', 1) > 1)
     if not r:
         raise signals.FAIL(f"Timestep {timestep} not yet available")
     return r
@@ -77,6 +86,83 @@ def download_timestep(timestep_info: dict, download_dir: str) -> dict:
     return r
 
 
+@prefect.task
+def prepare_disk_space(daterun_info: dict, timesteps: list, download_dir: str,
+                       keep_runs: int = None, keep_days: float = None,
+                       min_free_space: int = 0, evict: bool = False, db_dir: str = None) -> int:
+    """
+    Remove runs beyond retention, then check there is enough disk space for downloading a run
+
+    :param daterun_info:
+    :param timesteps:
+    :param download_dir:
+    :param keep_runs: number of most recent runs to keep, None for no limit
+    :param keep_days: age in days of runs to keep, None for no limit
+    :param min_free_space: bytes that must remain free after download
+    :param evict: remove oldest runs if there is not enough space, instead of failing
+    :param db_dir: directory of download database, whose records of removed runs are deleted
+    :return: bytes to download
+    """
+    if db_dir is None:
+        s3api = NoaaGfsS3()
+    else:
+        s3api = NoaaGfsS3(use_download_db=True, db_dir=db_dir)
+    s3api.prune_runs(download_dir, keep_runs=keep_runs, keep_days=keep_days)
+    try:
+        return s3api.ensure_disk_space(timesteps=timesteps, download_dir=download_dir,
+                                       min_free_space=min_free_space, evict=evict, **daterun_info)
+    except InsufficientDiskSpaceError as exc:
+        raise signals.FAIL(str(exc))
+
+
+@prefect.task
+def watch_run(run: Parameter, date_day: Parameter, timesteps: list, download_dir: str,
+              poll_interval: float, timeout: float, max_concurrent_download: int,
+              max_poll_interval: float = None, db_dir: str = None,
+              keep_runs: int = None, keep_days: float = None, min_free_space: int = 0, evict: bool = False) -> list:
+    """
+    Watch a GFS run, downloading each timestep as soon as it is published
+
+    :param run:
+    :param date_day:
+    :param timesteps:
+    :param download_dir:
+    :param poll_interval:
+    :param timeout:
+    :param max_concurrent_download:
+    :param max_poll_interval:
+    :param db_dir: directory of download database, which also records publication times
+    :param keep_runs: cf. `prepare_disk_space`
+    :param keep_days:
+    :param min_free_space:
+    :param evict:
+    :return:
+    """
+    if date_day is None:
+        date_day = prefect.context.scheduled_start_time.strftime("%Y%m%d")
+
+    # Run is usually not published yet, its size is estimated from previous runs
+    prepare_disk_space.run(
+        {'date_day': date_day, 'run': str(run)}, timesteps=timesteps, download_dir=download_dir,
+        keep_runs=keep_runs, keep_days=keep_days, min_free_space=min_free_space, evict=evict, db_dir=db_dir
+    )
+
+    if db_dir is None:
+        s3api = NoaaGfsS3()
+    else:
+        s3api = NoaaGfsS3(use_download_db=True, db_dir=db_dir)
+    r = list(s3api.watch_run(
+        date_day, str(run), timesteps=timesteps, download_dir=download_dir,
+        poll_interval=poll_interval, timeout=timeout, max_concurrent_downloads=max_concurrent_download,
+        max_poll_interval=max_poll_interval
+    ))
+    failed = [timestep_info['timestep'] for timestep_info in r if timestep_info['fp'] is None]
+    if len(r) < len(timesteps) or failed:
+        raise signals.FAIL(f"Run {date_day} / {run} : {len(timesteps) - len(r) + len(failed)} "
+                           f"timesteps not downloaded")
+    return r
+
+
 #######################################################
 
 
@@ -86,7 +172,11 @@ def create_flow_download(
         timesteps: list = None,
         max_concurrent_download: int = 5,
         download_dir: str = '/tmp/plop',
-        post_flowrun: StartFlowRun = None) -> prefect.Flow:
+        post_flowrun: StartFlowRun = None,
+        keep_runs: int = None,
+        keep_days: float = None,
+        min_free_space: int = 0,
+        evict: bool = False) -> prefect.Flow:
     """
     Create a prefect flow for downloading GFS
     with some configuration option
@@ -97,6 +187,10 @@ def create_flow_download(
     :param max_concurrent_download:
     :param download_dir:
     :param post_flowrun:
+    :param keep_runs: number of most recent runs kept in `download_dir`, None for no limit
+    :param keep_days: age in days of runs kept in `download_dir`, None for no limit
+    :param min_free_space: bytes that must remain free after downloading a run, which is refused otherwise
+    :param evict: remove oldest runs if there is not enough disk space, instead of refusing the run
     :return:
     """
     if not timesteps:
@@ -113,6 +207,10 @@ def create_flow_download(
         date_day = prefect.Parameter("date_day", default=None)
 
         daterun_avail = check_run_availability(run=param_run, date_day=date_day)
+        disk_space = prepare_disk_space(
+            daterun_info=daterun_avail, timesteps=timesteps, download_dir=download_dir,
+            keep_runs=keep_runs, keep_days=keep_days, min_free_space=min_free_space, evict=evict
+        )
 
         for timestep in timesteps:
             timestep_avail = check_timestep_availability(
@@ -122,7 +220,8 @@ def create_flow_download(
             fp = download_timestep(
                 timestep_info=timestep_avail,
                 download_dir=download_dir,
-                task_args={'name': f'timestep_{timestep}_download'}
+                task_args={'name': f'timestep_{timestep}_download'},
+                upstream_tasks=[disk_space]
             )
 
             if post_flowrun is not None:
@@ -144,3 +243,64 @@ def create_flow_download(
     prefect.utilities.logging._create_logger("datafetch")
 
     return flow_download
+
+
+def create_flow_watch(
+        flow_name: str = "aws-gfs-watch",
+        run: int = 0,
+        timesteps: list = None,
+        max_concurrent_download: int = 5,
+        download_dir: str = '/tmp/plop',
+        poll_interval: float = 30,
+        timeout: float = 6 * 3600,
+        max_poll_interval: float = 600,
+        db_dir: str = None,
+        keep_runs: int = None,
+        keep_days: float = None,
+        min_free_space: int = 0,
+        evict: bool = False) -> prefect.Flow:
+    """
+    Create a prefect flow watching a GFS run, for downloading timesteps as soon as they are published
+
+    Contrary to `create_flow_download`, there are no retries of availability checks :
+    a single task lists the run every `poll_interval` seconds until every timestep is downloaded
+
+    :param flow_name:
+    :param run:
+    :param timesteps:
+    :param max_concurrent_download:
+    :param download_dir:
+    :param poll_interval: seconds between two listings of the run
+    :param timeout: maximum watching time, in seconds
+    :param max_poll_interval: maximum seconds between two listings, when no timestep is expected soon
+    :param db_dir: directory of download database, allowing to learn when timesteps are usually published.
+        Without it, run is listed every `poll_interval` seconds.
+    :param keep_runs: cf. `create_flow_download`
+    :param keep_days:
+    :param min_free_space:
+    :param evict:
+    :return:
+    """
+    if not timesteps:
+        # Set default
+        timesteps = [3, 6]
+
+    with prefect.Flow(name=f"{flow_name}-run{run}") as flow_watch:
+        param_run = prefect.Parameter("run", default=run)
+        date_day = prefect.Parameter("date_day", default=None)
+
+        watch_run(
+            run=param_run, date_day=date_day, timesteps=timesteps, download_dir=download_dir,
+            poll_interval=poll_interval, timeout=timeout, max_concurrent_download=max_concurrent_download,
+            max_poll_interval=max_poll_interval, db_dir=db_dir,
+            keep_runs=keep_runs, keep_days=keep_days, min_free_space=min_free_space, evict=evict
+        )
+
+    # Scheduling on a daily basis, according to the run
+    cron = CronClock(f"0 {run} * * *", start_date=pendulum.now("UTC"))
+    flow_watch.schedule = Schedule(clocks=[cron])
+
+    # Setup prefect logging to catch current package logs
+    prefect.utilities.logging._create_logger("datafetch")
+
+    return flow_watch
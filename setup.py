@@ -19,6 +19,10 @@ setup(
     url="https://github.com/steph-ben/datafetch",
     packages=find_packages(),
     install_requires=requirements,
+    extras_require={
+        'async': ['aiohttp'],
+        'xxhash': ['xxhash'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
     ]
@@ -0,0 +1,50 @@
+import os
+import socket
+from functools import lru_cache
+from pathlib import Path
+
+import pytest
+
+
+@lru_cache()
+def has_network(host: str = "www.google.com", port: int = 80, timeout: float = 3) -> bool:
+    """
+    Check if internet can be reached
+
+    :param host:
+    :param port:
+    :param timeout:
+    :return:
+    """
+    try:
+        socket.create_connection((host, port), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
+
+
+def has_cds_credentials() -> bool:
+    """
+    Check if CDS credentials are configured, cf. https://github.com/ecmwf/cdsapi#configure
+
+    :return:
+    """
+    if os.environ.get("CDSAPI_URL") and os.environ.get("CDSAPI_KEY"):
+        return True
+    return Path(os.environ.get("CDSAPI_RC", "~/.cdsapirc")).expanduser().is_file()
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "network: test against live services, skipped without internet access")
+    config.addinivalue_line("markers", "cds: test against live CDS, skipped without CDS credentials")
+
+
+def pytest_collection_modifyitems(config, items):
+    """
+    Skip tests against live services when they can't be reached, their behaviour being also tested locally
+    """
+    for item in items:
+        if "network" in item.keywords and not has_network():
+            item.add_marker(pytest.mark.skip(reason="No internet access"))
+        elif "cds" in item.keywords and not has_cds_credentials():
+            item.add_marker(pytest.mark.skip(reason="No CDS credentials"))
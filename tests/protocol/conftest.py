@@ -0,0 +1,190 @@
+import gzip
+import hashlib
+import json
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+
+import pytest
+
+
+class LocalHttpServer(ThreadingHTTPServer):
+    """
+    A local HTTP server, keeping track of received requests
+    """
+    def __init__(self, served_dir: Path):
+        self.directory = served_dir
+        self.requests = []
+        super().__init__(("127.0.0.1", 0), partial(QuietHTTPRequestHandler, directory=str(served_dir)))
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """
+    Serve files of a temporary directory on localhost
+    """
+    served_dir = tmp_path / "served"
+    served_dir.mkdir()
+
+    server = LocalHttpServer(served_dir)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Serve static files, with ETag, conditional requests and byte ranges support
+
+    Some behaviours can be triggered with a query string :
+        - `?gzip` : gzip-encoded content
+        - `?norange` : no byte ranges support
+        - `?status=503` : error response, with some content
+    """
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+
+        path, _, query = self.path.partition("?")
+        if query.startswith("status="):
+            self.send_error(int(query.replace("status=", "")))
+            return
+        fp = Path(self.translate_path(path))
+        if not fp.is_file():
+            self.send_error(404)
+            return
+
+        content = fp.read_bytes()
+        headers = {
+            'ETag': f'"{hashlib.md5(content).hexdigest()}"',
+            'Last-Modified': self.date_time_string(int(fp.stat().st_mtime)),
+        }
+        status = 200
+
+        if self.headers.get('If-None-Match', self.headers.get('If-Modified-Since')) \
+                in (headers['ETag'], headers['Last-Modified']):
+            self.send_response(304)
+            self.send_header('ETag', headers['ETag'])
+            self.end_headers()
+            return
+
+        if query == "gzip":
+            content = gzip.compress(content)
+            headers['Content-Encoding'] = "gzip"
+        elif query != "norange":
+            headers['Accept-Ranges'] = "bytes"
+            if_range = self.headers.get('If-Range', headers['ETag'])
+            if 'Range' in self.headers and if_range in (headers['ETag'], headers['Last-Modified']):
+                start, _, end = self.headers['Range'].replace("bytes=", "").partition("-")
+                start, end = int(start), int(end) if end else len(content) - 1
+                if start >= len(content):
+                    self.send_error(416)
+                    return
+                headers['Content-Range'] = f"bytes {start}-{end}/{len(content)}"
+                content = content[start:end + 1]
+                status = 206
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeCdsServer(ThreadingHTTPServer):
+    """
+    A local CDS API, whose requests are completed after being checked `nb_checks` times
+
+    Result of a request is its parameters, as JSON
+    """
+    def __init__(self, nb_checks: int = 3):
+        self.nb_checks = nb_checks
+        self.tasks = {}
+        self.deleted = []
+        super().__init__(("127.0.0.1", 0), FakeCdsRequestHandler)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/api/v2"
+
+
+@pytest.fixture
+def cds_server():
+    """
+    Serve a fake CDS API on localhost
+    """
+    server = FakeCdsServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+class FakeCdsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Endpoints of CDS API used by cdsapi : submitting a request, checking and deleting it, and downloading its result
+    Requests with a "fail" parameter fail once completed.
+    """
+    def do_POST(self):
+        # /api/v2/resources/<name>
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        request_id = f"request-{len(self.server.tasks)}"
+        self.server.tasks[request_id] = {'request': request, 'nb_checks': 0}
+        self.send_json({'state': "queued", 'request_id': request_id})
+
+    def do_GET(self):
+        _, _, path = self.path.partition("/api/v2/")
+        kind, _, request_id = path.partition("/")
+        if request_id not in self.server.tasks:
+            self.send_error(404)
+            return
+
+        task = self.server.tasks[request_id]
+        if kind == "results":
+            content = json.dumps(task['request']).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+
+        task['nb_checks'] += 1
+        reply = {'state': "queued", 'request_id': request_id}
+        if task['nb_checks'] >= self.server.nb_checks and "fail" in task['request']:
+            reply.update({'state': "failed", 'error': {'message': "plop", 'reason': "plip"}})
+        elif task['nb_checks'] >= self.server.nb_checks:
+            reply.update({'state': "completed", 'location': f"{self.server.url}/results/{request_id}"})
+        self.send_json(reply)
+
+    def do_DELETE(self):
+        self.server.deleted.append(self.path.rsplit("/", 1)[-1])
+        self.send_json({})
+
+    def send_json(self, reply: dict):
+        content = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
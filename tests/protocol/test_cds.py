@@ -1,5 +1,8 @@
+import json
 from pathlib import Path
 
+import pytest
+
 from datafetch.protocol.cds import ClimateDataStoreApi
 from datafetch.utils.db import DownloadRecord
 
@@ -21,6 +24,8 @@ cds_test_resource = {
 }
 
 
+@pytest.mark.network
+@pytest.mark.cds
 def test_cds_queue(tmp_path):
     # test_cds_submit
     cds = ClimateDataStoreApi(db_dir=str(tmp_path))
@@ -64,6 +69,71 @@ def test_cds_queue(tmp_path):
     assert fp.is_file()
 
 
+def make_local_cds(cds_server, tmp_path) -> ClimateDataStoreApi:
+    cds = ClimateDataStoreApi(api_uid="1234", api_key="plop", db_dir=str(tmp_path))
+    cds._cds_url = cds_server.url
+    return cds
+
+
+def test_cds_queue_local(cds_server, tmp_path):
+    cds = make_local_cds(cds_server, tmp_path)
+    db_record, created = cds.submit_to_queue(**cds_test_resource)
+    assert created
+    assert db_record.status == "queued"
+    queue_id = db_record.queue_id
+    assert cds_server.tasks[queue_id]['request'] == cds_test_resource['cds_resource_param']
+
+    # Submitting it again doesn't make a new request
+    db_record, created = cds.submit_to_queue(**cds_test_resource)
+    assert not created
+    assert db_record.queue_id == queue_id
+    assert len(cds_server.tasks) == 1
+
+    # Not ready yet
+    db_record = cds.check_queue(**cds_test_resource)
+    assert db_record.status == "queued"
+    assert cds.download_result(**cds_test_resource, destination_dir=str(tmp_path)) is None
+
+    state, reply = cds.check_queue_by_id(queue_id, wait_until_complete=True, sleep_seconds=0)
+    assert state == "completed"
+    db_record = cds.check_queue(**cds_test_resource)
+    assert db_record.status == "queued_and_ready"
+    assert db_record.origin_url == f"{cds_server.url}/results/{queue_id}"
+
+    fp = cds.download_result(**cds_test_resource, destination_dir=str(tmp_path), destination_filename="era5.grib")
+    assert json.loads(fp.read_text()) == cds_test_resource['cds_resource_param']
+    assert cds_server.deleted == [queue_id]
+
+
+def test_cds_force_new_local(cds_server, tmp_path):
+    cds = make_local_cds(cds_server, tmp_path)
+    db_record, _ = cds.submit_to_queue(**cds_test_resource)
+    queue_id_1 = db_record.queue_id
+
+    db_record, created = cds.submit_to_queue(**cds_test_resource, force_new=True)
+    assert created
+    assert db_record.queue_id != queue_id_1
+    assert len(cds_server.tasks) == 2
+
+
+def test_cds_poll_queue_local(cds_server, tmp_path):
+    cds = make_local_cds(cds_server, tmp_path)
+    name = cds_test_resource['cds_resource_name']
+    params = [{**cds_test_resource['cds_resource_param'], 'day': str(day)} for day in range(1, 4)]
+    params.append({**cds_test_resource['cds_resource_param'], 'fail': 1})
+    for param in params:
+        cds.submit_to_queue(name, param)
+
+    records = list(cds.poll_queue(min_interval=0.01, max_interval=0.05))
+    assert sorted(record.status for record in records) == ["failed"] + ["queued_and_ready"] * 3
+
+    fp_list = cds.download_pipelined([(name, param) for param in params], destination_dir=str(tmp_path))
+    assert [json.loads(fp.read_text()) if fp else None for fp, _ in fp_list] == params[:3] + [None]
+    assert len(cds_server.deleted) == 3
+
+
+@pytest.mark.network
+@pytest.mark.cds
 def test_cds_force_new(tmp_path):
     # test_cds_submit
     cds = ClimateDataStoreApi(db_dir=str(tmp_path))
@@ -81,3 +151,130 @@ def test_cds_force_new(tmp_path):
     assert isinstance(created, bool)
     assert db_record.queue_id
     assert db_record.queue_id != queue_id_1
+
+
+def test_cds_resource_key():
+    name = cds_test_resource['cds_resource_name']
+    param = cds_test_resource['cds_resource_param']
+    key = ClimateDataStoreApi.get_resource_key(name, param)
+    assert len(key) < 100
+
+    equivalent_param = dict(reversed(list(param.items())))
+    equivalent_param.update({'month': 2, 'pressure_level': ['850'], 'time': ['18:00', '12:00', '06:00', '00:00', '06:00']})
+    assert ClimateDataStoreApi.get_resource_key(name, equivalent_param) == key
+
+    assert ClimateDataStoreApi.get_resource_key(name, {**param, 'day': '19'}) != key
+
+    # Values of positional parameters are kept in order
+    assert ClimateDataStoreApi.get_resource_key(name, {**param, 'area': [60, -10, 50, 2]}) \
+        != ClimateDataStoreApi.get_resource_key(name, {**param, 'area': [50, 2, 60, -10]})
+    assert ClimateDataStoreApi.get_resource_key(name, {**param, 'grid': [0.25, 1.0]}) \
+        != ClimateDataStoreApi.get_resource_key(name, {**param, 'grid': [1.0, 0.25]})
+    assert ClimateDataStoreApi.get_resource_key(name, {**param, 'area': [60.0, -10, 50, 2]}) \
+        == ClimateDataStoreApi.get_resource_key(name, {**param, 'area': ['60', '-10', '50', '2']})
+
+
+def test_cds_legacy_key_migration(tmp_path):
+    name = cds_test_resource['cds_resource_name']
+    param = cds_test_resource['cds_resource_param']
+    cds = ClimateDataStoreApi(db_dir=str(tmp_path))
+
+    # Records created by a previous version
+    with cds:
+        for legacy_param, status in (param, "queued"), (dict(reversed(list(param.items()))), "downloaded"):
+            record, _ = cds.db_get_record(key=ClimateDataStoreApi.get_legacy_resource_key(name, legacy_param))
+            record.status = status
+            record.save()
+
+    assert cds.db_migrate_legacy_keys() == 2
+    record, created = cds.db_get_resource_record(name, param)
+    assert not created
+    assert record.status == "downloaded"
+    assert cds.db_model.select().count() == 1
+
+    # On the fly migration
+    with cds:
+        record.key = ClimateDataStoreApi.get_legacy_resource_key(name, param)
+        record.save()
+    record, created = cds.db_get_resource_record(name, param)
+    assert not created
+    assert record.key == ClimateDataStoreApi.get_resource_key(name, param)
+
+
+class FakeQueueCds(ClimateDataStoreApi):
+    """
+    Requests complete after a number of checks given by their id, eg. "ok-3", "ko-1"
+    """
+    checks: dict = {}
+    max_queued: int = 0
+    location_base: str = "http://plop"
+    cleaned: list = []
+
+    def _queue_request(self, cds_resource_name: str, cds_resource_param: dict):
+        nb_queued = self.db_model.select().where(self.db_model.status == "queued").count() + 1
+        self.max_queued = max(self.max_queued, nb_queued)
+        return f"ok-2-{cds_resource_param['day']}"
+
+    def check_queue_by_id(self, queue_id: str, **kwargs):
+        result, nb_checks = queue_id.split("-")[:2]
+        self.checks[queue_id] = self.checks.get(queue_id, 0) + 1
+        if self.checks[queue_id] < int(nb_checks):
+            return "queued", {}
+        if result == "ok":
+            return "completed", {'location': f"{self.location_base}/{queue_id}"}
+        return "failed", {'error': "plop"}
+
+    def cleanup_request(self, queue_id: str):
+        self.cleaned.append(queue_id)
+
+
+def test_cds_poll_queue(tmp_path):
+    cds = FakeQueueCds(db_dir=str(tmp_path))
+    with cds:
+        for queue_id in "ok-4", "ok-1", "ko-2":
+            record, _ = cds.db_get_record(key=queue_id)
+            record.set_queued(queue_id)
+            record.save()
+
+    records = list(cds.poll_queue(min_interval=0.01, max_interval=0.05))
+    assert [r.queue_id for r in records] == ["ok-1", "ko-2", "ok-4"]
+    assert [r.status for r in records] == ["queued_and_ready", "failed", "queued_and_ready"]
+    assert records[0].origin_url == "http://plop/ok-1"
+    assert cds.checks["ok-4"] == 4
+
+
+def test_cds_submit_window(tmp_path):
+    name = cds_test_resource['cds_resource_name']
+    resources = [(name, {**cds_test_resource['cds_resource_param'], 'day': str(day)}) for day in range(1, 8)]
+
+    cds = FakeQueueCds(db_dir=str(tmp_path))
+    records = []
+    for record in cds.submit_window(resources[:5], max_active=2, min_interval=0.01):
+        records.append(record)
+        if len(records) == 3:
+            # Simulate an interruption
+            break
+    assert cds.max_queued == 2
+
+    # Restart, with more requests : completed requests are yielded again, since not downloaded yet
+    cds = FakeQueueCds(db_dir=str(tmp_path))
+    records = list(cds.submit_window(resources, max_active=3, min_interval=0.01))
+    assert sorted(r.queue_id for r in records) == sorted(f"ok-2-{day}" for day in range(1, 8))
+    assert all(r.status == "queued_and_ready" for r in records)
+    assert cds.max_queued == 3
+
+
+def test_cds_download_pipelined(tmp_path, http_server):
+    name = cds_test_resource['cds_resource_name']
+    resources = [(name, {**cds_test_resource['cds_resource_param'], 'day': str(day)}) for day in range(1, 5)]
+    for day in range(1, 5):
+        (http_server.directory / f"ok-2-{day}").write_text(f"result {day}")
+
+    cds = FakeQueueCds(db_dir=str(tmp_path), location_base=http_server.url)
+    for name, param in resources:
+        cds.submit_to_queue(name, param)
+
+    fp_list = cds.download_pipelined(resources, destination_dir=str(tmp_path), min_interval=0.01)
+    assert [fp.read_text() for fp, _ in fp_list] == [f"result {day}" for day in range(1, 5)]
+    assert [param['day'] for _, param in fp_list] == ["1", "2", "3", "4"]
+    assert sorted(cds.cleaned) == [f"ok-2-{day}" for day in range(1, 5)]
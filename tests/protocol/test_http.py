@@ -1,9 +1,17 @@
+import hashlib
+import os
+import socket
 from pathlib import Path
 
+import pytest
+
 from datafetch.protocol.http.core import SimpleHttpFetch
 from datafetch.core import FetchWithTemporaryExtensionMixin, DownloadedFileRecorderMixin
+from datafetch.protocol.http.session import HttpSessionPool
+from datafetch.utils import metrics
 
 
+@pytest.mark.network
 def test_simplehttp(tmp_path):
     fetcher = SimpleHttpFetch(base_url="http://www.google.com")
     assert isinstance(fetcher, SimpleHttpFetch)
@@ -21,6 +29,7 @@ def test_simplehttp(tmp_path):
     assert r.name == "plop.txt"
 
 
+@pytest.mark.network
 def test_simplehttp_raw(tmp_path):
     for use_raw in True, False:
         fetcher = SimpleHttpFetch(base_url="http://www.google.com", use_requests_raw=use_raw)
@@ -29,6 +38,7 @@ def test_simplehttp_raw(tmp_path):
         assert r.is_file()
 
 
+@pytest.mark.network
 def test_download_with_db(tmp_path):
     fetcher = SimpleHttpFetch(
         base_url="http://www.google.com",
@@ -50,3 +60,246 @@ def test_download_with_db(tmp_path):
     r = fetcher.fetch(destination_dir=str(tmp_path))
     assert isinstance(r, Path)
     assert not r.exists()
+
+
+def test_simplehttp_local(http_server, tmp_path):
+    base_url, served_dir = http_server.url, http_server.directory
+    (served_dir / "file.csv").write_text("some content")
+
+    fetcher = SimpleHttpFetch(base_url=base_url)
+    r = fetcher.fetch(url_suffix="file.csv", destination_dir=str(tmp_path))
+    assert r.read_text() == "some content"
+
+
+def test_http_session_pool():
+    pool = HttpSessionPool()
+    session = pool.get("https://plop.org/a/b")
+    assert pool.get("https://plop.org/c") is session
+    assert pool.get("https://plip.org/c") is not session
+    assert pool.get("https://plop.org/c", pool_maxsize=2) is not session
+    pool.close()
+
+
+def test_simplehttp_stream(http_server, tmp_path):
+    base_url, served_dir = http_server.url, http_server.directory
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    (served_dir / "file.bin").write_bytes(content)
+
+    fetcher = SimpleHttpFetch(base_url=base_url, stream_min_chunk_size=1024, stream_max_chunk_size=256 * 1024)
+    r = fetcher.fetch(url_suffix="file.bin", destination_dir=str(tmp_path))
+    assert r.read_bytes() == content
+
+    # Compressed response should be transparently decoded
+    r = fetcher.fetch(url_suffix="file.bin?gzip", destination_dir=str(tmp_path), destination_filename="gz.bin")
+    assert r.read_bytes() == content
+
+
+def test_simplehttp_error_status(http_server, tmp_path):
+    (http_server.directory / "file.bin").write_bytes(b"some content")
+    fetcher = SimpleHttpFetch(base_url=http_server.url, use_download_db=True, db_dir=str(tmp_path),
+                              resume_partial=True, http_max_retries=1, http_backoff_factor=0)
+
+    for url_suffix in "missing.bin", "file.bin?status=503":
+        labels = fetcher.get_metrics_labels(url=f"{http_server.url}/{url_suffix}")
+        nb_failed = metrics.fetches_total.get(status="failed", **labels)
+        assert fetcher.fetch(url_suffix=url_suffix, destination_dir=str(tmp_path), destination_filename="f") is None
+        assert not (tmp_path / "f").exists()
+        assert not (tmp_path / "f.tmp").exists()
+        assert metrics.fetches_total.get(status="failed", **labels) == nb_failed + 1
+        with fetcher:
+            record, _ = fetcher.db_get_record(key=f"{http_server.url}/{url_suffix}")
+        assert record.status == "failed"
+
+    # Server errors are retried before giving up
+    assert [path for _, path, _ in http_server.requests].count("/file.bin?status=503") == 2
+
+    # A partial download is kept for later, instead of being overwritten with an error page
+    (tmp_path / "f.tmp").write_bytes(b"some")
+    assert fetcher.fetch(url_suffix="missing.bin", destination_dir=str(tmp_path), destination_filename="f") is None
+    assert (tmp_path / "f.tmp").read_bytes() == b"some"
+
+
+def test_simplehttp_resume(http_server, tmp_path):
+    content = os.urandom(100000)
+    (http_server.directory / "file.bin").write_bytes(content)
+    fetcher = SimpleHttpFetch(base_url=http_server.url, use_download_db=True, db_dir=str(tmp_path),
+                              resume_partial=True)
+
+    # Simulate an interrupted download, with validators recorded in db
+    fetcher.fetch(url_suffix="file.bin", destination_dir=str(tmp_path))
+    fp = tmp_path / "file.bin"
+    fp.unlink()
+    (tmp_path / "file.bin.tmp").write_bytes(content[:30000])
+    with fetcher:
+        record, _ = fetcher.db_get_record(key=f"{http_server.url}/file.bin")
+        assert record.etag
+        record.set_failed()
+        record.save()
+
+    labels = fetcher.get_metrics_labels(url=f"{http_server.url}/file.bin")
+    downloaded_bytes = metrics.downloaded_bytes_total.get(**labels)
+    r = fetcher.fetch(url_suffix="file.bin", destination_dir=str(tmp_path))
+    assert r.read_bytes() == content
+    assert http_server.requests[-1][2]['Range'] == "bytes=30000-"
+    # Only the resumed part is counted as downloaded
+    assert metrics.downloaded_bytes_total.get(**labels) == downloaded_bytes + 70000
+    # Checksum covers the whole file, not only the resumed part
+    with fetcher:
+        record, _ = fetcher.db_get_record(key=f"{http_server.url}/file.bin")
+    assert record.checksum == f"sha256:{hashlib.sha256(content).hexdigest()}"
+
+
+def test_simplehttp_resume_fallback(http_server, tmp_path):
+    content = os.urandom(100000)
+    (http_server.directory / "file.bin").write_bytes(content)
+    fetcher = SimpleHttpFetch(base_url=http_server.url, use_download_db=True, db_dir=str(tmp_path),
+                              resume_partial=True)
+
+    # Validators from previous attempt doesn't match anymore
+    with fetcher:
+        record, _ = fetcher.db_get_record(key=f"{http_server.url}/file.bin")
+        record.set_remote_validators(etag='"outdated"')
+        record.save()
+    (tmp_path / "file.bin.tmp").write_bytes(b"x" * 30000)
+
+    labels = fetcher.get_metrics_labels(url=f"{http_server.url}/file.bin")
+    downloaded_bytes = metrics.downloaded_bytes_total.get(**labels)
+    r = fetcher.fetch(url_suffix="file.bin", destination_dir=str(tmp_path))
+    assert r.read_bytes() == content
+    # Whole file is downloaded again
+    assert metrics.downloaded_bytes_total.get(**labels) == downloaded_bytes + 100000
+
+
+def test_simplehttp_segmented(http_server, tmp_path):
+    content = os.urandom(100000)
+    (http_server.directory / "file.bin").write_bytes(content)
+    fetcher = SimpleHttpFetch(base_url=http_server.url, segmented_download=True,
+                              segments=4, segment_min_size=10000)
+
+    r = fetcher.fetch(url_suffix="file.bin", destination_dir=str(tmp_path))
+    assert r.read_bytes() == content
+    ranges = sorted(headers['Range'] for command, _, headers in http_server.requests if command == "GET")
+    assert ranges == ["bytes=0-24999", "bytes=25000-49999", "bytes=50000-74999", "bytes=75000-99999"]
+
+    # Without ranges support, a single stream is downloaded
+    r = fetcher.fetch(url_suffix="file.bin?norange", destination_dir=str(tmp_path), destination_filename="f2")
+    assert r.read_bytes() == content
+
+
+def test_simplehttp_segmented_short_writes(http_server, tmp_path, monkeypatch):
+    content = os.urandom(100000)
+    (http_server.directory / "file.bin").write_bytes(content)
+    pwrite = os.pwrite
+    # Writes interrupted after a few bytes
+    monkeypatch.setattr(os, "pwrite", lambda fd, data, position: pwrite(fd, data[:1000], position))
+    fetcher = SimpleHttpFetch(base_url=http_server.url, segmented_download=True,
+                              segments=4, segment_min_size=10000)
+
+    r = fetcher.fetch(url_suffix="file.bin", destination_dir=str(tmp_path))
+    assert r.read_bytes() == content
+    # Without falling back to a single stream download
+    assert all('Range' in headers for command, _, headers in http_server.requests if command == "GET")
+
+
+def test_simplehttp_checksum(http_server, tmp_path):
+    content = os.urandom(100000)
+    (http_server.directory / "file.bin").write_bytes(content)
+    fetcher = SimpleHttpFetch(base_url=http_server.url, use_download_db=True, db_dir=str(tmp_path),
+                              checksum_algorithm="sha256", http_etag_is_md5=True)
+
+    r = fetcher.fetch(url_suffix="file.bin", destination_dir=str(tmp_path))
+    assert r.read_bytes() == content
+    with fetcher:
+        record, _ = fetcher.db_get_record(key=f"{http_server.url}/file.bin")
+    assert record.checksum == f"sha256:{hashlib.sha256(content).hexdigest()}"
+
+    # Raw gzipped content doesn't match the ETag, computed on the file
+    fetcher.use_requests_raw = True
+    r = fetcher.fetch(url_suffix="file.bin?gzip", destination_dir=str(tmp_path), destination_filename="f2")
+    assert r is None
+    assert not (tmp_path / "f2").exists()
+    assert not (tmp_path / "f2.tmp").exists()
+    with fetcher:
+        record, _ = fetcher.db_get_record(key=f"{http_server.url}/file.bin?gzip")
+    assert record.status == "failed"
+
+
+def test_simplehttp_conditional(http_server, tmp_path):
+    (http_server.directory / "synop.csv").write_text("some content")
+    fetcher = SimpleHttpFetch(base_url=http_server.url, conditional_fetch=True)
+
+    r = fetcher.fetch(url_suffix="synop.csv", destination_dir=str(tmp_path))
+    assert r.read_text() == "some content"
+    assert (tmp_path / ".synop.csv.validators").is_file()
+
+    # Unchanged remote file isn't transferred again
+    r = fetcher.fetch(url_suffix="synop.csv", destination_dir=str(tmp_path))
+    assert r == tmp_path / "synop.csv"
+    assert r.read_text() == "some content"
+    assert "If-None-Match" in http_server.requests[-1][2]
+    assert not (tmp_path / "synop.csv.tmp").exists()
+
+    (http_server.directory / "synop.csv").write_text("updated content")
+    r = fetcher.fetch(url_suffix="synop.csv", destination_dir=str(tmp_path))
+    assert r.read_text() == "updated content"
+
+
+def test_simplehttp_conditional_error_status(http_server, tmp_path):
+    (http_server.directory / "synop.csv").write_text("some content")
+    fetcher = SimpleHttpFetch(base_url=http_server.url, conditional_fetch=True,
+                              http_max_retries=1, http_backoff_factor=0)
+    fetcher.fetch(url_suffix="synop.csv", destination_dir=str(tmp_path))
+    validators = (tmp_path / ".synop.csv.validators").read_text()
+
+    # Error responses to the conditional request leave local copy and its validators as they were
+    for url_suffix in "synop.csv?status=503", "synop.csv?status=410":
+        assert fetcher.fetch(url_suffix=url_suffix, destination_dir=str(tmp_path),
+                             destination_filename="synop.csv") is None
+        assert "If-None-Match" in http_server.requests[-1][2]
+    (http_server.directory / "synop.csv").unlink()
+    assert fetcher.fetch(url_suffix="synop.csv", destination_dir=str(tmp_path)) is None
+
+    assert (tmp_path / "synop.csv").read_text() == "some content"
+    assert (tmp_path / ".synop.csv.validators").read_text() == validators
+    assert fetcher.read_validators(tmp_path / "synop.csv") is not None
+    assert not (tmp_path / "synop.csv.tmp").exists()
+
+
+def test_simplehttp_cache(http_server, tmp_path):
+    (http_server.directory / "file.bin").write_bytes(b"some content")
+    fetcher = SimpleHttpFetch(base_url=http_server.url, cache_dir=str(tmp_path / "cache"))
+
+    r = fetcher.fetch(url_suffix="file.bin", destination_dir=str(tmp_path / "a"))
+    assert r.read_bytes() == b"some content"
+    nb_requests = len(http_server.requests)
+
+    # Another destination is served from cache, without any request
+    r = fetcher.fetch(url_suffix="file.bin", destination_dir=str(tmp_path / "b"))
+    assert r.read_bytes() == b"some content"
+    assert os.path.samefile(r, tmp_path / "a" / "file.bin")
+    assert len(http_server.requests) == nb_requests
+
+
+def test_simplehttp_metrics(http_server, tmp_path):
+    (http_server.directory / "file.bin").write_bytes(b"some content")
+    fetcher = SimpleHttpFetch(base_url=http_server.url)
+    labels = fetcher.get_metrics_labels(url=f"{http_server.url}/file.bin")
+    assert labels == {'protocol': "http", 'host': "127.0.0.1", 'bucket': ""}
+    downloaded_bytes = metrics.downloaded_bytes_total.get(**labels)
+    nb_failed = metrics.fetches_total.get(status="failed", **labels)
+    nb_retries = metrics.retries_total.get(**labels)
+
+    assert fetcher.fetch(url_suffix="file.bin", destination_dir=str(tmp_path))
+    assert metrics.downloaded_bytes_total.get(**labels) == downloaded_bytes + len(b"some content")
+
+    # Nothing listening on this port
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    unreachable = SimpleHttpFetch(base_url=f"http://127.0.0.1:{port}", http_max_retries=2, http_backoff_factor=0)
+    assert unreachable.fetch(url_suffix="file.bin", destination_dir=str(tmp_path / "unreachable")) is None
+    assert metrics.fetches_total.get(status="failed", **labels) == nb_failed + 1
+    assert metrics.retries_total.get(**labels) == nb_retries + 2
+    assert metrics.fetches_in_progress.get(**labels) == 0
+    assert 'datafetch_fetch_duration_seconds_count{protocol="http",host="127.0.0.1",bucket=""}' \
+        in metrics.metrics.to_prometheus()
@@ -0,0 +1,71 @@
+import hashlib
+import os
+from pathlib import Path
+
+from datafetch.protocol.http.aio import AsyncHttpFetch
+
+
+def test_async_fetch_many(http_server, tmp_path):
+    base_url, served_dir = http_server.url, http_server.directory
+    for i in range(10):
+        (served_dir / f"file{i}.csv").write_text(f"content {i}")
+
+    fetcher = AsyncHttpFetch(base_url=base_url, max_concurrent_downloads=3)
+    r = fetcher.fetch_many(
+        destination_dir=str(tmp_path / "dest"),
+        fetch_list=[{'url_suffix': f"file{i}.csv"} for i in range(10)]
+    )
+    assert len(r) == 10
+    for i, fp in enumerate(r):
+        assert isinstance(fp, Path)
+        assert fp.name == f"file{i}.csv"
+        assert fp.read_text() == f"content {i}"
+        assert not fp.with_name(f"{fp.name}.{fetcher.temporary_extension}").exists()
+
+
+def test_async_fetch_many_with_db(http_server, tmp_path):
+    base_url, served_dir = http_server.url, http_server.directory
+    (served_dir / "file.csv").write_text("content")
+
+    fetcher = AsyncHttpFetch(base_url=base_url, use_download_db=True, db_dir=str(tmp_path))
+    fp, = fetcher.fetch_many(destination_dir=str(tmp_path), fetch_list=[{'url_suffix': "file.csv"}])
+    assert fp.is_file()
+    assert fetcher.db_path.is_file()
+
+    # Already recorded, it should not be downloaded again
+    fp.unlink()
+    fp, = fetcher.fetch_many(destination_dir=str(tmp_path), fetch_list=[{'url_suffix': "file.csv"}])
+    assert not fp.exists()
+
+
+def test_async_fetch_many_failure(http_server, tmp_path):
+    base_url, served_dir = http_server.url, http_server.directory
+    (served_dir / "file.csv").write_text("content")
+
+    fetcher = AsyncHttpFetch(base_url=base_url, use_download_db=True, db_dir=str(tmp_path))
+    fetch_list = [{'url_suffix': "file.csv"}, {'url_suffix': "missing.csv"}]
+    fp, fp_missing = fetcher.fetch_many(destination_dir=str(tmp_path / "dest"), fetch_list=fetch_list)
+    assert fp.is_file()
+    assert fp_missing is None
+    assert not (tmp_path / "dest" / "missing.csv").exists()
+    with fetcher:
+        record, _ = fetcher.db_get_record(key=f"{base_url}/missing.csv")
+    assert record.status == "failed"
+
+    # Failed download is attempted again
+    (served_dir / "missing.csv").write_text("content")
+    fp, fp_missing = fetcher.fetch_many(destination_dir=str(tmp_path / "dest"), fetch_list=fetch_list)
+    assert fp_missing.read_text() == "content"
+
+
+def test_async_fetch_many_checksum(http_server, tmp_path):
+    content = os.urandom(100000)
+    (http_server.directory / "file.bin").write_bytes(content)
+
+    fetcher = AsyncHttpFetch(base_url=http_server.url, use_download_db=True, db_dir=str(tmp_path),
+                             checksum_algorithm="sha256", http_etag_is_md5=True)
+    fp, = fetcher.fetch_many(destination_dir=str(tmp_path / "dest"), fetch_list=[{'url_suffix': "file.bin"}])
+    assert fp.read_bytes() == content
+    with fetcher:
+        record, _ = fetcher.db_get_record(key=f"{http_server.url}/file.bin")
+    assert record.checksum == f"sha256:{hashlib.sha256(content).hexdigest()}"
@@ -1,4 +1,20 @@
-from datafetch.protocol.s3 import S3ApiBucket
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import boto3.session
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+from s3transfer.download import GetObjectTask
+
+from datafetch.protocol.s3 import S3ApiBucket, listing_cache
+from datafetch.protocol.s3.transfer import TransferConcurrencyBudget, BudgetedThreadPoolExecutor, \
+    get_shared_transfer_manager, set_transfer_concurrency_budget, transfer_budget
+from datafetch.utils import metrics
 
 
 def test_s3_generic():
@@ -12,3 +28,342 @@ def test_s3_fetch(tmp_path):
     s3api = S3ApiBucket(bucket_name="any_bucket")
     r = s3api.fetch(object_key="plop", destination_dir=str(tmp_path))
     assert r is None
+
+
+def test_s3_transfer_config():
+    s3api = S3ApiBucket(bucket_name="any_bucket", transfer_multipart_chunksize=16 * 1024 * 1024,
+                        transfer_max_concurrency=4)
+    config = s3api.transfer_config()
+    assert config.multipart_chunksize == 16 * 1024 * 1024
+    assert config.max_concurrency == 4
+    assert s3api.transfer_config(max_concurrency=2).max_concurrency == 2
+
+
+def test_s3_transfer_budget():
+    budget = TransferConcurrencyBudget(size=4)
+    with budget.acquire(10) as slots:
+        assert slots == 4
+        assert budget.in_use == 4
+    assert budget.in_use == 0
+
+    # Concurrent downloads share the budget, instead of waiting for all their slots
+    with budget.acquire(3) as slots:
+        assert slots == 3
+        with budget.acquire(3) as other_slots:
+            assert other_slots == 1
+            assert budget.in_use == 4
+
+    budget.resize(None)
+    with budget.acquire(10) as slots:
+        assert slots == 10
+
+
+def test_s3_shared_transfer_manager():
+    s3api = S3ApiBucket(bucket_name="any_bucket")
+    manager = get_shared_transfer_manager(s3api.transfer_config(), **s3api.client_config)
+    assert get_shared_transfer_manager(s3api.transfer_config(), **s3api.client_config) is manager
+
+    # Different chunk size, different manager
+    s3api.transfer_multipart_chunksize = 16 * 1024 * 1024
+    other = get_shared_transfer_manager(s3api.transfer_config(), **s3api.client_config)
+    assert other is not manager
+    assert other.config.multipart_chunksize == 16 * 1024 * 1024
+
+    # Managers are replaced when budget changes, without shutting down those still in use
+    set_transfer_concurrency_budget(2)
+    try:
+        assert get_shared_transfer_manager(s3api.transfer_config(), **s3api.client_config) is not other
+    finally:
+        set_transfer_concurrency_budget(None)
+
+
+class FakeGetObjectTask(GetObjectTask):
+    """
+    A GET request of a managed transfer, keeping track of how many run at the same time
+    """
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+
+    def __init__(self):
+        pass
+
+    def __call__(self, ctx=None):
+        cls = FakeGetObjectTask
+        with cls.lock:
+            cls.running += 1
+            cls.max_running = max(cls.max_running, cls.running)
+        time.sleep(0.05)
+        with cls.lock:
+            cls.running -= 1
+
+
+def test_s3_shared_pools_budget():
+    # Pools of two shared managers, with more threads than the budget
+    transfer_budget.resize(3)
+    try:
+        with BudgetedThreadPoolExecutor(max_workers=4) as executor, \
+                BudgetedThreadPoolExecutor(max_workers=4) as other_executor:
+            futures = [pool.submit(FakeGetObjectTask()) for pool in (executor, other_executor) for _ in range(8)]
+            for future in futures:
+                future.result()
+    finally:
+        transfer_budget.resize(None)
+    assert FakeGetObjectTask.max_running == 3
+    assert transfer_budget.in_use == 0
+
+
+def test_s3_fetch_byte_ranges(tmp_path):
+    content = bytes(range(256)) * 10
+    s3api = S3ApiBucket(bucket_name="any_bucket")
+    with Stubber(s3api.client) as stubber:
+        stubber.add_response('head_object',
+                             {'ContentLength': len(content), 'ETag': '"abc"', 'LastModified': datetime(2021, 2, 1)},
+                             {'Bucket': "any_bucket", 'Key': "plop"})
+        for start, end in (10, 19), (2000, 2559):
+            stubber.add_response('get_object',
+                                 {'Body': StreamingBody(io.BytesIO(content[start:end + 1]), end - start + 1)},
+                                 {'Bucket': "any_bucket", 'Key': "plop", 'Range': f"bytes={start}-{end}",
+                                  'IfMatch': '"abc"'})
+        s3api.transfer_max_concurrency = 1
+        r = s3api.fetch(object_key="plop", destination_dir=str(tmp_path),
+                        byte_ranges=[(10, 19), (2000, None)])
+
+    assert r.read_bytes() == content[10:20] + content[2000:]
+
+
+def test_s3_fetch_byte_ranges_verified(tmp_path):
+    content = bytes(range(256)) * 10
+    s3api = S3ApiBucket(bucket_name="any_bucket", transfer_max_concurrency=1)
+
+    # Parts from different versions of the object
+    with Stubber(s3api.client) as stubber:
+        for (start, end), etag in zip([(10, 19), (100, 199)], ['"abc"', '"def"']):
+            stubber.add_response('get_object',
+                                 {'Body': StreamingBody(io.BytesIO(content[start:end + 1]), end - start + 1),
+                                  'ETag': etag})
+        assert s3api.fetch(object_key="plop", destination_dir=str(tmp_path), byte_ranges=[(10, 19), (100, 199)]) \
+            is None
+
+    # Truncated part
+    with Stubber(s3api.client) as stubber:
+        stubber.add_response('get_object', {'Body': StreamingBody(io.BytesIO(content[10:15]), 5), 'ETag': '"abc"'})
+        assert s3api.fetch(object_key="plop", destination_dir=str(tmp_path), byte_ranges=[(10, 19)]) is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_s3_fetch_byte_ranges_short_writes(tmp_path, monkeypatch):
+    content = bytes(range(256)) * 10
+    pwrite = os.pwrite
+    # Writes interrupted after a few bytes
+    monkeypatch.setattr(os, "pwrite", lambda fd, data, position: pwrite(fd, data[:7], position))
+    s3api = S3ApiBucket(bucket_name="any_bucket", transfer_max_concurrency=1)
+    with Stubber(s3api.client) as stubber:
+        stubber.add_response('get_object', {'Body': StreamingBody(io.BytesIO(content[100:600]), 500)},
+                             {'Bucket': "any_bucket", 'Key': "plop", 'Range': "bytes=100-599"})
+        r = s3api.fetch(object_key="plop", destination_dir=str(tmp_path), byte_ranges=[(100, 599)])
+
+    assert r.read_bytes() == content[100:600]
+
+
+def test_s3_fetch_resume(tmp_path):
+    content = bytes(range(256)) * 10
+    s3api = S3ApiBucket(bucket_name="any_bucket", resume_partial=True, use_download_db=True, db_dir=str(tmp_path))
+    with s3api:
+        record, _ = s3api.db_get_record(key="plop")
+        record.set_remote_validators(etag='"abc"')
+        record.set_failed()
+        record.save()
+    (tmp_path / "plop.tmp").write_bytes(content[:1000])
+
+    labels = s3api.get_metrics_labels()
+    downloaded_bytes = metrics.downloaded_bytes_total.get(**labels)
+    with Stubber(s3api.client) as stubber:
+        stubber.add_response('get_object',
+                             {'Body': StreamingBody(io.BytesIO(content[1000:]), len(content) - 1000),
+                              'ETag': '"abc"', 'LastModified': datetime(2021, 2, 1)},
+                             {'Bucket': "any_bucket", 'Key': "plop", 'Range': "bytes=1000-", 'IfMatch': '"abc"'})
+        r = s3api.fetch(object_key="plop", destination_dir=str(tmp_path))
+
+    assert r.read_bytes() == content
+    assert metrics.downloaded_bytes_total.get(**labels) == downloaded_bytes + len(content) - 1000
+    with s3api:
+        record, _ = s3api.db_get_record(key="plop")
+    assert record.checksum == f"sha256:{hashlib.sha256(content).hexdigest()}"
+
+
+def test_s3_list_keys_cache(tmp_path):
+    listing_cache.clear()
+    s3api = S3ApiBucket(bucket_name="any_bucket", listing_cache_dir=str(tmp_path))
+    listing = {'Contents': [{'Key': "plop/a", 'Size': 1}, {'Key': "plop/b", 'Size': 2}]}
+    with Stubber(s3api.client) as stubber:
+        stubber.add_response('list_objects_v2', listing, {'Bucket': "any_bucket", 'Prefix': "plop"})
+        assert s3api.list_keys("plop") == {"plop/a": 1, "plop/b": 2}
+        # Served from cache, without any request
+        assert s3api.list_keys("plop") == {"plop/a": 1, "plop/b": 2}
+        stubber.assert_no_pending_responses()
+
+        listing['Contents'].append({'Key': "plop/c", 'Size': 3})
+        stubber.add_response('list_objects_v2', listing, {'Bucket': "any_bucket", 'Prefix': "plop"})
+        assert "plop/c" in s3api.list_keys("plop", refresh=True)
+
+    # Listing is shared with other processes through cache directory
+    listing_cache.clear()
+    assert "plop/c" in S3ApiBucket(bucket_name="any_bucket", listing_cache_dir=str(tmp_path)).list_keys("plop")
+
+
+def test_s3_stat():
+    s3api = S3ApiBucket(bucket_name="any_bucket")
+    with Stubber(s3api.client) as stubber:
+        stubber.add_response('head_object',
+                             {'ContentLength': 42, 'ETag': '"abc"', 'LastModified': datetime(2021, 2, 1)},
+                             {'Bucket': "any_bucket", 'Key': "plop"})
+        stubber.add_client_error('head_object', service_error_code='404', http_status_code=404,
+                                 expected_params={'Bucket': "any_bucket", 'Key': "plip"})
+        assert s3api.stat("plop") == {'size': 42, 'etag': '"abc"', 'last_modified': datetime(2021, 2, 1)}
+        assert not s3api.exists("plip")
+
+    with Stubber(s3api.client) as stubber:
+        for key in "ab":
+            stubber.add_response('head_object',
+                                 {'ContentLength': 1, 'ETag': f'"{key}"', 'LastModified': datetime(2021, 2, 1)},
+                                 {'Bucket': "any_bucket", 'Key': key})
+        r = s3api.stat_many(["a", "b"], max_workers=1)
+    assert {key: info['etag'] for key, info in r.items()} == {'a': '"a"', 'b': '"b"'}
+
+
+def test_s3_metrics():
+    s3api = S3ApiBucket(bucket_name="metrics_bucket")
+    assert s3api.get_metrics_labels() == {'protocol': "s3", 'host': "", 'bucket': "metrics_bucket"}
+    nb_head = metrics.s3_requests_total.get(bucket="metrics_bucket", operation="HeadObject")
+
+    with Stubber(s3api.client) as stubber:
+        for key in "ab":
+            stubber.add_response('head_object',
+                                 {'ContentLength': 1, 'ETag': f'"{key}"', 'LastModified': datetime(2021, 2, 1),
+                                  'ResponseMetadata': {'RetryAttempts': 2}},
+                                 {'Bucket': "metrics_bucket", 'Key': key})
+        s3api.stat_many(["a", "b"], max_workers=1)
+
+    assert metrics.s3_requests_total.get(bucket="metrics_bucket", operation="HeadObject") == nb_head + 2
+    assert metrics.retries_total.get(protocol="s3", host="", bucket="metrics_bucket") >= 4
+
+
+def test_s3_client_cache():
+    s3api = S3ApiBucket(bucket_name="any_bucket")
+    other = S3ApiBucket(bucket_name="other_bucket")
+    assert s3api.client is other.client
+    assert s3api.s3.meta.client is s3api.client
+    assert s3api.bucket is s3api.bucket
+    assert S3ApiBucket(bucket_name="any_bucket", max_pool_connections=50).client is not s3api.client
+
+    # Resources are not thread-safe, each thread gets its own
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        bucket = executor.submit(lambda: s3api.bucket).result()
+    assert bucket is not s3api.bucket
+    assert bucket.meta.client is s3api.client
+
+
+def test_s3_client_cache_resource(monkeypatch):
+    s3api = S3ApiBucket(bucket_name="resource_bucket", max_pool_connections=7)
+    client = s3api.client
+
+    # Resources are built on top of the shared client, without creating another one
+    def fail(*args, **kwargs):
+        raise AssertionError("Unexpected client creation")
+    monkeypatch.setattr(boto3.session.Session, "client", fail)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        resources = list(executor.map(lambda _: s3api.s3, range(2)))
+    assert all(resource.meta.client is client for resource in resources)
+    assert type(resources[0]) is type(s3api.s3)
+    assert s3api.bucket.Object("plop").meta.client is client
+
+
+def test_s3_fetch_managed_checksum(tmp_path):
+    content = bytes(range(256)) * 10
+    head = {'ContentLength': len(content), 'ETag': f'"{hashlib.md5(content).hexdigest()}"',
+            'LastModified': datetime(2021, 2, 1)}
+
+    def stub_transfer(stubber: Stubber, head: dict = head):
+        # Object metadata is given to the transfer, which doesn't send its own HEAD request
+        stubber.add_response('head_object', head, {'Bucket': "any_bucket", 'Key': "plop"})
+        stubber.add_response('get_object', {'Body': StreamingBody(io.BytesIO(content), len(content)),
+                                            'ContentLength': len(content), 'ETag': head['ETag']})
+
+    # By default, size is verified without hashing downloaded file again
+    s3api = S3ApiBucket(bucket_name="any_bucket", transfer_use_threads=False)
+    remote_info = {}
+    with Stubber(s3api.client) as stubber:
+        stub_transfer(stubber)
+        r = s3api.fetch(object_key="plop", destination_dir=str(tmp_path), remote_info=remote_info)
+        stubber.assert_no_pending_responses()
+    assert r.read_bytes() == content
+    assert remote_info['size'] == len(content)
+    assert 'checksum' not in remote_info
+
+    # Truncated download
+    with Stubber(s3api.client) as stubber:
+        stub_transfer(stubber, dict(head, ContentLength=len(content) + 10))
+        assert s3api.fetch(object_key="plop", destination_dir=str(tmp_path / "truncated")) is None
+    assert not (tmp_path / "truncated" / "plop").exists()
+    assert not (tmp_path / "truncated" / "plop.tmp").exists()
+
+    # Opt-in checksum, by reading the file again
+    s3api = S3ApiBucket(bucket_name="any_bucket", transfer_use_threads=False,
+                        checksum_after_transfer=True, checksum_algorithm="sha256")
+    with Stubber(s3api.client) as stubber:
+        stub_transfer(stubber)
+        r = s3api.fetch(object_key="plop", destination_dir=str(tmp_path), remote_info=remote_info)
+        stubber.assert_no_pending_responses()
+    assert r.read_bytes() == content
+    assert remote_info['checksum'] == f"sha256:{hashlib.sha256(content).hexdigest()}"
+
+
+def test_s3_fetch_checksum_mismatch(tmp_path):
+    content = bytes(range(256)) * 10
+    s3api = S3ApiBucket(bucket_name="any_bucket", resume_partial=True)
+    with Stubber(s3api.client) as stubber:
+        stubber.add_response('get_object',
+                             {'Body': StreamingBody(io.BytesIO(content), len(content)), 'ContentLength': len(content),
+                              'ETag': f'"{hashlib.md5(b"other content").hexdigest()}"',
+                              'LastModified': datetime(2021, 2, 1)},
+                             {'Bucket': "any_bucket", 'Key': "plop"})
+        r = s3api.fetch(object_key="plop", destination_dir=str(tmp_path))
+
+    assert r is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_s3_fetch_conditional(tmp_path):
+    content = b"some content"
+    head = {'ContentLength': len(content), 'ETag': f'"{hashlib.md5(content).hexdigest()}"',
+            'LastModified': datetime(2021, 2, 1)}
+    s3api = S3ApiBucket(bucket_name="any_bucket", conditional_fetch=True)
+    (tmp_path / "plop").write_bytes(content)
+    s3api.write_validators(tmp_path / "plop", {'etag': head['ETag'], 'size': len(content)})
+
+    # A single HEAD request, without any download
+    with Stubber(s3api.client) as stubber:
+        stubber.add_response('head_object', head, {'Bucket': "any_bucket", 'Key': "plop"})
+        r = s3api.fetch(object_key="plop", destination_dir=str(tmp_path))
+        stubber.assert_no_pending_responses()
+    assert r == tmp_path / "plop"
+    assert r.read_bytes() == content
+
+    # Local file was modified, validators don't apply anymore
+    (tmp_path / "plop").write_bytes(b"modified")
+    assert s3api.read_validators(tmp_path / "plop") is None
+
+
+def test_s3_fetch_shared_pool(tmp_path):
+    content = bytes(range(256)) * 10
+    s3api = S3ApiBucket(bucket_name="any_bucket", transfer_use_shared_pool=True)
+    with Stubber(s3api.client) as stubber:
+        stubber.add_response('head_object', {'ContentLength': len(content), 'ETag': '"abc"',
+                                             'LastModified': datetime(2021, 2, 1)})
+        stubber.add_response('get_object', {'Body': StreamingBody(io.BytesIO(content), len(content)),
+                                            'ContentLength': len(content), 'ETag': '"abc"'})
+        r = s3api.fetch(object_key="plop", destination_dir=str(tmp_path))
+        stubber.assert_no_pending_responses()
+    assert r.read_bytes() == content
+    assert transfer_budget.in_use == 0
@@ -0,0 +1,33 @@
+from datafetch.utils.availability import ExpectedAvailability, compute_expected_availability, next_poll_delay, \
+    percentile
+
+
+def test_expected_availability():
+    assert percentile([5, 1, 3, 2, 4], 95) == 5
+    assert percentile([5, 1, 3, 2, 4], 50) == 3
+
+    expected = compute_expected_availability({'000': [100, 110, 120, 1000], '003': [200]}, min_samples=2)
+    assert list(expected) == ['000']
+    assert expected['000'].median == 115
+    assert expected['000'].p95 == 1000
+
+
+def test_next_poll_delay():
+    expected = [ExpectedAvailability(median=1000, p95=1200, nb_samples=10),
+                ExpectedAvailability(median=2000, p95=2100, nb_samples=10)]
+    # Nothing expected soon
+    assert next_poll_delay(0, expected, min_interval=10, max_interval=600, margin=60) == 600
+    # Sleep until window of first timestep
+    assert next_poll_delay(700, expected, min_interval=10, max_interval=600, margin=60) == 240
+    # Inside window, margins included
+    assert next_poll_delay(1000, expected, min_interval=10, max_interval=600, margin=60) == 10
+    assert next_poll_delay(1250, expected, min_interval=10, max_interval=600, margin=60) == 10
+    # After window of first timestep, backoff since it is late, bounded by window of second one
+    assert next_poll_delay(1500, expected, min_interval=10, max_interval=600, margin=60) == 120
+    assert next_poll_delay(1800, expected, min_interval=10, max_interval=600, margin=60) == 140
+    # Later than usual : backoff from dense to sparse polling
+    assert next_poll_delay(2170, expected, min_interval=10, max_interval=600, margin=60) == 10
+    assert next_poll_delay(2260, expected, min_interval=10, max_interval=600, margin=60) == 50
+    assert next_poll_delay(5000, expected, min_interval=10, max_interval=600, margin=60) == 600
+    # Unknown availability
+    assert next_poll_delay(0, expected + [None], min_interval=10, max_interval=600) == 10
@@ -0,0 +1,120 @@
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from datafetch.protocol.http.core import SimpleHttpFetch
+from datafetch.utils.cache import DownloadCache
+
+
+def test_cache_put_materialize(tmp_path):
+    cache = DownloadCache(cache_dir=str(tmp_path / "cache"))
+    fp = tmp_path / "a" / "file.grib"
+    fp.parent.mkdir()
+    fp.write_text("some content")
+
+    assert cache.materialize("s3://plop/file.grib", tmp_path / "b" / "file.grib") is None
+    stored_fp = cache.put("s3://plop/file.grib", fp, checksum="sha256:abcdef")
+    assert os.path.samefile(stored_fp, fp)
+
+    r = cache.materialize("s3://plop/file.grib", tmp_path / "b" / "file.grib")
+    assert r.read_text() == "some content"
+    assert os.path.samefile(r, fp)
+    assert cache.get_entry("s3://plop/file.grib").nb_hits == 1
+
+    # Same content under another key is stored once
+    other_fp = tmp_path / "other.grib"
+    other_fp.write_text("some content")
+    assert cache.put("https://plop/file.grib", other_fp, checksum="sha256:abcdef") == stored_fp
+    assert os.path.samefile(other_fp, fp)
+    assert cache.total_size() == len("some content")
+
+
+def test_cache_put_hardlink_fallback(tmp_path, monkeypatch):
+    # Cache on another filesystem
+    def cross_device_link(source, destination):
+        raise OSError(18, "Invalid cross-device link")
+    monkeypatch.setattr(os, "link", cross_device_link)
+    copies = []
+    copyfile = shutil.copyfile
+    monkeypatch.setattr(shutil, "copyfile", lambda src, dst: copies.append((src, dst)) or copyfile(src, dst))
+
+    cache = DownloadCache(cache_dir=str(tmp_path / "cache"))
+    fp = tmp_path / "file.grib"
+    fp.write_text("some content")
+    stored_fp = cache.put("plop", fp, checksum="sha256:abcdef")
+    # Stored with a single copy, destination isn't copied back
+    assert copies == [(fp, stored_fp.with_name(f".{stored_fp.name}.{os.getpid()}.{threading.get_ident()}.link"))]
+    assert fp.read_text() == "some content"
+    assert not os.path.samefile(fp, stored_fp)
+
+    # Same content already stored
+    other_fp = tmp_path / "other.grib"
+    other_fp.write_text("some content")
+    cache.put("plip", other_fp, checksum="sha256:abcdef")
+    assert len(copies) == 1
+    assert other_fp.read_text() == "some content"
+
+
+def test_cache_link_concurrent(tmp_path):
+    cache = DownloadCache(cache_dir=str(tmp_path / "cache"), link_mode="copy")
+    fp = tmp_path / "file.grib"
+    fp.write_bytes(b"0" * 1024 * 1024)
+    cache.put("plop", fp)
+
+    # Threads materializing the same destination don't share a temporary file
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        r = list(executor.map(lambda _: cache.materialize("plop", tmp_path / "out" / "file.grib"), range(32)))
+    assert all(fp.read_bytes() == b"0" * 1024 * 1024 for fp in r)
+    assert [fp.name for fp in (tmp_path / "out").iterdir()] == ["file.grib"]
+
+
+def test_cache_link_modes(tmp_path):
+    for link_mode in ("copy", "symlink", "reflink"):
+        cache = DownloadCache(cache_dir=str(tmp_path / link_mode), link_mode=link_mode)
+        fp = tmp_path / f"{link_mode}.grib"
+        fp.write_text("some content")
+        cache.put("plop", fp)
+        r = cache.materialize("plop", tmp_path / link_mode / "out" / "file.grib")
+        assert r.read_text() == "some content"
+        assert r.is_symlink() == (link_mode == "symlink")
+        assert not os.path.samefile(r, fp) or link_mode == "symlink"
+
+
+def test_cache_eviction(tmp_path):
+    cache = DownloadCache(cache_dir=str(tmp_path / "cache"), max_size=25)
+    for name in ("a", "b", "c"):
+        if name == "c":
+            # "a" is used again, "b" becomes least recently used
+            cache.materialize("a", tmp_path / "a2")
+        fp = tmp_path / name
+        fp.write_text(name * 10)
+        cache.put(name, fp)
+        time.sleep(0.01)
+
+    assert cache.get_entry("b") is None
+    assert cache.get_entry("a") is not None
+    assert cache.get_entry("c") is not None
+    assert cache.total_size() == 20
+
+    # Replacing a file doesn't evict others
+    (tmp_path / "c").write_text("d" * 10)
+    cache.put("c", tmp_path / "c")
+    assert cache.get_entry("a") is not None
+    assert cache.total_size() == 20
+
+    cache.ttl = 0
+    assert cache.evict() == 2
+    assert cache.total_size() == 0
+
+
+def test_cache_created_once(tmp_path):
+    fetcher = SimpleHttpFetch(cache_dir=str(tmp_path / "cache"))
+    cache = fetcher.download_cache
+    assert fetcher.download_cache is cache
+    assert cache.db_model is cache.db_model
+
+    fetcher.cache_max_size = 100
+    assert fetcher.download_cache is not cache
+    assert fetcher.download_cache.max_size == 100
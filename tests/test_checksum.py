@@ -0,0 +1,33 @@
+import hashlib
+
+import pytest
+
+from datafetch.utils.checksum import Checksum, ChecksumMismatchError, md5_from_etag
+
+
+def test_md5_from_etag():
+    md5 = hashlib.md5(b"plop").hexdigest()
+    assert md5_from_etag(f'"{md5}"') == md5
+    assert md5_from_etag(f'"{md5}-12"') is None
+    assert md5_from_etag(f'W/"{md5}"') is None
+    assert md5_from_etag(None) is None
+
+
+def test_checksum(tmp_path):
+    checksum = Checksum("sha256", with_md5=True)
+    for chunk in (b"some ", b"content"):
+        checksum.update(chunk)
+    assert checksum.value == f"sha256:{hashlib.sha256(b'some content').hexdigest()}"
+    checksum.verify(etag=f'"{hashlib.md5(b"some content").hexdigest()}"', size=12)
+    with pytest.raises(ChecksumMismatchError):
+        checksum.verify(size=13)
+    with pytest.raises(ChecksumMismatchError):
+        checksum.verify(etag=f'"{hashlib.md5(b"other content").hexdigest()}"')
+
+    # Resuming from a partial file
+    fp = tmp_path / "partial"
+    fp.write_bytes(b"some content, and more")
+    checksum = Checksum("sha256")
+    checksum.update_from_file(fp, size=5, chunk_size=2)
+    checksum.update(b"content")
+    assert checksum.value == f"sha256:{hashlib.sha256(b'some content').hexdigest()}"
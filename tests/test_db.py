@@ -1,7 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
 
+import peewee
+
 from datafetch.core import DownloadedFileRecorderMixin
-from datafetch.utils.db import DownloadRecord
+from datafetch.utils.db import DownloadRecord, migrate_tables
 
 
 def test_downdb(tmp_path):
@@ -47,3 +51,117 @@ def test_downdb_record(tmp_path: Path):
     assert record.filepath == str(fp.absolute())
     assert record.size == fp.stat().st_size
     assert record.date_stop
+
+
+def test_downdb_migration(tmp_path):
+    # A database created before some columns were added
+    database = peewee.SqliteDatabase(str(tmp_path / "old.db"))
+    database.execute_sql("CREATE TABLE downloadrecord (id INTEGER PRIMARY KEY, key VARCHAR(255) UNIQUE, "
+                         "status VARCHAR(255), nb_try INTEGER)")
+    migrate_tables(database, [DownloadRecord])
+    columns = {column.name for column in database.get_columns("downloadrecord")}
+    assert {"etag", "last_modified", "filepath"} <= columns
+
+
+def test_downdb_persistent_connection(tmp_path):
+    recorder = DownloadedFileRecorderMixin(db_dir=str(tmp_path))
+    with recorder:
+        assert recorder.db.execute_sql("PRAGMA journal_mode").fetchone()[0] == "wal"
+        connection = recorder.db.connection()
+    with recorder:
+        assert recorder.db.connection() is connection
+
+    recorder.db_close()
+    assert recorder.db.is_closed()
+
+    recorder = DownloadedFileRecorderMixin(db_dir=str(tmp_path), keep_db_open=False)
+    with recorder:
+        assert not recorder.db.is_closed()
+    assert recorder.db.is_closed()
+
+
+def test_downdb_concurrent(tmp_path):
+    recorders = [DownloadedFileRecorderMixin(db_dir=str(tmp_path), db_name=f"db{i % 2}") for i in range(8)]
+
+    def record(args):
+        i, recorder = args
+        for j in range(20):
+            with recorder:
+                r, _ = recorder.db_get_record(key=f"{i}-{j}")
+                r.set_downloaded()
+                r.save()
+        return recorder.db_model.select().count()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(record, enumerate(recorders)))
+
+    for name in "db0", "db1":
+        recorder = DownloadedFileRecorderMixin(db_dir=str(tmp_path), db_name=name)
+        assert recorder.db_model.select().count() == 80
+        assert recorder.db_model.select().where(recorder.db_model.status == "downloaded").count() == 80
+
+
+def test_downdb_plan(tmp_path):
+    recorder = DownloadedFileRecorderMixin(db_dir=str(tmp_path))
+    with recorder:
+        for key, status in ("a", "downloaded"), ("b", "failed"), ("c", "downloaded"):
+            record, _ = recorder.db_get_record(key=key)
+            record.status = status
+            record.save()
+
+    keys = ["a", "b", "c", "d"] + [f"k{i}" for i in range(2000)]
+    plan = recorder.db_plan(keys)
+    assert plan["downloaded"] == ["a", "c"]
+    assert plan["failed"] == ["b"]
+    assert len(plan["missing"]) == 2001
+
+    # Missing records have been created
+    plan = recorder.db_plan(keys, create_missing=False)
+    assert "missing" not in plan
+    assert len(plan["empty"]) == 2001
+
+    assert recorder.db_keys_to_download(["a", "b", "c", "d", "e"]) == ["b", "d", "e"]
+
+
+def test_availability_record(tmp_path):
+    fetcher = DownloadedFileRecorderMixin(db_dir=str(tmp_path))
+    for day in range(1, 4):
+        run_time = datetime(2021, 2, day)
+        timesteps = {f"{day}/000": "000", f"{day}/003": "003"}
+        fetcher.db_record_availability("plop", run_time, timesteps, [], observed_at=run_time + timedelta(hours=3))
+        fetcher.db_record_availability("plop", run_time, timesteps, [f"{day}/000"],
+                                       observed_at=run_time + timedelta(hours=3, minutes=10))
+        fetcher.db_record_availability("plop", run_time, timesteps, [f"{day}/000", f"{day}/003"],
+                                       observed_at=run_time + timedelta(hours=3, minutes=20))
+
+    offsets = fetcher.db_get_availability_offsets("plop", max_runs=2)
+    assert offsets == {'000': [3 * 3600 + 300] * 2, '003': [3 * 3600 + 900] * 2}
+
+    # Most recent runs are kept
+    run_time = datetime(2021, 2, 4)
+    fetcher.db_record_availability("plop", run_time, {"4/000": "000"}, [], observed_at=run_time)
+    fetcher.db_record_availability("plop", run_time, {"4/000": "000"}, ["4/000"],
+                                   observed_at=run_time + timedelta(hours=1))
+    offsets = fetcher.db_get_availability_offsets("plop", max_runs=2)
+    assert offsets == {'000': [1800, 3 * 3600 + 300], '003': [3 * 3600 + 900] * 2}
+    assert fetcher.db_get_availability_offsets("plip") == {}
+
+
+def test_downdb_delete_records(tmp_path):
+    recorder = DownloadedFileRecorderMixin(db_dir=str(tmp_path))
+    with recorder:
+        for name in ("a/1", "a/2", "ab/1", "b/1"):
+            fp = tmp_path / name
+            fp.parent.mkdir(exist_ok=True)
+            fp.write_text(name)
+            record, _ = recorder.db_get_record(key=name)
+            record.set_downloaded(fp)
+            record.save()
+
+    # Directory "ab" is not under "a"
+    assert recorder.db_delete_records_under([tmp_path / "a"]) == 2
+    assert sorted(record.key for record in recorder.db_model.select()) == ["ab/1", "b/1"]
+
+    (tmp_path / "b" / "1").unlink()
+    assert recorder.db_forget_missing_files() == 1
+    assert [record.key for record in recorder.db_model.select()] == ["ab/1"]
@@ -0,0 +1,37 @@
+from datafetch.utils.grib import parse_grib_idx, select_grib_idx_entries, merge_byte_ranges
+
+idx_content = """1:0:d=2021020200:PRMSL:mean sea level:3 hour fcst:
+2:1000:d=2021020200:TMP:850 mb:3 hour fcst:
+3:2500:d=2021020200:UGRD:850 mb:3 hour fcst:
+3.2:2500:d=2021020200:VGRD:850 mb:3 hour fcst:
+4:4000:d=2021020200:TMP:2 m above ground:3 hour fcst:
+5:5200:d=2021020200:UGRD:10 m above ground:3 hour fcst:
+"""
+
+
+def test_parse_grib_idx():
+    entries = parse_grib_idx(idx_content)
+    assert len(entries) == 6
+    assert entries[0].variable == "PRMSL"
+    assert entries[0].byte_range == (0, 999)
+    assert entries[2].byte_range == entries[3].byte_range == (2500, 3999)
+    assert entries[-1].byte_range == (5200, None)
+
+
+def test_select_grib_idx_entries():
+    entries = parse_grib_idx(idx_content)
+
+    selected = select_grib_idx_entries(entries, ["TMP"])
+    assert [e.level for e in selected] == ["850 mb", "2 m above ground"]
+
+    selected = select_grib_idx_entries(entries, ["TMP:850 mb", "UGRD:850 mb", "VGRD:850 mb"])
+    assert [e.offset for e in selected] == [1000, 2500]
+
+    assert select_grib_idx_entries(entries, ["PLOP"]) == []
+
+
+def test_merge_byte_ranges():
+    assert merge_byte_ranges([(1000, 2499), (0, 999), (4000, 5199)]) == [(0, 2499), (4000, 5199)]
+    assert merge_byte_ranges([(0, 999), (2500, 3999)], max_gap=1500) == [(0, 3999)]
+    assert merge_byte_ranges([(4000, 5199), (5200, None)]) == [(4000, None)]
+    assert merge_byte_ranges([(0, None), (1000, 1999)]) == [(0, None)]
@@ -0,0 +1,63 @@
+import urllib.request
+
+import pytest
+
+from datafetch.utils.metrics import MetricsRegistry
+
+
+def test_metrics_export():
+    registry = MetricsRegistry()
+    counter = registry.counter("plop_total", "Plop", ("host",))
+    gauge = registry.gauge("plop_in_progress", "Plop in progress")
+    histogram = registry.histogram("plop_seconds", "Plop duration", ("host",), buckets=(1, 10))
+
+    counter.inc(host='a"b')
+    counter.inc(2, host='a"b')
+    with gauge.track_in_progress():
+        assert gauge.get() == 1
+    histogram.observe(0.5, host="a")
+    histogram.observe(5, host="a")
+
+    assert registry.counter("plop_total", "Plop", ("host",)) is counter
+    with pytest.raises(ValueError):
+        registry.gauge("plop_total", "Plop")
+    with pytest.raises(ValueError):
+        counter.inc(-1, host="a")
+    with pytest.raises(ValueError):
+        counter.inc(plip="a")
+
+    assert registry.to_prometheus() == "\n".join([
+        '# HELP plop_total Plop',
+        '# TYPE plop_total counter',
+        'plop_total{host="a\\"b"} 3.0',
+        '# HELP plop_in_progress Plop in progress',
+        '# TYPE plop_in_progress gauge',
+        'plop_in_progress 0.0',
+        '# HELP plop_seconds Plop duration',
+        '# TYPE plop_seconds histogram',
+        'plop_seconds_bucket{host="a",le="1.0"} 1.0',
+        'plop_seconds_bucket{host="a",le="10.0"} 2.0',
+        'plop_seconds_bucket{host="a",le="+Inf"} 2.0',
+        'plop_seconds_sum{host="a"} 5.5',
+        'plop_seconds_count{host="a"} 2.0',
+    ]) + "\n"
+
+    registry.clear()
+    assert counter.get(host='a"b') == 0
+
+
+def test_metrics_endpoints(tmp_path):
+    registry = MetricsRegistry()
+    registry.counter("plop_total", "Plop").inc()
+
+    registry.write_textfile(tmp_path / "metrics" / "datafetch.prom")
+    assert (tmp_path / "metrics" / "datafetch.prom").read_text() == registry.to_prometheus()
+
+    server = registry.start_http_server(port=0)
+    try:
+        host, port = server.server_address
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics") as r:
+            assert r.headers["Content-Type"].startswith("text/plain")
+            assert r.read().decode() == registry.to_prometheus()
+    finally:
+        server.shutdown()
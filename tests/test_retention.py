@@ -0,0 +1,23 @@
+from datetime import datetime
+
+from datafetch.utils.retention import select_expired_runs, get_free_space, get_directory_size
+
+
+def test_select_expired_runs():
+    run_times = [datetime(2021, 2, day, hour) for day in (1, 2, 3) for hour in (0, 12)]
+    now = datetime(2021, 2, 3, 18)
+
+    assert select_expired_runs(run_times, now=now) == []
+    assert select_expired_runs(run_times, keep_runs=4, now=now) == run_times[:2]
+    assert select_expired_runs(run_times, keep_days=1, now=now) == run_times[:4]
+    # Runs are kept if they satisfy any of the criteria
+    assert select_expired_runs(run_times, keep_runs=3, keep_days=1, now=now) == run_times[:3]
+
+
+def test_disk_space(tmp_path):
+    assert get_free_space(tmp_path / "not" / "yet") == get_free_space(tmp_path) > 0
+
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "file").write_bytes(b"0" * 10)
+    (tmp_path / "file").write_bytes(b"0" * 5)
+    assert get_directory_size(tmp_path) == 15
@@ -1,10 +1,13 @@
 from datetime import timedelta, datetime
 from pathlib import Path
 
+import pytest
+
 from datafetch.utils.db import DownloadRecord
 from datafetch.weather.ecmwf.core import EcmwfEra5S3, EcmwfEra5CDS
 
 
+@pytest.mark.network
 def test_era5_aws_filter(tmp_path):
     s3 = EcmwfEra5S3()
 
@@ -18,6 +21,7 @@ def test_era5_aws_filter(tmp_path):
     assert r is True
 
 
+@pytest.mark.network
 def test_era5_aws_fetch(tmp_path):
     s3 = EcmwfEra5S3()
 
@@ -31,6 +35,8 @@ def test_era5_aws_fetch(tmp_path):
     assert isinstance(r, Path)
 
 
+@pytest.mark.network
+@pytest.mark.cds
 def test_era5_cds(tmp_path):
     cds = EcmwfEra5CDS(
         destination_dir=str(tmp_path),
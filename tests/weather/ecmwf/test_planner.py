@@ -0,0 +1,41 @@
+from datetime import date
+
+from datafetch.weather.ecmwf.planner import LogicalRequest, plan_requests, find_planned_request, date_range
+
+
+def test_plan_merge_small_months():
+    request = LogicalRequest(
+        name='reanalysis-era5-single-levels',
+        variables=['total_precipitation'],
+        dates=date_range(date(2020, 1, 1), date(2020, 12, 31)),
+        extra={'product_type': 'reanalysis', 'format': 'grib'}
+    )
+    planned = plan_requests(request)
+    assert len(planned) == 1
+    assert planned[0].months == list(range(1, 13))
+    assert planned[0].param['day'][-1] == "31"
+    assert planned[0].filename.endswith(".grib")
+
+
+def test_plan_split_large_months():
+    request = LogicalRequest(
+        name='reanalysis-era5-pressure-levels',
+        variables=['temperature', 'geopotential', 'u_component_of_wind', 'v_component_of_wind'],
+        levels=[str(level) for level in range(100, 1001, 50)],
+        dates=date_range(date(2020, 1, 15), date(2020, 3, 31)),
+    )
+    planned = plan_requests(request, max_fields=20000)
+    assert all(p.nb_fields <= 20000 for p in planned)
+
+    # Every field is planned exactly once
+    for variable in request.variables:
+        for day in request.dates:
+            for level in request.levels:
+                matching = [p for p in planned if p.covers(variable, day, level=level, time="06:00")]
+                assert len(matching) == 1
+
+    # Partial January is not merged with full months
+    january = find_planned_request(planned, 'temperature', date(2020, 1, 20), level='500')
+    assert january.months == [1]
+    assert january.days == list(range(15, 32))
+    assert find_planned_request(planned, 'temperature', date(2020, 1, 2)) is None
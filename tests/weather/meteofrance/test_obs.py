@@ -1,10 +1,13 @@
 from pathlib import Path
 
+import pytest
+
 from datafetch.protocol.http.core import SimpleHttpFetch
 from datafetch.core import FetchWithTemporaryExtensionMixin
 from datafetch.weather.meteofrance.obs.core import MeteoFranceObservationFetch
 
 
+@pytest.mark.network
 def test_meteofrance_obs(tmp_path):
     fetcher = MeteoFranceObservationFetch()
     assert isinstance(fetcher, (MeteoFranceObservationFetch,
@@ -1,12 +1,22 @@
+import io
+import time
 from pathlib import Path
 from datetime import datetime, timedelta
 
+import pytest
+from botocore.exceptions import EndpointConnectionError
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+from datafetch.protocol.s3 import listing_cache
+from datafetch.utils.retention import InsufficientDiskSpaceError
 from datafetch.weather.noaa.nwp import NoaaGfsS3
 
 yesterday = datetime.today() - timedelta(days=1)
 date_day = yesterday.strftime("%Y%m%d")
 
 
+@pytest.mark.network
 def test_filter():
     s3api = NoaaGfsS3()
     r = s3api.filter(
@@ -15,6 +25,7 @@ def test_filter():
     assert isinstance(list(r), list)
 
 
+@pytest.mark.network
 def test_download(tmp_path):
     s3api = NoaaGfsS3()
     r = s3api.fetch(
@@ -23,6 +34,7 @@ def test_download(tmp_path):
     assert isinstance(r, Path)
 
 
+@pytest.mark.network
 def test_check_availability():
     s3api = NoaaGfsS3()
     r = s3api.check_timestep_availability(
@@ -33,6 +45,21 @@ def test_check_availability():
     assert isinstance(r, dict)
 
 
+def test_check_availability_listing_cache():
+    listing_cache.clear()
+    s3api = NoaaGfsS3()
+    prefix = s3api.get_daterun_prefix("20210201", "00")
+    listing = {'Contents': [{'Key': s3api.get_timestep_key("20210201", "00", timestep) + suffix, 'Size': 1}
+                            for timestep in ("000", "003") for suffix in ("", ".idx")]}
+    with Stubber(s3api.client) as stubber:
+        stubber.add_response('list_objects_v2', listing, {'Bucket': s3api.bucket_name, 'Prefix': prefix})
+        assert s3api.check_run_availability("20210201", "00") is not None
+        assert s3api.check_timestep_availability("20210201", "00", "003") is not None
+        assert NoaaGfsS3().check_timestep_availability("20210201", "00", "000") is not None
+        assert s3api.check_timestep_availability("20210201", "00", "006") is None
+
+
+@pytest.mark.network
 def test_download_with_db(tmp_path):
     s3api = NoaaGfsS3(
         use_download_db=True, db_dir=str(tmp_path)
@@ -56,3 +83,178 @@ def test_download_with_db(tmp_path):
         download_dir=str(tmp_path)
     )
     assert not fp.exists()
+
+
+@pytest.mark.network
+def test_download_subset(tmp_path):
+    s3api = NoaaGfsS3()
+    r = s3api.download_timestep_subset(
+        date_day=date_day, run=0, timestep="003",
+        fields=["TMP:850 mb", "UGRD:10 m above ground", "VGRD:10 m above ground"],
+        download_dir=str(tmp_path)
+    )
+    assert isinstance(r, dict)
+    fp = Path(r['fp'])
+    assert fp.is_file()
+    assert fp.read_bytes()[:4] == b"GRIB"
+
+
+def test_download_subset_stubbed(tmp_path):
+    messages = [b"GRIB" + bytes([i]) * 96 for i in range(4)]
+    content = b"".join(messages)
+    index = "\n".join([
+        "1:0:d=2021020100:PRMSL:mean sea level:3 hour fcst:",
+        "2:100:d=2021020100:TMP:850 mb:3 hour fcst:",
+        "3:200:d=2021020100:UGRD:10 m above ground:3 hour fcst:",
+        "4:300:d=2021020100:VGRD:10 m above ground:3 hour fcst:",
+    ])
+    s3api = NoaaGfsS3()
+    object_key = s3api.get_timestep_key("20210201", "00", "003")
+    with Stubber(s3api.client) as stubber:
+        stubber.add_response('get_object', {'Body': StreamingBody(io.BytesIO(index.encode()), len(index))},
+                             {'Bucket': s3api.bucket_name, 'Key': f"{object_key}.idx"})
+        stubber.add_response('head_object', {'ContentLength': len(content), 'ETag': '"abc"',
+                                             'LastModified': datetime(2021, 2, 1)},
+                             {'Bucket': s3api.bucket_name, 'Key': object_key})
+        # Adjacent messages in a single request, the last one until the end of the object
+        stubber.add_response('get_object', {'Body': StreamingBody(io.BytesIO(content[100:400]), 300)},
+                             {'Bucket': s3api.bucket_name, 'Key': object_key, 'Range': "bytes=100-399",
+                              'IfMatch': '"abc"'})
+        r = s3api.download_timestep_subset("20210201", "00", "003",
+                                           fields=["TMP:850 mb", "UGRD", "VGRD:10 m above ground"],
+                                           download_dir=str(tmp_path))
+        stubber.assert_no_pending_responses()
+
+    assert Path(r['fp']).read_bytes() == b"".join(messages[1:])
+
+
+class FakeWatchedGfs(NoaaGfsS3):
+    """
+    A run being published : each listing reveals one more timestep, first download of "006" fails
+    """
+    timesteps: list = []
+    nb_listings: int = 0
+    downloads: list = []
+
+    def list_keys(self, prefix: str, refresh: bool = False) -> dict:
+        self.nb_listings += 1
+        return {self.get_timestep_key("20210201", "00", timestep): 1
+                for timestep in self.timesteps[:self.nb_listings]}
+
+    def download_timestep(self, date_day: str, run: str, timestep: str, download_dir: str) -> dict:
+        self.downloads.append(timestep)
+        if timestep == "006" and self.downloads.count("006") == 1:
+            return None
+        return {'fp': f"{download_dir}/{timestep}"}
+
+
+def test_watch_run():
+    s3api = FakeWatchedGfs(timesteps=["000", "003", "006"])
+    r = list(s3api.watch_run("20210201", "00", ["000", "003", "006"], download_dir="/plop", poll_interval=0.01))
+    assert sorted(timestep_info['timestep'] for timestep_info in r) == ["000", "003", "006"]
+    assert all(timestep_info['fp'] == f"/plop/{timestep_info['timestep']}" for timestep_info in r)
+    assert sorted(s3api.downloads) == ["000", "003", "006", "006"]
+
+
+class FakeUnreliableGfs(FakeWatchedGfs):
+    """
+    Second listing of the run fails
+    """
+    nb_errors: int = 0
+
+    def list_keys(self, prefix: str, refresh: bool = False) -> dict:
+        if self.nb_listings == 1 and not self.nb_errors:
+            self.nb_errors += 1
+            raise EndpointConnectionError(endpoint_url="https://noaa-gfs-bdp-pds.s3.amazonaws.com")
+        return super().list_keys(prefix, refresh=refresh)
+
+
+def test_watch_run_listing_error():
+    s3api = FakeUnreliableGfs(timesteps=["000", "003", "006"])
+    started = time.monotonic()
+    r = list(s3api.watch_run("20210201", "00", ["000", "003", "006"], download_dir="/plop", poll_interval=0.05))
+    assert sorted(timestep_info['timestep'] for timestep_info in r) == ["000", "003", "006"]
+    assert sorted(s3api.downloads) == ["000", "003", "006", "006"]
+    # Failed listing and download are each tried again after a poll interval
+    assert (s3api.nb_errors, s3api.nb_listings) == (1, 4)
+    assert time.monotonic() - started >= 4 * 0.05
+
+
+def test_watch_run_timeout():
+    s3api = FakeWatchedGfs(timesteps=["000"])
+    r = list(s3api.watch_run("20210201", "00", ["000", "003"], download_dir="/plop",
+                             poll_interval=0.01, timeout=0.05))
+    assert [timestep_info['timestep'] for timestep_info in r] == ["000"]
+
+
+def test_watch_run_records_availability(tmp_path):
+    s3api = FakeWatchedGfs(timesteps=["000", "003", "006"], use_download_db=True, db_dir=str(tmp_path))
+    list(s3api.watch_run("20210201", "00", ["000", "003", "006"], download_dir="/plop",
+                         poll_interval=0.01, max_poll_interval=0.05))
+    offsets = s3api.db_get_availability_offsets(s3api.bucket_name)
+    # First timestep was already there at first poll, so its publication time is unknown
+    assert sorted(offsets) == ["003", "006"]
+
+
+def make_downloaded_runs(s3api: NoaaGfsS3, download_dir: Path, date_days: list, size: int = 10):
+    for date_day in date_days:
+        for run in ("00", "12"):
+            fp = download_dir / s3api.get_timestep_key(date_day, run, "003")
+            fp.parent.mkdir(parents=True)
+            fp.write_bytes(b"0" * size)
+            record, _ = s3api.db_get_record(key=fp.relative_to(download_dir).as_posix())
+            record.set_downloaded(fp)
+            record.save()
+
+
+def test_prune_runs(tmp_path):
+    s3api = NoaaGfsS3(use_download_db=True, db_dir=str(tmp_path))
+    download_dir = tmp_path / "gfs"
+    make_downloaded_runs(s3api, download_dir, ["20210201", "20210202"])
+    (download_dir / "plop").mkdir()
+
+    runs = s3api.list_downloaded_runs(str(download_dir))
+    assert [run_time for run_time, _ in runs] == [
+        datetime(2021, 2, 2, 12), datetime(2021, 2, 2), datetime(2021, 2, 1, 12), datetime(2021, 2, 1)
+    ]
+
+    assert s3api.prune_runs(str(download_dir), keep_runs=3, dry_run=True) == [download_dir / "gfs.20210201/00"]
+    assert s3api.prune_runs(str(download_dir), keep_runs=3) == [download_dir / "gfs.20210201/00"]
+    assert not (download_dir / "gfs.20210201/00").exists()
+    assert (download_dir / "plop").exists()
+    assert s3api.db_model.select().count() == 3
+
+
+class FakePublishedGfs(NoaaGfsS3):
+    """
+    Run 20210203 / 00, whose timestep "006" is not published yet, on a disk where each run takes 50 bytes
+    """
+    free_space: int = 150
+
+    def list_keys(self, prefix: str, refresh: bool = False) -> dict:
+        return {self.get_timestep_key("20210203", "00", "003"): 100}
+
+    def remove_runs(self, run_dirs: list):
+        self.free_space += 50 * len(run_dirs)
+        super().remove_runs(run_dirs)
+
+
+def test_ensure_disk_space(tmp_path, monkeypatch):
+    s3api = FakePublishedGfs(use_download_db=True, db_dir=str(tmp_path))
+    download_dir = tmp_path / "gfs"
+    make_downloaded_runs(s3api, download_dir, ["20210201", "20210202"], size=50)
+    (download_dir / s3api.get_timestep_key("20210202", "12", "006")).write_bytes(b"0" * 20)
+
+    # "006" estimated from previous run
+    assert s3api.get_run_download_size("20210203", "00", ["003", "006"], str(download_dir)) == 120
+
+    monkeypatch.setattr("datafetch.weather.noaa.nwp.core.get_free_space", lambda path: s3api.free_space)
+    assert s3api.ensure_disk_space("20210203", "00", ["003", "006"], str(download_dir), min_free_space=30) == 120
+    with pytest.raises(InsufficientDiskSpaceError):
+        s3api.ensure_disk_space("20210203", "00", ["003", "006"], str(download_dir), min_free_space=40)
+
+    # Evicting oldest runs
+    s3api.ensure_disk_space("20210203", "00", ["003", "006"], str(download_dir), min_free_space=100, evict=True)
+    assert [run_dir.relative_to(download_dir).as_posix()
+            for _, run_dir in s3api.list_downloaded_runs(str(download_dir))] == ["gfs.20210202/12", "gfs.20210202/00"]
+    assert s3api.db_model.select().count() == 2
@@ -1,6 +1,7 @@
 from datetime import timedelta, datetime
 
 import prefect
+import pytest
 from prefect.tasks.prefect import StartFlowRun
 
 from datafetch.weather.noaa.nwp.flows import create_flow_download
@@ -10,6 +11,7 @@ yesterday = datetime.today() - timedelta(days=1)
 date_day = yesterday.strftime("%Y%m%d")
 
 
+@pytest.mark.network
 def test_flow(tmp_path):
     flow_download = create_flow_download(download_dir=str(tmp_path))
     flow_download.schedule = None
@@ -17,6 +19,7 @@ def test_flow(tmp_path):
     print(type(flow_run))
 
 
+@pytest.mark.network
 def test_flow_post_process(tmp_path):
     post = StartFlowRun(flow_name="gfs-post-processing", project_name="laptop-gfs-project")
     flow_download = create_flow_download(